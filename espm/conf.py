@@ -22,6 +22,9 @@ DATASETS_PATH = BASE_PATH.parent / Path("generated_datasets")
 # Ensure that the folder DATASETS_PATH exists
 DATASETS_PATH.mkdir(exist_ok=True, parents=True)
 
+# Default folder of the on-disk cache of the G matrices (see espm.models.g_cache)
+G_CACHE_PATH = DATASETS_PATH / Path("G_cache")
+
 
 
 DEFAULT_MISC_PARAMS = {
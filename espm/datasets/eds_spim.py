@@ -12,6 +12,7 @@ The main purpose of this class is to provide an easy and clean interface between
 
 from  hyperspy.signals import Signal1D
 from espm.models import EDXS
+from espm.models.g_cache import g_cache_key, load_g, save_g
 from exspy.misc.eds.utils import take_off_angle
 from espm.utils import number_to_symbol_list, get_explained_intensity_W, arg_helper
 import numpy as np
@@ -166,7 +167,7 @@ class EDS_espm(Signal1D) :
             raise AttributeError("There is no ground truth contained in this dataset")
         return phases, weights
 
-    def build_G(self, problem_type = "bremsstrahlung",*, elements_dict = {}) :
+    def build_G(self, problem_type = "bremsstrahlung",*, elements_dict = {}, cache = True, cache_dir = None) :
         r"""
         Build the G matrix of the :class:`espm.models.EDXS` model corresponding to the metadata of the :class:`EDS_espm` object and stores it as an attribute.
 
@@ -180,6 +181,10 @@ class EDS_espm(Signal1D) :
         elements_dict : dict, optional
             Dictionary containing atomic numbers and a corresponding cut-off energies. It is used to separate the characteristic X-rays of the given elements into two energies ranges and assign them each a column in the G matrix instead of having one column per element.
             For example elements_dict = {"26",3.0} will separate the characteristic X-rays of the element Fe into two energies ranges and assign them each a column in the G matrix. This is useful to circumvent issues with the absorption.
+        cache : bool, optional
+            If True, the G matrix is taken from the cache of :mod:`espm.models.g_cache` when it was already built with the same metadata, problem_type and elements_dict. Otherwise it is built and added to the cache.
+        cache_dir : str or pathlib.Path, optional
+            Folder where the cached G matrices are also stored on disk (e.g. espm.conf.G_CACHE_PATH), so that they are shared between sessions. If None, they are only kept in memory.
         Returns
         -------
         G : None or numpy.ndarray or callable
@@ -189,7 +194,14 @@ class EDS_espm(Signal1D) :
         self.separated_lines = elements_dict
         g_pars = {"g_type" : problem_type, "elements" : self.metadata.Sample.elements, "elements_dict" : elements_dict}
 
-        self.model.generate_g_matr(**g_pars)
+        key = g_cache_key(get_metadata(self), **g_pars) if cache else None
+        entry = None if key is None else load_g(key, cache_dir)
+        if entry is None : 
+            self.model.generate_g_matr(**g_pars)
+            if key is not None and self.model.G is not None : 
+                save_g(key, self.model.G, self.model.norm, self.model.model_elts, self.model.bkgd_in_G, cache_dir)
+        else : 
+            self.model.set_G(*entry)
         self.G_ = self.model.G
                 
         # Storing the model parameters in the metadata so that the decomposition does not erase them
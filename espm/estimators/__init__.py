@@ -10,4 +10,6 @@ The transform method is implemented in the child classes.
 
 """
 from espm.estimators.base import NMFEstimator
-from espm.estimators.smooth_nmf import SmoothNMF
\ No newline at end of file
+from espm.estimators.smooth_nmf import SmoothNMF
+from espm.estimators.online_nmf import OnlineSmoothNMF
+from espm.estimators.multi_start import MultiStartNMF
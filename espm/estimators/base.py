@@ -1,15 +1,30 @@
 import numpy as np
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.utils.validation import check_is_fitted
-from espm.estimators.updates import initialize_algorithms
+from espm.estimators.updates import initialize_algorithms, apply_G, ReconstructionCache, Workspace
 from espm.measures import KLdiv_loss, Frobenius_loss, find_min_angle, find_min_MSE
 from espm.conf import log_shift
 from espm.utils import rescaled_DH
 import time
 from abc import ABC, abstractmethod
-from espm.utils import create_laplacian_matrix 
-from scipy.sparse import lil_matrix
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import copy
+from espm.utils import LaplacianOperator
+from scipy.sparse import identity, issparse, csr_matrix
+from sklearn.utils import check_random_state
+from espm.estimators.chunks import PixelChunks
 from espm.models.base import PhysicalModel
+from espm.estimators.profiling import Profiler
+from contextlib import nullcontext
+
+
+IterationState = namedtuple("IterationState", ["n_iter", "loss", "rel_W", "rel_H", "timings", "W", "H"])
+IterationState.__doc__ = """State of the optimization passed to the `callback` of :class:`NMFEstimator`.
+
+`timings` is a dictionary with the wall time of the last iteration ("iteration") and since the beginning of the fit ("total"),
+in seconds, and the wall time of each phase of the last iteration if `profile` is set.
+`W` and `H` are read-only views of the current estimates, which should be copied to be kept."""
 
 
 def normalization_factor (X, nc) : 
@@ -89,9 +104,16 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
     G : np.array, function or None, default=None
         If np.array, it is the known matrix of the data. 
         If function, it is a function that takes as input the data matrix and returns the known matrix (np.array). 
-        If None, it is assumed that G is the identity matrix.
+        If None, it is assumed that G is the identity matrix. The identity is never built explicitly: the attribute `G_` is then None
+        and all the products with G are skipped. An explicit identity matrix is treated the same way.
     shape_2d : tuple or None, default=None
         If not None, it is the image shape of the columns of the matrices  :math:`X` and  :math:`H`.
+        The Laplacian of the smoothness regularization is then a :class:`espm.utils.LaplacianOperator` on this image.
+    laplacian_connectivity : int, default=4
+        Number of neighbours of the pixels in the Laplacian (4 or 8).
+    laplacian_mask : np.array or None, default=None
+        Boolean array of shape `shape_2d` selecting the pixels of a non-rectangular region. The columns of :math:`X` are then
+        the pixels of the mask, in the row-major order.
     normalize : bool, default=False
         If True, the algorithm will normalize the data matrix  :math:`X`.
     log_shift : float, default=1e-10
@@ -102,6 +124,13 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         Ground truth for the matrix :math:`GW`. Used for evaluation purposes.
     true_H : np.array or None, default=None
         Ground truth for the matrix :math:`H`. Used for evaluation purposes.
+    eval_truth_every : int, default=1
+        Number of iterations between each evaluation of the metrics of the ground truth (angles, MSE and loss of
+        `true_D` and `true_H`). The metrics of the other iterations are set to NaN.
+    eval_truth_background : bool, default=False
+        If True, the metrics of the ground truth are computed on a background thread from copies of W and H,
+        so that they do not slow down the optimization. The attributes `angles_`, `mse_` and `true_losses_` are then
+        only complete at the end of the fit.
     fixed_H : np.array or None, default=None
         If not None, it fixes the non-zero values of the matrix :math:`H`. 
         Note that convergence is not guaranteed with fixed_H enabled.
@@ -110,6 +139,32 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         Note that convergence is not guaranteed with fixed_W enabled.
     no_stop_criterion : bool, default=False
         If True, the algorithm will not stop when the stopping criterion is reached and will continue until max_iter is reached.
+    workspace : bool, default=False
+        If True, the buffers of shape (n, p) needed by the update steps and the loss are allocated once at the beginning of the fit
+        and reused at every iteration (see :class:`espm.estimators.updates.Workspace`). This reduces the peak memory and the
+        allocations for large datasets.
+    dtype : np.float32, np.float64 or None, default=None
+        If not None, the data matrix :math:`X`, the matrices :math:`G`, :math:`W`, :math:`H`, the Laplacian and the temporaries
+        of the optimization are kept in this precision. Using np.float32 halves the memory footprint. The KL log-sum and the
+        simplex multipliers are still accumulated in float64.
+        If None, :math:`X` is kept in float32 or float64 as provided.
+    chunk_size : int or None, default=None
+        If not None, :math:`X` is not loaded in memory but streamed by blocks of `chunk_size` pixels (columns of :math:`X`).
+        :math:`X` can then be any 2D array-like supporting slicing, for example a np.memmap, a h5py or a zarr dataset.
+        Only :math:`W`, :math:`H` and one block are resident. Each iteration reads the data three times (steps in H and W and loss).
+        Only the KL divergence is supported and the initialization must be random unless W or H is provided.
+    profile : bool or str, default=False
+        If True, the wall and CPU times of the phases of each iteration (steps in H and W, dichotomy, loss, update of G,
+        ground truth metrics and stopping checks) are recorded (see :class:`espm.estimators.profiling.Profiler`).
+        If "memory", the peak allocated bytes of each iteration are recorded as well, which slows down the optimization.
+        The records are returned by `get_profile` and can be exported with `export_profile`.
+    callback : callable or None, default=None
+        If not None, `callback(state)` is called every `callback_every` iterations with the state of the optimization,
+        an :class:`espm.estimators.base.IterationState` named tuple (n_iter, loss, rel_W, rel_H, timings, W, H).
+        If it returns True, the optimization stops. It can be used for wall-clock budgets, custom stopping criteria or
+        to report the progress.
+    callback_every : int, default=1
+        Number of iterations between the calls of `callback`.
     hspy_comp : bool, default=False
         If True, the algorithm will use the format compatible with hyperspy.
         Use this option if you run the algorithm with the method decompositio in hyperspy.
@@ -125,8 +180,9 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
     def __init__(self, n_components=2, init=None, tol=1e-4, max_iter=200,
                  random_state=None, verbose=1, debug=False,
                  l2=False,  G=None, shape_2d = None, normalize = False, log_shift=log_shift, 
-                 eval_print=10, true_D = None, true_H = None, fixed_H = None, fixed_W = None, hspy_comp = False, 
-                 no_stop_criterion = False, simplex_H=False, simplex_W = True
+                 eval_print=10, true_D = None, true_H = None, eval_truth_every = 1, eval_truth_background = False, fixed_H = None, fixed_W = None, hspy_comp = False, 
+                 no_stop_criterion = False, simplex_H=False, simplex_W = True, workspace = False, dtype = None, chunk_size = None,
+                 laplacian_connectivity = 4, laplacian_mask = None, profile = False, callback = None, callback_every = 1
                  ):
         self.n_components = n_components
         self.init = init
@@ -142,6 +198,8 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         self.eval_print = eval_print
         self.true_D = true_D
         self.true_H = true_H
+        self.eval_truth_every = eval_truth_every
+        self.eval_truth_background = eval_truth_background
         self.fixed_H = fixed_H
         self.fixed_W = fixed_W
         self.hspy_comp = hspy_comp
@@ -149,6 +207,14 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         self.no_stop_criterion = no_stop_criterion
         self.simplex_H = simplex_H
         self.simplex_W = simplex_W
+        self.workspace = workspace
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.laplacian_connectivity = laplacian_connectivity
+        self.laplacian_mask = laplacian_mask
+        self.profile = profile
+        self.callback = callback
+        self.callback_every = callback_every
 
     def _more_tags(self):
         return {'requires_positive_X': True}
@@ -180,21 +246,53 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
             Value of the loss function.
 
         """
-        GW = self.G_ @ W
+        cache = getattr(self, "_cache", None)
+        if cache is None : 
+            GW = apply_G(self.G_, W)
+        else : 
+            GW = cache.GW(self.G_, W)
         if X is None : 
             X = self.X_
 
-        assert(X.shape == (self.G_.shape[0],H.shape[1]))
+        assert(X.shape == (GW.shape[0],H.shape[1]))
 
-        self.GWH_numel_ = self.G_.shape[0] * H.shape[1]
+        self.GWH_numel_ = GW.shape[0] * H.shape[1]
         
         if self.l2:
             loss_ = 0.5*Frobenius_loss(X, GW, H, average=False) 
         else:
+            if self._chunked() and X is self.X_ : 
+                return self._chunked_KL_loss(GW, H, average)
             if self.const_KL_ is None:
-                self.const_KL_ = np.sum(X*np.log(np.maximum(self.X_, self.log_shift))) - np.sum(X) 
+                if issparse(X) : 
+                    # Only the nonzeros of X contribute to the constant
+                    self.const_KL_ = np.sum(X.data*np.log(np.maximum(X.data, self.log_shift)), dtype=np.float64) - np.sum(X.data, dtype=np.float64)
+                else : 
+                    self.const_KL_ = np.sum(X*np.log(np.maximum(self.X_, self.log_shift)), dtype=np.float64) - np.sum(X, dtype=np.float64) 
+
+            # The cached reconstruction can only be used if the clipping of the loss does not modify GW and H
+            GWH = None
+            if not(cache is None) and np.min(GW) >= self.log_shift and np.min(H) >= self.log_shift : 
+                if issparse(X) : 
+                    GWH = cache.GWH_nonzeros(self.G_, W, H, X)
+                else : 
+                    GWH = cache.GWH(self.G_, W, H)
+            buffer = cache.loss_buffer if isinstance(cache, Workspace) else None
+            loss_ =  KLdiv_loss(X, GW, H, self.log_shift, average=False, WH=GWH, buffer=buffer) + self.const_KL_
+        if average:
+            loss_ = loss_ / self.GWH_numel_
+        self.detailed_loss_ = [loss_]
+        return loss_
 
-            loss_ =  KLdiv_loss(X, GW, H, self.log_shift, average=False) + self.const_KL_
+    def _chunked_KL_loss(self, GW, H, average) : 
+        # Same as the KL loss, accumulated over the blocks of pixels
+        if self.const_KL_ is None : 
+            self.const_KL_ = 0
+            for _, Xb in self.X_.blocks() : 
+                self.const_KL_ += np.sum(Xb*np.log(np.maximum(Xb, self.log_shift)), dtype=np.float64) - np.sum(Xb, dtype=np.float64)
+        loss_ = self.const_KL_
+        for sl, Xb in self.X_.blocks() : 
+            loss_ += KLdiv_loss(Xb, GW, H[:, sl], self.log_shift, average=False)
         if average:
             loss_ = loss_ / self.GWH_numel_
         self.detailed_loss_ = [loss_]
@@ -216,7 +314,8 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         Parameters
         ----------
         X : {array-like, sparse matrix} of shape (n, p)
-            Data matrix to be decomposed
+            Data matrix to be decomposed. A sparse matrix is converted to the CSR format and is never densified:
+            the KL updates and loss only touch its nonzero entries. Sparse matrices are not supported with `l2=True`.
         y : Ignored
             Not used, present here for API consistency by convention.
         W : array-like of shape (m, k)
@@ -233,10 +332,14 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         ############################
         # Initialize the algorithm #
         ############################
-        if self.hspy_comp : 
-            self.X_ = self._validate_data(X.T, dtype=[np.float64, np.float32])
+        dtype = [np.float64, np.float32] if self.dtype is None else self.dtype
+        if not(self.chunk_size is None) : 
+            # X stays where it is and is streamed by blocks of pixels
+            self.X_ = PixelChunks(X, self.chunk_size, self.log_shift, transpose=self.hspy_comp, dtype=self.dtype)
+        elif self.hspy_comp : 
+            self.X_ = self._validate_data(X.T, dtype=dtype, accept_sparse="csr")
         else : 
-            self.X_ = self._validate_data(X, dtype=[np.float64, np.float32])
+            self.X_ = self._validate_data(X, dtype=dtype, accept_sparse="csr")
 
         if self.hspy_comp==False:
             try:
@@ -250,18 +353,33 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
             except:
                 pass
 
+        if issparse(self.X_) and self.l2 : 
+            raise ValueError("A sparse X is only supported with the KL divergence (l2=False).")
+        if self._chunked() and self.l2 : 
+            raise ValueError("The chunked mode is only supported with the KL divergence (l2=False).")
+
         # The algorithm does not work when full columns or lines of X are zero
-        self.X_ = self.remove_zeros_lines(self.X_, self.log_shift)
+        # In the chunked mode, this is done on the fly when reading the blocks
+        if not(self._chunked()) : 
+            self.X_ = self.remove_zeros_lines(self.X_, self.log_shift)
 
         self.const_KL_ = None
         if self.normalize : 
             # We normalize the data so that the strength of the regularization is somewhat the same for all datasets
             self.norm_factor_ = normalization_factor(self.X_,self.n_components)
-            self.X_ = self.norm_factor_ * self.X_
+            if self._chunked() : 
+                self.X_.scale = self.norm_factor_
+            elif issparse(self.X_) or np.may_share_memory(self.X_, X) : 
+                self.X_ = self.norm_factor_ * self.X_
+            else : 
+                # X_ is already a private copy of X (converted or filled)
+                self.X_ *= self.norm_factor_
         
         if isinstance(self.G, PhysicalModel):
             self.physics_model_ = self.G
+            # The G matrix of the estimator is updated in place during the fit, hence it is a private copy of the G matrix of the model
             G = self.physics_model_.NMF_update()
+            G = None if G is None else G.copy()
         else:
             self.physics_model_ = None
             G = self.G
@@ -275,28 +393,57 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
                                                           random_state = self.random_state,
                                                           simplex_H = self.simplex_H,
                                                           simplex_W = self.simplex_W,
-                                                          physics_model = self.physics_model_)
+                                                          physics_model = self.physics_model_,
+                                                          init_DH = self._chunked_init(G, W, H) if self._chunked() else None)
+        if not(self.dtype is None) : 
+            self.G_, self.W_, self.H_ = [self._astype(M) for M in (self.G_, self.W_, self.H_)]
         
         if not(self.shape_2d is None) :
-            self.L_ = create_laplacian_matrix(*self.shape_2d)
+            self.L_ = LaplacianOperator(*self.shape_2d, connectivity=self.laplacian_connectivity, mask=self.laplacian_mask, dtype=self.X_.dtype)
+            if self.L_.shape[0] != self.X_.shape[1] :
+                raise ValueError("The number of pixels of shape_2d (or of laplacian_mask) does not match the number of columns of X.")
+        elif getattr(self, "lambda_L", 0) == 0 :
+            # Without smoothness regularization, the Laplacian is never used
+            self.L_ = None
+        else : 
+            self.L_ = identity(self.X_.shape[1], dtype=self.X_.dtype, format="csr")
+
+        # The products GW and GWH are shared between the steps in W and H and the loss evaluations
+        if self.workspace and not(issparse(self.X_)) and not(self._chunked()) : 
+            self._cache = Workspace(*self.X_.shape, dtype=np.result_type(self.X_, self.W_, self.H_))
         else : 
-            self.L_ =lil_matrix((self.X_.shape[1],self.X_.shape[1]),dtype=np.float32)
-            self.L_.setdiag([1]*self.X_.shape[1])
+            self._cache = ReconstructionCache()
 
         algo_start = time.time()
         eval_before = np.inf
         eval_init = self.loss(self.W_, self.H_)
         self.n_iter_ = 0
 
+        if self.callback is not None and not(callable(self.callback)) :
+            raise ValueError("callback must be callable.")
+        if self.callback_every < 1 :
+            raise ValueError("callback_every must be a positive integer.")
+
+        if self.profile :
+            self.profiler_ = Profiler(track_memory=(self.profile == "memory"))
+            self._profiler = self.profiler_
+            self._profiler.start()
+        else :
+            self.profiler_ = None
+            self._profiler = None
+
         self.losses_ = []
         self.rel_ = []
         self.detailed_losses_ = []
+        truth_pool, truth_futures = None, []
         if not(self.true_D is None) and not(self.true_H is None) : 
             if (self.true_D.shape[1] == self.n_components) and (self.true_H.shape[0] == self.n_components) : 
                 self.angles_ = []
                 self.mse_ = []
                 self.true_losses_ = []
                 true_DH = self.true_D @ self.true_H
+                if self.eval_truth_background : 
+                    truth_pool = ThreadPoolExecutor(max_workers=1)
             else : 
                 print("The chosen number of components does not match the number of components of the provided truth. The ground truth will be ignored.")
         
@@ -305,15 +452,20 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         #############
         try:
             while True:
+                if self._profiler is not None and len(self._profiler.records) < self.n_iter_ :
+                    self._profiler.end_iteration()
                 # Take one step in W, H
+                iter_start = time.time()
                 old_W, old_H = self.W_.copy(), self.H_.copy()
                 
                 self.W_, self.H_ = self._iteration(self.W_, self.H_ )
-                eval_after = self.loss(self.W_, self.H_)
+                with self._phase("loss"):
+                    eval_after = self.loss(self.W_, self.H_)
                 self.n_iter_ +=1
                 
-                rel_W = np.max(np.abs((self.W_ - old_W))/(self.W_ + self.tol*np.mean(self.W_) ))
-                rel_H = np.max(np.abs((self.H_ - old_H))/(self.H_ + self.tol*np.mean(self.H_) ))
+                with self._phase("stopping_checks"):
+                    rel_W = np.max(np.abs((self.W_ - old_W))/(self.W_ + self.tol*np.mean(self.W_) ))
+                    rel_H = np.max(np.abs((self.H_ - old_H))/(self.H_ + self.tol*np.mean(self.H_) ))
 
                 # store some information for assessing the convergence
                 # for debugging purposes
@@ -326,14 +478,18 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
 
                 if not(self.true_D is None) and not(self.true_H is None) :
                     if (self.true_D.shape[1] == self.n_components) and (self.true_H.shape[0] == self.n_components) : 
-                        if self.simplex_H or self.simplex_W:
-                            W, H = self.W_, self.H_ 
-                        else:
-                            W, H = rescaled_DH(self.W_, self.H_ )
-                        GW = self.G_ @ W
-                        angles = find_min_angle(self.true_D.T,GW.T, unique=True)
-                        mse = find_min_MSE(self.true_H, H,unique=True)
-                        loss = self.loss(self.W_,H, X = true_DH )
+                        if self.n_iter_ % self.eval_truth_every != 0 : 
+                            angles, mse, loss = np.full(self.n_components, np.nan), np.full(self.n_components, np.nan), np.nan
+                        elif truth_pool is not None : 
+                            # The metrics are computed later from a snapshot of the estimator
+                            snapshot = copy.copy(self)
+                            snapshot.W_, snapshot.H_, snapshot.G_ = self.W_.copy(), self.H_.copy(), copy.deepcopy(self.G_)
+                            snapshot._cache, snapshot._profiler = None, None
+                            truth_futures.append((len(self.angles_), truth_pool.submit(snapshot._truth_metrics, true_DH)))
+                            angles, mse, loss = np.full(self.n_components, np.nan), np.full(self.n_components, np.nan), np.nan
+                        else : 
+                            with self._phase("truth_metrics"):
+                                angles, mse, loss = self._truth_metrics(true_DH)
                         self.angles_.append(angles)
                         self.mse_.append(mse)
                         self.true_losses_.append(loss)
@@ -342,6 +498,11 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
                 self.detailed_losses_.append(detailed_loss_)
                 self.rel_.append([rel_W,rel_H])
                               
+                if self.callback is not None and self.n_iter_ % self.callback_every == 0:
+                    if self.callback(self._iteration_state(eval_after, rel_W, rel_H, iter_start, algo_start)):
+                        print("exits because the callback returned True")
+                        break
+
                 # check convergence criterions
                 if self.n_iter_ >= self.max_iter:
                     print("exits because max_iteration was reached")
@@ -377,12 +538,26 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
                 # Update G might increase the loss so we reevaluate the loss to avoid artificial negative decrease
                 # We do this update every 3 iterations, but it is arbitrary.
                 if self.physics_model_ != None and self.n_iter_%3 == 0: 
-                    self.G_ = self.physics_model_.NMF_update(self.W_)
-                    eval_before = self.loss(self.W_, self.H_)
+                    with self._phase("G_update"):
+                        self.G_ = self._astype(self.physics_model_.NMF_update(self.W_, self.G_))
+                    # G may have been modified in place
+                    self._cache.invalidate()
+                    with self._phase("loss"):
+                        eval_before = self.loss(self.W_, self.H_)
                 else :
                     eval_before = eval_after
         except KeyboardInterrupt:
             pass
+        finally:
+            if truth_pool is not None :
+                for i, future in truth_futures : 
+                    self.angles_[i], self.mse_[i], self.true_losses_[i] = future.result()
+                truth_pool.shutdown()
+            if self._profiler is not None :
+                if len(self._profiler.records) < self.n_iter_ :
+                    self._profiler.end_iteration()
+                self._profiler.stop()
+            self._profiler = None
 
         ###################
         # End of the loop #
@@ -396,11 +571,13 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
             f"and {np.round(algo_time) % 60} seconds."
         )
         self.reconstruction_err_ = self.loss(self.W_, self.H_)
+        # The cache is only valid during the optimization
+        self._cache = None
 
         if self.normalize : 
             self.W_ = self.W_ / self.norm_factor_
         
-        GW = self.G_ @ self.W_
+        GW = apply_G(self.G_, self.W_)
         self.n_components_ = self.H_.shape[0]
         
         if self.hspy_comp : 
@@ -465,7 +642,7 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
         
         """
         check_is_fitted(self)
-        return self.G_ @ W @ self.H_
+        return apply_G(self.G_, W) @ self.H_
     
     def get_losses(self):
         """
@@ -507,14 +684,111 @@ class NMFEstimator(ABC, TransformerMixin, BaseEstimator):
 
         return array
 
+    def get_profile(self):
+        """
+        Return the times spent in the phases of each iteration, if the estimator was fitted with `profile` set.
+        See :meth:`espm.estimators.profiling.Profiler.to_array` for the fields of the structured array.
+        """
+        if getattr(self, "profiler_", None) is None :
+            raise ValueError("The estimator was not fitted with profile set.")
+        return self.profiler_.to_array()
+
+    def export_profile(self, filename):
+        """
+        Write the phases of the iterations to a JSON file in the Chrome trace format, if the estimator was fitted with `profile` set.
+        """
+        if getattr(self, "profiler_", None) is None :
+            raise ValueError("The estimator was not fitted with profile set.")
+        self.profiler_.export_chrome_trace(filename)
+
+    def _truth_metrics(self, true_DH) : 
+        # Angles, MSE and loss of the current estimates with respect to the ground truth
+        if self.simplex_H or self.simplex_W:
+            W, H = self.W_, self.H_ 
+        else:
+            W, H = rescaled_DH(self.W_, self.H_ )
+        cache = getattr(self, "_cache", None)
+        GW = apply_G(self.G_, W) if cache is None else cache.GW(self.G_, W)
+        angles = find_min_angle(self.true_D.T,GW.T, unique=True)
+        mse = find_min_MSE(self.true_H, H,unique=True)
+        loss = self.loss(self.W_,H, X = true_DH )
+        return angles, mse, loss
+
+    def _iteration_state(self, loss, rel_W, rel_H, iter_start, algo_start) : 
+        now = time.time()
+        timings = {"iteration" : now - iter_start, "total" : now - algo_start}
+        if self._profiler is not None :
+            timings.update(self._profiler.current())
+        W, H = self.W_.view(), self.H_.view()
+        W.flags.writeable = False
+        H.flags.writeable = False
+        return IterationState(self.n_iter_, loss, rel_W, rel_H, timings, W, H)
+
+    def _phase(self, name) : 
+        # Records the phase if profiling is enabled
+        profiler = getattr(self, "_profiler", None)
+        return nullcontext() if profiler is None else profiler.phase(name)
+
+    def _chunked(self) : 
+        return isinstance(getattr(self, "X_", None), PixelChunks)
+
+    def _chunked_init(self, G, W, H) : 
+        # Initial estimates of GW and H for initialize_algorithms, computed by streaming the blocks of X
+        if W is None and H is None : 
+            if not(self.init in [None, "random"]) : 
+                raise ValueError("Only the random initialization is supported in the chunked mode.")
+            # Same as the random initialization of scikit-learn
+            avg = np.sqrt(self.X_.mean() / self.n_components)
+            rng = check_random_state(self.random_state)
+            H = np.abs(avg * rng.standard_normal(size=(self.n_components, self.X_.shape[1])).astype(self.X_.dtype, copy=False))
+            D = np.abs(avg * rng.standard_normal(size=(self.X_.shape[0], self.n_components)).astype(self.X_.dtype, copy=False))
+            return D, H
+        elif W is None : 
+            pinvH = np.linalg.pinv(H)
+            D = sum(Xb @ pinvH[sl] for sl, Xb in self.X_.blocks())
+            return np.abs(D), H
+        elif H is None : 
+            pinvD = np.linalg.pinv(apply_G(G, W))
+            H = np.empty((W.shape[1], self.X_.shape[1]), dtype=np.result_type(pinvD, self.X_.dtype))
+            for sl, Xb in self.X_.blocks() : 
+                H[:, sl] = np.abs(pinvD @ Xb)
+            return None, H
+        return None
+
+    def _astype(self, M) : 
+        # Convert a matrix to the precision of the optimization (G may be None)
+        if M is None or self.dtype is None : 
+            return M
+        return M.astype(self.dtype, copy=False)
+
     def remove_zeros_lines (self, X, epsilon) : 
+        if issparse(X) : 
+            return self._remove_zeros_lines_sparse(X, epsilon)
         if np.all(X >= 0) : 
+            zero_cols = np.where(X.sum(axis = 0) == 0)[0]
+            zero_rows = np.where(X.sum(axis = 1) == 0)[0]
+            if len(zero_cols) == 0 and len(zero_rows) == 0 : 
+                # X is never modified by the algorithms, hence it is only copied when it has to be filled
+                return X
             new_X = X.copy()
-            sum_cols = X.sum(axis = 0)
-            sum_rows = X.sum(axis = 1)
-            new_X[:,np.where(sum_cols == 0)] = epsilon
-            new_X[np.where(sum_rows == 0),:] = epsilon
+            new_X[:,zero_cols] = epsilon
+            new_X[zero_rows,:] = epsilon
             return new_X
         else : 
             raise ValueError("There are negative values in X")
 
+    def _remove_zeros_lines_sparse (self, X, epsilon) : 
+        # Same as remove_zeros_lines for a CSR matrix. Only the empty lines and columns are filled.
+        if np.any(X.data < 0) : 
+            raise ValueError("There are negative values in X")
+        new_X = csr_matrix(X, copy=True)
+        new_X.sum_duplicates()
+        zero_cols = np.where(np.asarray(new_X.sum(axis = 0)).ravel() == 0)[0]
+        zero_rows = np.where(np.asarray(new_X.sum(axis = 1)).ravel() == 0)[0]
+        if len(zero_cols) or len(zero_rows) : 
+            new_X = new_X.tolil()
+            new_X[:,zero_cols] = epsilon
+            new_X[zero_rows,:] = epsilon
+            new_X = new_X.tocsr()
+        return new_X
+
@@ -0,0 +1,111 @@
+r"""
+Chunked data
+------------
+
+The :mod:`espm.estimators.chunks` module implements the access by blocks of pixels to a data matrix that is not loaded in memory.
+It is used by the estimators when the parameter `chunk_size` is set.
+
+"""
+
+import numpy as np
+
+
+class PixelChunks:
+    r"""Access by blocks of pixels (i.e. columns) to a data matrix :math:`X` of shape (n, p) that stays on disk.
+
+    :math:`X` can be any 2D array-like supporting slicing, for example a np.memmap, a h5py dataset or a zarr array.
+    The blocks are read and converted to dense np.arrays only when they are needed.
+
+    As done by :meth:`espm.estimators.NMFEstimator.remove_zeros_lines`, the empty lines and columns of :math:`X` are replaced by `epsilon`.
+    The blocks are also multiplied by the attribute `scale` (used for the normalization of the estimators).
+    Both operations are applied on the fly, so that :math:`X` is never modified.
+
+    :param X: data array-like of shape (n, p), or (p, n) if `transpose` is True
+    :param int chunk_size: number of pixels per block
+    :param float epsilon: value replacing the empty lines and columns
+    :param bool transpose: if True, X is stored with the pixels as the first dimension (hyperspy layout)
+    :param dtype: dtype of the blocks (default: dtype of X, or np.float64 for integer data)
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from espm.estimators.chunks import PixelChunks
+    >>> X = np.random.rand(10, 25)
+    >>> chunks = PixelChunks(X, chunk_size=10, epsilon=1e-10)
+    >>> [Xb.shape for _, Xb in chunks.blocks()]
+    [(10, 10), (10, 10), (10, 5)]
+    """
+    def __init__(self, X, chunk_size, epsilon, transpose=False, dtype=None):
+        if len(X.shape) != 2:
+            raise ValueError("X should be a 2D array.")
+        if chunk_size < 1:
+            raise ValueError("chunk_size should be a positive integer.")
+        self.data = X
+        self.chunk_size = int(chunk_size)
+        self.epsilon = epsilon
+        self.transpose = transpose
+        self.shape = tuple(X.shape[::-1]) if transpose else tuple(X.shape)
+        if dtype is None:
+            dtype = X.dtype if np.issubdtype(X.dtype, np.floating) else np.float64
+        self.dtype = np.dtype(dtype)
+        self.ndim = 2
+        self.scale = 1
+        self._compute_statistics()
+
+    def _read(self, sl):
+        # Copy of the raw block, so that the data on disk is never modified
+        if self.transpose:
+            return np.array(self.data[sl, :], dtype=self.dtype).T
+        return np.array(self.data[:, sl], dtype=self.dtype)
+
+    def _compute_statistics(self):
+        # A first pass over the data to find the empty lines and columns
+        n, p = self.shape
+        row_sums = np.zeros(n, dtype=np.float64)
+        col_sums = np.zeros(p, dtype=np.float64)
+        for sl in self.slices():
+            Xb = self._read(sl)
+            if np.any(Xb < 0):
+                raise ValueError("There are negative values in X")
+            row_sums += np.sum(Xb, axis=1, dtype=np.float64)
+            col_sums[sl] = np.sum(Xb, axis=0, dtype=np.float64)
+        self.zero_rows = np.where(row_sums == 0)[0]
+        self.zero_cols = np.where(col_sums == 0)[0]
+        self.zero_cols_mask = col_sums == 0
+        # Sums of the lines of X once the empty lines and columns are filled
+        self._row_sums = row_sums + self.epsilon * len(self.zero_cols)
+        self._row_sums[self.zero_rows] = self.epsilon * p
+        self._total = np.sum(self._row_sums)
+
+    def slices(self):
+        r"""Iterate over the slices of pixels of the blocks."""
+        for start in range(0, self.shape[1], self.chunk_size):
+            yield slice(start, min(start + self.chunk_size, self.shape[1]))
+
+    def block(self, sl):
+        r"""Return the block of pixels `sl` as a np.array of shape (n, len(sl))."""
+        Xb = self._read(sl)
+        Xb[:, self.zero_cols_mask[sl]] = self.epsilon
+        Xb[self.zero_rows, :] = self.epsilon
+        if not(self.scale == 1):
+            Xb *= self.scale
+        return Xb
+
+    def blocks(self):
+        r"""Iterate over the blocks of pixels. Yield the slice of pixels and the corresponding block."""
+        for sl in self.slices():
+            yield sl, self.block(sl)
+
+    def sum(self, axis=None):
+        r"""Sum of X. The dimensions are kept when `axis` is not None."""
+        if axis is None:
+            return self.scale * self._total
+        elif axis == 1:
+            return self.scale * self._row_sums[:, np.newaxis]
+        return np.concatenate([np.sum(Xb, axis=0, keepdims=True) for _, Xb in self.blocks()], axis=1)
+
+    def mean(self, axis=None, dtype=None, out=None):
+        r"""Mean of all the entries of X."""
+        if not(axis is None):
+            raise NotImplementedError("Only the mean of all the entries is implemented.")
+        return self.sum() / (self.shape[0] * self.shape[1])
@@ -1,5 +1,6 @@
 import numpy as np
 from espm.conf import dicotomy_tol, log_shift, maxit_dichotomy
+from espm.estimators.profiling import get_active_profiler
 
 def dichotomy_simplex(num, denum, log_shift=log_shift, tol=dicotomy_tol, maxit=maxit_dichotomy):
     """
@@ -9,14 +10,16 @@ def dichotomy_simplex(num, denum, log_shift=log_shift, tol=dicotomy_tol, maxit=m
     """
     # The function has exactly one root at the right of the first singularity (the singularity at min(denum))
     
-    # num = num.astype("float64")
-    # denum = denum.astype("float64")
-
     # do some test
 
     assert((num>=0).all())
     assert((denum>=0).all())
     assert((np.sum(num, axis=0)>0).all())
+
+    # The multiplier is computed in float64, even for float32 inputs
+    dtype = np.result_type(num, denum, np.float32)
+    num = num.astype(np.float64, copy=False)
+    denum = denum.astype(np.float64, copy=False)
     if log_shift>0:
         # Check that a solution is possible
         if denum.shape[0] * log_shift >= 1:
@@ -24,25 +27,10 @@ def dichotomy_simplex(num, denum, log_shift=log_shift, tol=dicotomy_tol, maxit=m
         denum_max = num/log_shift
     else:
         denum_max = np.inf
-    # Ideally we want to do this, but we have to exclude the case where num==0.
-    # a = np.max(num/2 - denum, axis=0)
-    if denum.shape[1]>1:
-        a = []
-        for n,d in zip(num.T, denum.T):
-            m = n>0
-            # The divided by 2 is just a factor to help a bit.
-            a.append(np.max(n[m]/2 - d[m]))
-        a = np.array(a)
-    else: 
-        # This else is just to preserve the size and make it work in any case...
-        # There might be a possiblity to write this more elegantly
-        d = denum[:,0]
-        def max_masked(n):
-            m = n>0
-            return np.max(n[m]/2-d[m])
-        a = np.apply_along_axis(max_masked, 0, num)
-        
-        
+    # a = np.max(num/2 - denum, axis=0), excluding the entries where num==0.
+    # The divided by 2 is just a factor to help a bit.
+    a = np.max(np.where(num>0, num/2 - denum, -np.inf), axis=0)
+
     # r = np.sum(num/denum, axis=0)
     # b = np.zeros(r.shape)
     # b[r>=1] = (len(num) * np.max(num, axis=0)/0.5 - np.min(denum, axis=0))[r>=1]
@@ -50,9 +38,12 @@ def dichotomy_simplex(num, denum, log_shift=log_shift, tol=dicotomy_tol, maxit=m
 
     def func(x):
         new_x = x + denum
-        return np.sum(np.maximum(num / new_x, log_shift), axis=0) - 1
+        ratio = num / new_x
+        active = ratio > log_shift
+        return np.sum(np.where(active, ratio, log_shift), axis=0) - 1, - np.sum(np.where(active, ratio / new_x, 0), axis=0)
 
-    return dicotomy(a, b, func, maxit, tol)
+    # func is convex and decreasing: the Newton iterates started from a stay at the left of the root
+    return safeguarded_newton(a, b, func, maxit, tol, x0=a).astype(dtype, copy=False)
 
 def dichotomy_simplex_acc(a, b, minus_c, log_shift=log_shift, tol=dicotomy_tol, maxit=maxit_dichotomy):
     """
@@ -71,14 +62,23 @@ def dichotomy_simplex_acc(a, b, minus_c, log_shift=log_shift, tol=dicotomy_tol,
         if b.shape[0] * log_shift >= 1:
             raise ValueError("No solution exists!")
 
+    dtype = np.result_type(b, minus_c, np.float32)
+    b = b.astype(np.float64, copy=False)
+    minus_c = minus_c.astype(np.float64, copy=False)
+
     n_p = len(b) 
     nu_max = n_p * np.max(b**2/a+2*a+2*(b+ minus_c), axis=0) * 1.5 + 1e-3
     nu_min = - (2 * a + np.sum(b, axis=0))/ n_p  * 1.1 - 1e-3
     
     def func(x):
-        return   2*a - np.sum( np.maximum(np.sqrt( (b + x)**2 + 4*a*minus_c) - x - b, log_shift*2*a), axis=0)
+        sq = np.sqrt( (b + x)**2 + 4*a*minus_c)
+        active = sq - x - b > log_shift*2*a
+        with np.errstate(divide="ignore", invalid="ignore"):
+            d = 1 - (b + x) / sq
+        return   2*a - np.sum( np.where(active, sq - x - b, log_shift*2*a), axis=0), np.sum(np.where(active, d, 0), axis=0)
 
-    return dicotomy(nu_max, nu_min, func, maxit, tol)
+    # func is concave and increasing: the Newton iterates started from nu_min stay at the left of the root
+    return safeguarded_newton(nu_max, nu_min, func, maxit, tol, x0=nu_min).astype(dtype, copy=False)
 
 def dichotomy_simplex_projected_gradient(a, log_shift=log_shift, tol=dicotomy_tol, maxit=maxit_dichotomy):
     r"""
@@ -97,6 +97,8 @@ def dichotomy_simplex_projected_gradient(a, log_shift=log_shift, tol=dicotomy_to
         if a.shape[0] * log_shift >= 1:
             raise ValueError("No solution exists!")
 
+    dtype = np.result_type(a, np.float32)
+    a = a.astype(np.float64, copy=False)
 
     nu_min = -np.max(a, axis=0)
     nu_max = 1/a.shape[0] - np.min(a, axis=0)
@@ -105,8 +107,46 @@ def dichotomy_simplex_projected_gradient(a, log_shift=log_shift, tol=dicotomy_to
         return   np.sum( np.maximum(a + x, log_shift), axis=0) -1
 
 
-    return dicotomy(nu_max, nu_min, func, maxit, tol)     
+    return dicotomy(nu_max, nu_min, func, maxit, tol).astype(dtype, copy=False)
+
+
+def simplex_projected_gradient(a, log_shift=log_shift):
+    r"""
+    Exact solution of the equation solved by :func:`dichotomy_simplex_projected_gradient`:
+
+    .. :math::
+
+        f(\nu) = \sum_p \max \left( \alpha_p+\nu, \epsilon \right) - 1 = 0
+
+    i.e. the multiplier of the Euclidean projection of the columns of `a` onto the simplex shifted by :math:`\epsilon`.
+    With :math:`y = \alpha - \epsilon`, the problem is the projection of :math:`y` onto the simplex of radius :math:`1 - k \epsilon`,
+    which is solved by sorting each column. The cost is a single sort of `a` instead of the passes of the dichotomy.
+
+    >>> import numpy as np
+    >>> a = np.array([[0.5, 2.0], [0.2, -1.0], [0.1, 0.0]])
+    >>> nu = simplex_projected_gradient(a, log_shift=0)
+    >>> np.sum(np.maximum(a + nu, 0), axis=0)
+    array([1., 1.])
+    """
+
+    k = a.shape[0]
+    if log_shift>0:
+        # Check that a solution is possible
+        if k * log_shift >= 1:
+            raise ValueError("No solution exists!")
+
+    dtype = np.result_type(a, np.float32)
+    y = a.astype(np.float64, copy=False) - log_shift
+    radius = 1 - k * log_shift
 
+    # Columns sorted in decreasing order
+    u = -np.sort(-y, axis=0)
+    cumsum = np.cumsum(u, axis=0) - radius
+    j = np.arange(1, k + 1).reshape((k,) + (1,) * (y.ndim - 1))
+    # Number of entries above the threshold. The first entry is always above it.
+    rho = np.sum(u * j > cumsum, axis=0)
+    theta = np.take_along_axis(cumsum, np.expand_dims(rho - 1, axis=0), axis=0)[0] / rho
+    return (-theta).astype(dtype, copy=False)
 
 def dicotomy(a, b, func, maxit, tol):
     """
@@ -135,6 +175,9 @@ def dicotomy(a, b, func, maxit, tol):
     This algorithm works for number or numpy array of any size.
     """
 
+    profiler = get_active_profiler()
+    if profiler is not None:
+        clock = profiler.clock()
     func_max = func(a)
     func_min = func(b)
 
@@ -149,11 +192,11 @@ def dicotomy(a, b, func, maxit, tol):
     func_new = func(new)
     # print("A : {}, B: {}, new : {}, fA : {}, fB : {}, fnew : {}".format(np.min(np.abs(a)),np.min(np.abs(b)),np.min(np.abs(new)),np.min(np.abs(func(a))),np.min(np.abs(func(b))),np.min(np.abs(func(new)))))
     # print("A : {}, B: {}, new : {}, fA : {}, fB : {}, fnew : {}".format(np.max(a),np.max(b),np.max(new),np.max(func(a)),np.max(func(b)),np.max(func(new))))
+    # func(a) is kept up to date instead of being evaluated again at each iteration
+    func_a = func_max
     while np.max(np.abs(func_new)) > tol:
         
         it=it+1
-        func_a = func(a)
-        # func_b = func(b)
 
         # if f(a)*f(new) <0 then f(new) < 0 --> store in b
         minus_bool = func_a * func_new <= 0
@@ -164,10 +207,87 @@ def dicotomy(a, b, func, maxit, tol):
 
         b[minus_bool] = new[minus_bool]
         a[plus_bool] = new[plus_bool]
+        func_a[plus_bool] = func_new[plus_bool]
         new = (a + b) / 2
         func_new = func(new)
         if it>=maxit:
             print("Dicotomy stopped for maximum number of iterations with an error of : {}".format(np.max(np.abs(func_new))))
             break
-        
+
+    if profiler is not None:
+        profiler.add("dichotomy", *clock, iterations=it)
+    return new
+
+def safeguarded_newton(a, b, func, maxit, tol, x0=None):
+    """
+    Safeguarded Newton algorithm searching for func(x)=0, for a monotone function. It is applied independently to each entry
+    of x, with the same stopping criterion as :func:`dicotomy`.
+
+    Each entry keeps a bracket [a, b] with func(a) > 0 and func(b) < 0, which is updated with the new iterate. The Newton step
+    is taken when it falls inside the bracket, otherwise a bisection step is taken. The bracketing guarantees of the
+    dichotomy are kept, but the convergence is quadratic close to the root.
+
+    Parameters
+    ----------
+
+    a : float or numpy array
+        Bound of the interval such that func(a) > 0
+    b : float or numpy array
+        Bound of the interval such that func(b) < 0
+    func : function
+        Function to solve, returning the value of the function and of its derivative
+    maxit : int
+        Maximum number of iterations - the algorithm stops if |func(sol)| < tol
+    tol : float
+        Tolerance - the algorithm stops if |func(sol)| < tol
+    x0 : float or numpy array
+        Starting point (default: middle of the interval)
+
+    Returns
+    -------
+    new : float or numpy array
+        Solution of the equation func(new) = 0
+
+    >>> import numpy as np
+    >>> x = safeguarded_newton(np.array([0.0, 0.0]), np.array([2.0, 3.0]), lambda x: ([2.0, 3.0] - x**2, -2*x), 50, 1e-12)
+    >>> np.allclose(x**2, [2, 3])
+    True
+    """
+
+    profiler = get_active_profiler()
+    if profiler is not None:
+        clock = profiler.clock()
+    func_max, _ = func(a)
+    func_min, _ = func(b)
+
+    assert(np.sum(func_min>=0)==0)
+    assert(np.sum(func_max<=0)==0)
+    assert(np.sum(np.isnan(func_max))==0)
+    assert(np.sum(np.isnan(func_min))==0)
+
+    it = 0
+    new = (a + b)/2 if x0 is None else x0
+    func_new, dfunc_new = func(new)
+    while np.max(np.abs(func_new)) > tol:
+
+        it=it+1
+
+        # Update of the brackets
+        plus_bool = func_new > 0
+        a = np.where(plus_bool, new, a)
+        b = np.where(plus_bool, b, new)
+
+        # Newton step, replaced by a bisection step if it leaves the bracket (or if the derivative is 0).
+        # Close to the root, the Newton step can be below the resolution of x: the iterate then stays on the bracket.
+        with np.errstate(divide="ignore", invalid="ignore"):
+            newton = new - func_new / dfunc_new
+        inside = (newton - a) * (newton - b) <= 0
+        new = np.where(inside, newton, (a + b) / 2)
+        func_new, dfunc_new = func(new)
+        if it>=maxit:
+            print("Newton stopped for maximum number of iterations with an error of : {}".format(np.max(np.abs(func_new))))
+            break
+
+    if profiler is not None:
+        profiler.add("dichotomy", *clock, iterations=it)
     return new
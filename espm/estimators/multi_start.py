@@ -0,0 +1,214 @@
+r"""
+Multi-start fitting
+-------------------
+
+The :mod:`espm.estimators.multi_start` module implements the fitting of an NMF estimator from several random initializations,
+keeping the best fit.
+
+"""
+
+import mmap
+import numpy as np
+from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from joblib import effective_n_jobs
+from sklearn.base import BaseEstimator
+from sklearn.utils import check_random_state
+from scipy.sparse import issparse
+
+from espm.estimators.updates import apply_G
+from espm.measures import find_min_angle
+
+
+def _fit_one(estimator, X, random_state, source=None):
+    # Fit a copy of the estimator. When X is in shared memory or in a file, the worker only maps it:
+    # source is ("shm", name, shape, dtype) or ("memmap", filename, offset, shape, dtype, order).
+    shm = None
+    if source is not None and source[0] == "shm":
+        shm = shared_memory.SharedMemory(name=source[1])
+        X = np.ndarray(source[2], dtype=source[3], buffer=shm.buf)
+    elif source is not None:
+        X = np.memmap(source[1], mode="r", offset=source[2], shape=source[3], dtype=source[4], order=source[5])
+    estimator.random_state = random_state
+    try:
+        out = estimator.fit_transform(X)
+    finally:
+        # X_ is not returned with the fitted estimator, as it is X itself or a copy of it
+        estimator.__dict__.pop("X_", None)
+        estimator.__dict__.pop("_cache", None)
+        del X
+        if shm is not None:
+            shm.close()
+    return estimator, out
+
+
+def _is_file_map(X):
+    # A np.memmap of a whole file, whose data is in the file (i.e. not a view and not opened with mode="c")
+    return isinstance(X, np.memmap) and isinstance(X.base, mmap.mmap) and X.filename is not None and X.mode != "c"
+
+def _fit_dtype(estimator, X):
+    # dtype of X during the fit (see the validation of X in NMFEstimator.fit_transform)
+    if estimator.dtype is not None:
+        return np.dtype(estimator.dtype)
+    return X.dtype if X.dtype in (np.float64, np.float32) else np.dtype(np.float64)
+
+
+class MultiStartNMF(BaseEstimator):
+    r"""Fit an NMF estimator from several random initializations and keep the best fit.
+
+    The estimator is copied `n_init` times with different values of `random_state`, and the copy with the lowest
+    `reconstruction_err_` is kept. If the `init` of the estimator is None, the copies use `init="random"` so that they do
+    not all start from the same (deterministic) initialization.
+
+    With `n_jobs` > 1, the runs are executed in a pool of processes. A dense X is then copied once into shared memory, in
+    the dtype of the estimator and with its empty lines and columns filled, and mapped by the workers instead of being pickled
+    for each run. A np.memmap of a whole file is reopened by the workers, and a sparse X is pickled for each run.
+    The workers do not copy a mapped X, unless the estimator normalizes the data (`normalize=True`), or a memory map has to be
+    converted or has empty lines or columns. The peak memory is then about `n_jobs` copies of X.
+
+    Besides the best fit, the spread of the losses (`reconstruction_errs_`) and the agreement of the components of each run
+    with the ones of the best run (`angles_`, computed with :func:`espm.measures.find_min_angle`) are reported.
+    The attribute `X_` of the fitted estimators is not kept.
+
+    Parameters
+    ----------
+    estimator : NMFEstimator
+        The estimator to fit, e.g. a :class:`espm.estimators.SmoothNMF`.
+    n_init : int, default=4
+        Number of runs.
+    n_jobs : int, default=None
+        Number of processes. None means 1 (the runs are executed sequentially) and -1 means using all the processors.
+    random_state : int, RandomState instance or None, default=None
+        Seed of the random states of the runs.
+    verbose : int, default=1
+        If > 0, print a summary of the runs.
+
+    Attributes
+    ----------
+    best_estimator_ : NMFEstimator
+        The fitted estimator with the lowest loss.
+    best_index_ : int
+        Index of the best run.
+    estimators_ : list of NMFEstimator
+        The fitted estimators of all the runs.
+    random_states_ : np.array of shape (n_init,)
+        The random states of the runs.
+    reconstruction_errs_ : np.array of shape (n_init,)
+        The final losses of the runs.
+    angles_ : np.array of shape (n_init, n_components)
+        Angles in degrees between the components (columns of GW) of each run and the ones of the best run.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from espm.estimators import SmoothNMF, MultiStartNMF
+    >>> X = np.random.rand(30, 50)
+    >>> multi = MultiStartNMF(SmoothNMF(n_components=2, max_iter=5, verbose=0), n_init=3, random_state=0, verbose=0)
+    >>> multi = multi.fit(X)
+    >>> multi.angles_.shape
+    (3, 2)
+    """
+
+    def __init__(self, estimator, n_init=4, n_jobs=None, random_state=None, verbose=1):
+        self.estimator = estimator
+        self.n_init = n_init
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.verbose = verbose
+
+    def fit_transform(self, X, y=None):
+        """Fit the `n_init` runs and returns the data transformed by the best one.
+
+        Parameters
+        ----------
+        X : array-like, shape (n, p)
+            Data matrix to be decomposed
+        y : Ignored
+            Not used, present here for API consistency by convention.
+
+        Returns
+        -------
+        GW : ndarrays
+            Transformed data of the best run (see the `fit_transform` method of the estimator).
+        """
+        assert self.n_init >= 1, "n_init must be a positive integer"
+        rng = check_random_state(self.random_state)
+        self.random_states_ = rng.randint(np.iinfo(np.int32).max, size=self.n_init)
+
+        estimator = deepcopy(self.estimator)
+        if estimator.init is None:
+            estimator.init = "random"
+
+        n_workers = min(effective_n_jobs(self.n_jobs), self.n_init)
+        if n_workers == 1:
+            results = [_fit_one(deepcopy(estimator), X, random_state) for random_state in self.random_states_]
+        elif _is_file_map(X):
+            # Pickling a np.memmap would copy its data into every task, hence the workers open the file again
+            if X.mode != "r":
+                X.flush()
+            order = "F" if X.flags.f_contiguous and not(X.flags.c_contiguous) else "C"
+            source = ("memmap", X.filename, X.offset, X.shape, X.dtype, order)
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                futures = [pool.submit(_fit_one, estimator, None, random_state, source) for random_state in self.random_states_]
+                results = [future.result() for future in futures]
+        elif not(issparse(X)):
+            X = np.asarray(X)
+            dtype = _fit_dtype(estimator, X)
+            shm = shared_memory.SharedMemory(create=True, size=max(X.size * dtype.itemsize, 1))
+            try:
+                X_shared = np.ndarray(X.shape, dtype=dtype, buffer=shm.buf)
+                X_shared[:] = X
+                # The empty lines and columns are filled here once, so that the workers do not copy X to fill them
+                X_filled = estimator.remove_zeros_lines(X_shared, estimator.log_shift)
+                if not(X_filled is X_shared):
+                    X_shared[:] = X_filled
+                del X_shared, X_filled
+                source = ("shm", shm.name, X.shape, dtype)
+                with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                    futures = [pool.submit(_fit_one, estimator, None, random_state, source) for random_state in self.random_states_]
+                    results = [future.result() for future in futures]
+            finally:
+                shm.close()
+                shm.unlink()
+        else:
+            # Sparse matrices are pickled for each run
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                futures = [pool.submit(_fit_one, estimator, X, random_state) for random_state in self.random_states_]
+                results = [future.result() for future in futures]
+
+        self.estimators_ = [est for est, _ in results]
+        self.reconstruction_errs_ = np.array([est.reconstruction_err_ for est in self.estimators_], dtype=np.float64)
+        self.best_index_ = int(np.nanargmin(self.reconstruction_errs_))
+        self.best_estimator_ = self.estimators_[self.best_index_]
+
+        best_components = self._components(self.best_estimator_)
+        self.angles_ = np.array([find_min_angle(best_components, self._components(est), unique=True) for est in self.estimators_])
+
+        if self.verbose > 0:
+            print(f"Best run {self.best_index_} / {self.n_init}: loss {self.reconstruction_errs_[self.best_index_]:3e}, "
+                  f"losses in [{np.nanmin(self.reconstruction_errs_):3e}, {np.nanmax(self.reconstruction_errs_):3e}], "
+                  f"max angle to the best components {np.max(self.angles_):0.2f} degrees")
+        return results[self.best_index_][1]
+
+    def fit(self, X, y=None):
+        """Fit the `n_init` runs and keep the best one.
+
+        Parameters
+        ----------
+        X : array-like, shape (n, p)
+            Data matrix to be decomposed
+        y : Ignored
+            Not used, present here for API consistency by convention.
+
+        Returns
+        -------
+        self
+            The fitted multi-start estimator.
+        """
+        self.fit_transform(X, y=y)
+        return self
+
+    def _components(self, estimator):
+        # Spectra of the components (GW) as the lines of a matrix
+        return apply_G(estimator.G_, estimator.W_).T
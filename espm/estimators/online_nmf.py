@@ -0,0 +1,242 @@
+r"""
+Online SmoothNMF
+----------------
+
+The :mod:`espm.estimators.online_nmf` module implements a mini-batch variant of :class:`espm.estimators.SmoothNMF`
+for the datasets with a large number of pixels.
+
+"""
+
+import numpy as np
+from sklearn.utils import check_array, check_random_state
+
+from espm.estimators import SmoothNMF
+from espm.estimators.updates import multiplicative_step_h, initialize_algorithms, get_KL_ratio, has_nan, apply_Gt, G_column_sums, simplex_denum_w
+from espm.conf import dicotomy_tol, sigmaL
+from espm.models import PhysicalModel
+
+
+class OnlineSmoothNMF(SmoothNMF):
+    r"""OnlineSmoothNMF - mini-batch version of SmoothNMF
+
+    The class `OnlineSmoothNMF` solves the same problem as :class:`espm.estimators.SmoothNMF` without the Laplacian regularization, i.e.:
+
+    .. math::
+
+        \dot{W}, \dot{H} = \arg \min_{W \geq \epsilon, H \geq \epsilon} D_{GKL}(X || GWH) + \mu  \sum_{ij} \log(H_{ij} + \epsilon_{reg})
+
+    The pixels (columns of `X`) are processed by mini-batches. For each mini-batch `X_b`, the corresponding maps `H_b` are first
+    estimated with `W` fixed. The numerator and the denominator of the multiplicative step in `W` are then accumulated
+    in running sufficient statistics `A` and `B`:
+
+    .. math::
+
+        A \leftarrow \rho A + W \odot G^\top \frac{X_b}{GWH_b} H_b^\top, \qquad
+        B \leftarrow \rho B + G^\top \mathbf{1} \mathbf{1}^\top H_b^\top
+
+    and `W` is set to :math:`A / B` (with the simplex constraint if `simplex_W` is True). The forget factor :math:`\rho` discards
+    the statistics computed with the old values of `W`.
+
+    With `fit`, one iteration is a pass over all the pixels (an epoch), the maps `H` of the pixels being kept between the epochs.
+    A comparable loss to the one of :class:`espm.estimators.SmoothNMF` is usually obtained after one or two epochs.
+    With `partial_fit`, the model is updated with a single mini-batch, so that the data does not need to be available at once.
+
+    Only the algorithm "log_surrogate" is supported and `lambda_L` must be 0.
+    The physics model `G` (:class:`espm.models.PhysicalModel`) is updated every 3 mini-batches.
+
+    Parameters
+    ----------
+    batch_size : int, default=256
+        Number of pixels per mini-batch. In the chunked mode (`chunk_size` is set), the mini-batches are the blocks of pixels.
+    forget_factor : float, default=0.7
+        Forget factor :math:`\rho` of the sufficient statistics, between 0 and 1.
+    n_inner_iter : int, default=5
+        Number of steps in `H_b` for each mini-batch.
+    shuffle : bool, default=True
+        If True, the order of the pixels is shuffled at each epoch.
+    **kwargs : dict
+        Additional parameters for the `SmoothNMF` class.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from espm.estimators import OnlineSmoothNMF
+    >>> X = np.random.rand(30, 5000)
+    >>> estimator = OnlineSmoothNMF(n_components=3, batch_size=1000, random_state=0)
+    >>> for start in range(0, 5000, 1000):
+    ...     estimator = estimator.partial_fit(X[:, start:start + 1000])
+    >>> estimator.W_.shape
+    (30, 3)
+    """
+
+    def __init__(self, batch_size=256, forget_factor=0.7, n_inner_iter=5, shuffle=True, lambda_L=0.0, linesearch=False, mu=0, epsilon_reg=1, algo="log_surrogate", dicotomy_tol=dicotomy_tol, gamma=None, **kwargs):
+
+        self.batch_size = batch_size
+        self.forget_factor = forget_factor
+        self.n_inner_iter = n_inner_iter
+        self.shuffle = shuffle
+        super().__init__(lambda_L=lambda_L, linesearch=linesearch, mu=mu, epsilon_reg=epsilon_reg, algo=algo, dicotomy_tol=dicotomy_tol, gamma=gamma, **kwargs)
+
+    def check_params(self) :
+        super().check_params()
+        assert self.algo == "log_surrogate", "Only the algorithm 'log_surrogate' is supported"
+        assert self.lambda_L == 0, "The Laplacian regularization is not supported (lambda_L must be 0)"
+        assert not self.l2, "Only the KL divergence is supported (l2 must be False)"
+        assert not self.linesearch, "The linesearch is not supported"
+        assert self.batch_size >= 1, "The batch size must be a positive integer"
+        assert 0 < self.forget_factor <= 1, "The forget factor must be in ]0, 1]"
+        assert self.n_inner_iter >= 1, "The number of inner iterations must be a positive integer"
+
+    def fit_transform(self, X, y=None, W=None, H=None):
+        """Fit the model to the data X by passes over mini-batches of pixels and returns the transformed data.
+
+        Parameters
+        ----------
+        X : array-like, shape (n, p)
+            Data matrix to be decomposed
+        y : Ignored
+            Not used, present here for API consistency by convention.
+        W : array-like, shape (m, k)
+            If init='custom', it is used as initial guess for the solution.
+        H : array-like, shape (k, p)
+            If init='custom', it is used as initial guess for the solution.
+
+        Returns
+        -------
+        GW : ndarrays
+            Transformed data.
+        """
+        self._reset_statistics()
+        return super().fit_transform(X, y=y, W=W, H=H)
+
+    def partial_fit(self, X, y=None):
+        """Update the model with a single mini-batch of pixels.
+
+        At the first call, `G` and `W` are initialized from the mini-batch.
+        After `fit`, the model is updated starting from the fitted `W`.
+
+        Parameters
+        ----------
+        X : array-like, shape (n, b)
+            Mini-batch of pixels, or shape (b, n) if `hspy_comp` is True.
+        y : Ignored
+            Not used, present here for API consistency by convention.
+
+        Returns
+        -------
+        self : OnlineSmoothNMF
+            The updated estimator. The maps of the mini-batch are stored in the attribute `H_batch_`.
+        """
+        if self.normalize :
+            raise ValueError("normalize=True is not supported by partial_fit.")
+        dtype = [np.float64, np.float32] if self.dtype is None else self.dtype
+        Xb = check_array(X.T if self.hspy_comp else X, dtype=dtype)
+        Xb = self.remove_zeros_lines(Xb, self.log_shift)
+
+        if not(hasattr(self, "n_batches_")) :
+            # First call: the model is initialized with the mini-batch
+            self._reset_statistics()
+            if isinstance(self.G, PhysicalModel):
+                self.physics_model_ = self.G
+                # As in NMFEstimator.fit_transform, the G matrix of the estimator is a private copy, updated in place
+                G = self.physics_model_.NMF_update()
+                G = None if G is None else G.copy()
+            else:
+                self.physics_model_ = None
+                G = self.G
+            self.G_, self.W_, Hb = initialize_algorithms(X = Xb,
+                                                         G = G,
+                                                         W = None,
+                                                         H = None,
+                                                         n_components = self.n_components,
+                                                         init = self.init,
+                                                         random_state = self.random_state,
+                                                         simplex_H = self.simplex_H,
+                                                         simplex_W = self.simplex_W,
+                                                         physics_model = self.physics_model_)
+            self.G_, self.W_, Hb = [self._astype(M) for M in (self.G_, self.W_, Hb)]
+            self.gamma_ = sigmaL
+            self.n_components_ = self.W_.shape[1]
+        else :
+            Hb = self._initialize_batch(Xb, self.W_)
+
+        self.W_, self.H_batch_ = self._batch_step(Xb, self.W_, Hb)
+        return self
+
+    def _reset_statistics(self) :
+        self.A_, self.B_ = 0, 0
+        self.n_batches_ = 0
+        self._rng = check_random_state(self.random_state)
+
+    def _initialize_batch(self, Xb, W) :
+        # Least squares estimate of the maps of the new pixels
+        _, _, Hb = initialize_algorithms(Xb, self.G_, W, None, self.n_components, self.init, self.random_state,
+                                         self.simplex_H, self.simplex_W, logshift=self.log_shift, physics_model=self.physics_model_)
+        return self._astype(Hb)
+
+    def _batch_step(self, Xb, W, Hb, fixed_Hb=None) :
+        # 1. Maps of the mini-batch with W fixed
+        with self._phase("H_step"):
+            for _ in range(self.n_inner_iter) :
+                Hb = multiplicative_step_h(Xb,
+                                           self.G_,
+                                           W,
+                                           Hb,
+                                           simplex_H=self.simplex_H,
+                                           mu=self.mu,
+                                           log_shift=self.log_shift,
+                                           epsilon_reg=self.epsilon_reg,
+                                           safe=self.debug,
+                                           dicotomy_tol=self.dicotomy_tol,
+                                           fixed_H=fixed_Hb)
+
+        with self._phase("W_step"):
+            # 2. Running sufficient statistics of the multiplicative step in W
+            _, ratio = get_KL_ratio(Xb, self.G_, W, Hb)
+            if has_nan(ratio) :
+                _, ratio = get_KL_ratio(Xb, self.G_, W, Hb, clip=self.log_shift)
+            num = W * apply_Gt(self.G_, ratio @ Hb.T)
+            denum = G_column_sums(self.G_, Xb.shape[0], W.dtype) @ np.sum(Hb, axis=1, keepdims=True).T
+            self.A_ = self.forget_factor * self.A_ + num
+            self.B_ = self.forget_factor * self.B_ + denum
+
+            # 3. Step in W from the statistics
+            denum = self.B_.copy()
+            if self.simplex_W :
+                denum = simplex_denum_w(self.A_, denum, physics_model=self.physics_model_, log_shift=self.log_shift)
+            W = np.maximum(self.A_ / denum, self.log_shift)
+            if self.fixed_W is not None :
+                W[self.fixed_W >= 0] = self.fixed_W[self.fixed_W >= 0]
+
+        self.n_batches_ += 1
+        if self.physics_model_ != None and self.n_batches_ % 3 == 0 :
+            with self._phase("G_update"):
+                self.G_ = self._astype(self.physics_model_.NMF_update(W, self.G_))
+        return W, Hb
+
+    def _batches(self) :
+        # Mini-batches of pixels in a random order. The maps H of the pixels are kept between the epochs.
+        if self._chunked() :
+            slices = list(self.X_.slices())
+            order = self._rng.permutation(len(slices)) if self.shuffle else range(len(slices))
+            for i in order :
+                yield slices[i], self.X_.block(slices[i])
+        else :
+            p = self.X_.shape[1]
+            order = self._rng.permutation(p) if self.shuffle else np.arange(p)
+            for start in range(0, p, self.batch_size) :
+                # Sorted indices for a contiguous access to the memory
+                idx = np.sort(order[start:start + self.batch_size])
+                yield idx, self.X_[:, idx]
+
+    def _iteration(self, W, H):
+        # One epoch over the mini-batches
+        if self.n_iter_ == 0:
+            self.gamma_ = sigmaL if self.gamma is None else self.gamma
+        H = H.copy()
+        for idx, Xb in self._batches() :
+            fixed_Hb = None if self.fixed_H is None else self.fixed_H[:, idx]
+            W, H[:, idx] = self._batch_step(Xb, W, H[:, idx], fixed_Hb=fixed_Hb)
+        # G may have been updated during the epoch
+        self._cache.invalidate()
+        return W, H
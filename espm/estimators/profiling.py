@@ -0,0 +1,166 @@
+r"""
+Profiling
+---------
+
+The :mod:`espm.estimators.profiling` module records the time spent in the phases of the iterations of the estimators.
+It is used when the parameter `profile` of the estimators is set.
+
+"""
+
+import contextvars
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+PHASES = ["H_step", "W_step", "dichotomy", "loss", "G_update", "truth_metrics", "stopping_checks"]
+
+# Profiler of the running fit, used by the dichotomy solvers which do not have access to the estimator.
+# It is local to the context, so that the fits running in different threads do not share it. The pools of threads of a fit
+# must run their tasks in a copy of the context (see :func:`contextvars.copy_context`) to record them.
+_active_profiler = contextvars.ContextVar("espm_active_profiler", default=None)
+
+def get_active_profiler():
+    r"""Return the profiler of the running fit in the current context, or None."""
+    return _active_profiler.get()
+
+
+class Profiler:
+    r"""Record the wall and CPU times of the phases of each iteration.
+
+    The phases are "H_step", "W_step", "dichotomy" (with its number of iterations), "loss", "G_update", "truth_metrics" and
+    "stopping_checks". The phases can be nested: the dichotomy is part of the steps in H and W, and the loss may be evaluated
+    in the steps when `linesearch` is used. If `track_memory` is True, the peak of the memory allocated during each iteration
+    is recorded with tracemalloc (which slows down the allocations).
+
+    Every recorded phase is also kept as an event that can be exported to the Chrome trace format (see :meth:`export_chrome_trace`).
+
+    :param bool track_memory: record the peak allocated bytes of each iteration (default False)
+
+    Examples
+    --------
+    >>> from espm.estimators.profiling import Profiler
+    >>> profiler = Profiler()
+    >>> profiler.start()
+    >>> with profiler.phase("H_step"):
+    ...     pass
+    >>> profiler.end_iteration()
+    >>> profiler.stop()
+    >>> profiler.to_array().shape
+    (1,)
+    """
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.records = []
+        self.events = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._started_tracemalloc = False
+        self._token = None
+        self._reset_iteration()
+
+    def __getstate__(self):
+        # The lock and the context token cannot be pickled, e.g. when the fitted estimators are returned by a pool of processes
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_token"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _reset_iteration(self):
+        self._wall = dict.fromkeys(PHASES, 0.0)
+        self._cpu = dict.fromkeys(PHASES, 0.0)
+        self._dichotomy_iter = 0
+
+    def start(self):
+        r"""Make the profiler active in the current context and start a new iteration."""
+        self._token = _active_profiler.set(self)
+        if self.track_memory:
+            if not(tracemalloc.is_tracing()):
+                tracemalloc.start()
+                self._started_tracemalloc = True
+            tracemalloc.reset_peak()
+        self._reset_iteration()
+
+    def stop(self):
+        r"""Deactivate the profiler and restore the profiler that was active before :meth:`start`."""
+        if self._token is not None:
+            try:
+                _active_profiler.reset(self._token)
+            except ValueError:
+                # stop is called from another context than start
+                pass
+            self._token = None
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def clock(self):
+        r"""Return the current wall and CPU times, to be passed to :meth:`add`."""
+        return time.perf_counter(), time.process_time()
+
+    def add(self, name, wall_start, cpu_start, iterations=0):
+        r"""Add the time elapsed since (`wall_start`, `cpu_start`) to the phase `name` of the current iteration."""
+        wall_end, cpu_end = self.clock()
+        with self._lock:
+            self._wall[name] += wall_end - wall_start
+            self._cpu[name] += cpu_end - cpu_start
+            self._dichotomy_iter += iterations
+            self.events.append({"name": name,
+                                "ph": "X",
+                                "ts": (wall_start - self._origin) * 1e6,
+                                "dur": (wall_end - wall_start) * 1e6,
+                                "pid": os.getpid(),
+                                "tid": threading.get_ident(),
+                                "args": {"iteration": len(self.records) + 1}})
+
+    @contextmanager
+    def phase(self, name):
+        r"""Context manager recording the phase `name`."""
+        wall_start, cpu_start = self.clock()
+        try:
+            yield
+        finally:
+            self.add(name, wall_start, cpu_start)
+
+    def current(self):
+        r"""Return the wall times of the phases of the current iteration."""
+        with self._lock:
+            return dict(self._wall)
+
+    def end_iteration(self):
+        r"""Store the record of the current iteration and start a new one."""
+        peak = np.nan
+        if self.track_memory and tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+        record = (len(self.records) + 1,)
+        for name in PHASES:
+            record += (self._wall[name], self._cpu[name])
+        self.records.append(record + (self._dichotomy_iter, peak))
+        self._reset_iteration()
+
+    def to_array(self):
+        r"""Return the records as a structured array with one line per iteration.
+
+        The fields are "iteration", "<phase>_wall" and "<phase>_cpu" (in seconds) for each phase, "dichotomy_iter" and
+        "peak_bytes" (NaN if the memory is not tracked).
+        """
+        names = ["iteration"]
+        for name in PHASES:
+            names += [name + "_wall", name + "_cpu"]
+        names += ["dichotomy_iter", "peak_bytes"]
+        dt = np.dtype([(name, "float64") for name in names])
+        return np.array(self.records, dtype=dt)
+
+    def export_chrome_trace(self, filename):
+        r"""Write the recorded phases to a JSON file in the Chrome trace format (chrome://tracing or https://ui.perfetto.dev)."""
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
@@ -1,6 +1,11 @@
 import numpy as np
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from joblib import effective_n_jobs
+from threadpoolctl import threadpool_limits
 
 from espm.estimators.updates import multiplicative_step_h, multiplicative_step_w, multiplicative_step_hq, proj_grad_step_h, proj_grad_step_w, gradH, gradW, estimate_Lipschitz_bound_h, estimate_Lipschitz_bound_w
+from espm.estimators.updates import get_KL_ratio, has_nan
 from espm.measures import trace_xtLx, log_reg
 from espm.estimators import NMFEstimator
 from espm.estimators.surrogates import diff_surrogate, quadratic_surrogate
@@ -37,7 +42,7 @@ class SmoothNMF(NMFEstimator):
 
         See the documentation of the class :mod:`espm.estimators.NMFEstimator` for more details.
     
-    - `\Delta` is the Laplacian operator (it can be created using the function `create_laplacian_matrix` from the `utils` module).
+    - `\Delta` is the Laplacian operator (see :class:`espm.utils.LaplacianOperator`, it is created from the parameter `shape_2d`).
     
     - `\epsilon_{reg}` is the slope of the log regularization/sparsity at 0 (you probably want to leave this to 1).
 
@@ -75,6 +80,9 @@ class SmoothNMF(NMFEstimator):
         Tolerance for the dichotomy algorithm.
     gamma : float, default=None
         Initial value for the step size. If None, it is set to the Lipschitz constant of the gradient.
+    n_jobs : int, default=None
+        Number of threads used for the step in H. H is split in contiguous blocks of columns that are updated in parallel.
+        None means 1 and -1 means using all the processors.
     **kwargs : dict
         Additional parameters for the `NMFEstimator` class.
 
@@ -83,7 +91,7 @@ class SmoothNMF(NMFEstimator):
     loss_names_ = NMFEstimator.loss_names_ + ["log_reg_loss"] + ["Lapl_reg_loss"] + ["gamma"]
 
     # args and kwargs are copied from the init to the super instead of capturing them in *args and **kwargs to be scikit-learn compliant.
-    def __init__(self, lambda_L = 0.0, linesearch=False, mu=0, epsilon_reg=1, algo="log_surrogate", dicotomy_tol=dicotomy_tol, gamma=None, **kwargs):
+    def __init__(self, lambda_L = 0.0, linesearch=False, mu=0, epsilon_reg=1, algo="log_surrogate", dicotomy_tol=dicotomy_tol, gamma=None, n_jobs=None, **kwargs):
 
         super().__init__( **kwargs)
         self.lambda_L = lambda_L
@@ -94,6 +102,7 @@ class SmoothNMF(NMFEstimator):
         assert algo in ["l2_surrogate", "log_surrogate", "projected_gradient", "bmd"]
         self.algo = algo
         self.gamma = gamma
+        self.n_jobs = n_jobs
         self.check_params()
 
     def check_params(self) : 
@@ -106,6 +115,7 @@ class SmoothNMF(NMFEstimator):
 
         if self.algo=="l2_surrogate":
             assert not self.l2, "The l2 parameter must be False when using l2_surrogate"
+        assert self.n_jobs is None or (int(self.n_jobs) == self.n_jobs and self.n_jobs != 0), "n_jobs must be None or a non-zero integer"
 
         
 
@@ -152,6 +162,9 @@ class SmoothNMF(NMFEstimator):
 
         self.gamma_ = None
 
+        if not(self.chunk_size is None) and self.algo == "projected_gradient":
+            raise ValueError("The chunked mode is not supported with the algorithm 'projected_gradient'.")
+
         return super().fit_transform(X, y=y, W=W, H=H)
 
     def _iteration(self, W, H):
@@ -164,7 +177,8 @@ class SmoothNMF(NMFEstimator):
             if self.gamma is None:
 
                 if self.algo in ["l2_surrogate", "log_surrogate", "bmd"]:
-                    self.gamma_ = sigmaL
+                    # sigmaL bounds the largest eigenvalue of the 4-neighbours Laplacian. The bound of the 8-neighbours one is larger.
+                    self.gamma_ = max(sigmaL, getattr(self.L_, "sigma", sigmaL))
                 else:
                     gamma_W = estimate_Lipschitz_bound_w(self.log_shift, self.X_, self.G_, k=self.n_components)
                     gamma_H = estimate_Lipschitz_bound_h(self.log_shift,
@@ -174,158 +188,300 @@ class SmoothNMF(NMFEstimator):
                                                          lambda_L=self.lambda_L,
                                                          mu=self.mu,
                                                          epsilon_reg=self.epsilon_reg)
-                    self.gamma_ = [gamma_H, gamma_W]
+                    # Python floats do not promote float32 matrices
+                    self.gamma_ = [float(gamma_H), float(gamma_W)]
             else:
                 self.gamma_ = deepcopy(self.gamma)
 
+        if self._chunked():
+            return self._iteration_chunked(W, H)
+
         # 1. Update for H
-        if self.linesearch:
-            Hold = H.copy()
-        if self.algo=="l2_surrogate":
-            H = multiplicative_step_hq(self.X_,
-                                       self.G_,
-                                       W,
-                                       H,
-                                       simplex_H=self.simplex_H,
-                                       log_shift=self.log_shift,
-                                       safe=self.debug,
-                                       dicotomy_tol=self.dicotomy_tol,
-                                       lambda_L=self.lambda_L,
-                                       L=self.L_,
-                                       sigmaL=self.gamma_,
-                                       fixed_H=self.fixed_H)
-        elif self.algo=="log_surrogate":
-            H = multiplicative_step_h(self.X_,
-                                      self.G_,
-                                      W,
-                                      H,
-                                      simplex_H=self.simplex_H,
-                                      mu=self.mu,
-                                      log_shift=self.log_shift,
-                                      epsilon_reg=self.epsilon_reg,
-                                      safe=self.debug,
-                                      dicotomy_tol=self.dicotomy_tol,
-                                      lambda_L=self.lambda_L,
-                                      L=self.L_,
-                                      l2=self.l2,
-                                      fixed_H=self.fixed_H,
-                                      sigmaL=self.gamma_)
-        elif self.algo=="projected_gradient":
-            H = proj_grad_step_h(self.X_,
-                                 self.G_,
-                                 W,
-                                 H,
-                                 simplex_H=self.simplex_H,
-                                 mu=self.mu,
-                                 log_shift=self.log_shift,
-                                 epsilon_reg=self.epsilon_reg,
-                                 safe=self.debug,
-                                 dicotomy_tol=self.dicotomy_tol,
-                                 lambda_L=self.lambda_L,
-                                 L=self.L_,
-                                 l2=self.l2,
-                                 fixed_H=self.fixed_H,
-                                 gamma=self.gamma_[0])
-        elif self.algo=="bmd":
-            H = multiplicative_step_h(self.X_,
-                                      self.G_,
-                                      W,
-                                      H,
-                                      simplex_H=self.simplex_H,
-                                      mu=self.mu,
-                                      log_shift=self.log_shift,
-                                      epsilon_reg=self.epsilon_reg,
-                                      safe=self.debug,
-                                      dicotomy_tol=self.dicotomy_tol,
-                                      lambda_L=self.lambda_L,
-                                      L=self.L_,
-                                      l2=self.l2,
-                                      fixed_H=self.fixed_H,
-                                      sigmaL=self.gamma_,
-                                      use_bregman=True)
-        else:
-            raise ValueError("Unknown algorithm")
+        with self._phase("H_step"):
+            if self.linesearch:
+                Hold = H.copy()
+            if effective_n_jobs(self.n_jobs) > 1:
+                H = self._step_h_parallel(W, H)
+            elif self.algo=="l2_surrogate":
+                H = multiplicative_step_hq(self.X_,
+                                           self.G_,
+                                           W,
+                                           H,
+                                           simplex_H=self.simplex_H,
+                                           log_shift=self.log_shift,
+                                           safe=self.debug,
+                                           dicotomy_tol=self.dicotomy_tol,
+                                           lambda_L=self.lambda_L,
+                                           L=self.L_,
+                                           sigmaL=self.gamma_,
+                                           fixed_H=self.fixed_H,
+                                           cache=self._cache)
+            elif self.algo=="log_surrogate":
+                H = multiplicative_step_h(self.X_,
+                                          self.G_,
+                                          W,
+                                          H,
+                                          simplex_H=self.simplex_H,
+                                          mu=self.mu,
+                                          log_shift=self.log_shift,
+                                          epsilon_reg=self.epsilon_reg,
+                                          safe=self.debug,
+                                          dicotomy_tol=self.dicotomy_tol,
+                                          lambda_L=self.lambda_L,
+                                          L=self.L_,
+                                          l2=self.l2,
+                                          fixed_H=self.fixed_H,
+                                          sigmaL=self.gamma_,
+                                          cache=self._cache)
+            elif self.algo=="projected_gradient":
+                H = proj_grad_step_h(self.X_,
+                                     self.G_,
+                                     W,
+                                     H,
+                                     simplex_H=self.simplex_H,
+                                     mu=self.mu,
+                                     log_shift=self.log_shift,
+                                     epsilon_reg=self.epsilon_reg,
+                                     safe=self.debug,
+                                     dicotomy_tol=self.dicotomy_tol,
+                                     lambda_L=self.lambda_L,
+                                     L=self.L_,
+                                     l2=self.l2,
+                                     fixed_H=self.fixed_H,
+                                     gamma=self.gamma_[0],
+                                     cache=self._cache)
+            elif self.algo=="bmd":
+                H = multiplicative_step_h(self.X_,
+                                          self.G_,
+                                          W,
+                                          H,
+                                          simplex_H=self.simplex_H,
+                                          mu=self.mu,
+                                          log_shift=self.log_shift,
+                                          epsilon_reg=self.epsilon_reg,
+                                          safe=self.debug,
+                                          dicotomy_tol=self.dicotomy_tol,
+                                          lambda_L=self.lambda_L,
+                                          L=self.L_,
+                                          l2=self.l2,
+                                          fixed_H=self.fixed_H,
+                                          sigmaL=self.gamma_,
+                                          use_bregman=True,
+                                          cache=self._cache)
+            else:
+                raise ValueError("Unknown algorithm")
 
-        if self.linesearch:
-            if self.algo in ["l2_surrogate", "log_surrogate", "bmd"]:
-                d = diff_surrogate(Hold, H, L=self.L_, sigmaL=self.gamma_, algo=self.algo)
-                if d>0:
-                    self.gamma_  = self.gamma_ / 1.05
+            if self.linesearch:
+                if self.algo in ["l2_surrogate", "log_surrogate", "bmd"]:
+                    self._update_gamma_surrogate(Hold, H)
                 else:
-                    self.gamma_  = self.gamma_ * 1.5
+                    gradf_xt = gradH(self.X_,
+                                     self.G_,
+                                     W,
+                                     Hold,
+                                     mu= self.mu,
+                                     lambda_L=self.lambda_L,
+                                     L=self.L_,
+                                     epsilon_reg=self.epsilon_reg,
+                                     log_shift=self.log_shift,
+                                     safe=self.debug,
+                                     cache=self._cache)
+                    f_xt = self.loss(W, Hold, X = self.X_, average=False)
+                    f_x = self.loss(W, H, X = self.X_, average=False)
+                    g_xxt = quadratic_surrogate(H, Hold, f_xt, gradf_xt, self.gamma_[0])
+                    d = g_xxt - f_x
+                    if d>0:
+                        self.gamma_[0]  = self.gamma_[0] / 1.05
+                    else:
+                        self.gamma_[0]  = self.gamma_[0] * 1.5
+
+        # 2. Update for W
+        with self._phase("W_step"):
+            if self.algo in ["l2_surrogate", "log_surrogate"]:
+                W = multiplicative_step_w(self.X_,
+                                          self.G_,
+                                          W,
+                                          H,
+                                          log_shift=self.log_shift,
+                                          safe=self.debug,
+                                          l2=self.l2,
+                                          simplex_W=self.simplex_W,
+                                          fixed_W=self.fixed_W,
+                                          physics_model=self.physics_model_,
+                                          cache=self._cache)
+            elif self.algo=="bmd":
+                W = multiplicative_step_w(self.X_,
+                                          self.G_,
+                                          W,
+                                          H,
+                                          log_shift=self.log_shift,
+                                          safe=self.debug,
+                                          l2=self.l2,
+                                          simplex_W=self.simplex_W,
+                                          fixed_W=self.fixed_W,
+                                          use_bregman=True,
+                                          physics_model=self.physics_model_,
+                                          cache=self._cache)
             else:
-                gradf_xt = gradH(self.X_,
-                                 self.G_,
-                                 W,
-                                 Hold,
-                                 mu= self.mu,
-                                 lambda_L=self.lambda_L,
-                                 L=self.L_,
-                                 epsilon_reg=self.epsilon_reg,
-                                 log_shift=self.log_shift,
-                                 safe=self.debug)
-                f_xt = self.loss(W, Hold, X = self.X_, average=False)
-                f_x = self.loss(W, H, X = self.X_, average=False)
-                g_xxt = quadratic_surrogate(H, Hold, f_xt, gradf_xt, self.gamma_[0])
-                d = g_xxt - f_x
-                if d>0:
-                    self.gamma_[0]  = self.gamma_[0] / 1.05
-                else:
-                    self.gamma_[0]  = self.gamma_[0] * 1.5
+                if self.linesearch:
+                    Wold = W.copy()
+                W = proj_grad_step_w(self.X_,
+                                     self.G_,
+                                     W,
+                                     H,
+                                     log_shift=self.log_shift,
+                                     safe=self.debug,
+                                     gamma=self.gamma_[1],
+                                     simplex_W=self.simplex_W,
+                                     cache=self._cache)
+                if self.linesearch:
+                    gradf_xt = gradW(self.X_, self.G_, Wold, H, log_shift=self.log_shift, safe=self.debug, cache=self._cache)
+                    f_xt = self.loss(Wold, H, X = self.X_, average=False)
+                    f_x = self.loss(W, H, X = self.X_, average=False)
+                    g_xxt = quadratic_surrogate(W, Wold, f_xt, gradf_xt, self.gamma_[1])
+                    d = g_xxt - f_x
+                    if d>0:
+                        self.gamma_[1]  = self.gamma_[1] / 1.05
+                    else:
+                        self.gamma_[1]  = self.gamma_[1] * 1.5
+
+        # KL_surr = KL_loss_surrogate(self.X_, W, H, Hold, eps=0)
+        # log_surr = log_surrogate(H, Hold, mu=self.mu, epsilon=self.epsilon_reg)
+        # print("surrogate before:", KL_surr, log_surr, log_surr+KL_surr)
+        # KL_surr = KL_loss_surrogate(self.X_, W, H, H, eps=0)
+        # log_surr = log_surrogate(H, H, mu=self.mu, epsilon=self.epsilon_reg)
+        # print("loss after:", KL_surr, log_surr, log_surr+KL_surr)
+        return  W, H
+
+    def _update_gamma_surrogate(self, Hold, H):
+        d = diff_surrogate(Hold, H, L=self.L_, sigmaL=self.gamma_, algo=self.algo)
+        if d>0:
+            self.gamma_  = self.gamma_ / 1.05
+        else:
+            self.gamma_  = self.gamma_ * 1.5
+
+    def _step_h_block(self, X, G, W, H, sl, HL, maxH, cache=None):
+        # Step in H for the block of pixels `sl`. X is the block of data, H, HL and maxH are computed on all the pixels.
+        HLb = None if HL is None else HL[:, sl]
+        fixed_H = None if self.fixed_H is None else self.fixed_H[:, sl]
+        if self.algo=="l2_surrogate":
+            return multiplicative_step_hq(X,
+                                          G,
+                                          W,
+                                          H[:, sl],
+                                          simplex_H=self.simplex_H,
+                                          log_shift=self.log_shift,
+                                          safe=self.debug,
+                                          dicotomy_tol=self.dicotomy_tol,
+                                          lambda_L=self.lambda_L,
+                                          L=self.L_,
+                                          sigmaL=self.gamma_,
+                                          fixed_H=fixed_H,
+                                          cache=cache,
+                                          HL=HLb)
+        elif self.algo=="projected_gradient":
+            return proj_grad_step_h(X,
+                                    G,
+                                    W,
+                                    H[:, sl],
+                                    simplex_H=self.simplex_H,
+                                    mu=self.mu,
+                                    log_shift=self.log_shift,
+                                    epsilon_reg=self.epsilon_reg,
+                                    safe=self.debug,
+                                    dicotomy_tol=self.dicotomy_tol,
+                                    lambda_L=self.lambda_L,
+                                    L=self.L_,
+                                    l2=self.l2,
+                                    fixed_H=fixed_H,
+                                    gamma=self.gamma_[0],
+                                    cache=cache,
+                                    HL=HLb)
+        return multiplicative_step_h(X,
+                                     G,
+                                     W,
+                                     H[:, sl],
+                                     simplex_H=self.simplex_H,
+                                     mu=self.mu,
+                                     log_shift=self.log_shift,
+                                     epsilon_reg=self.epsilon_reg,
+                                     safe=self.debug,
+                                     dicotomy_tol=self.dicotomy_tol,
+                                     lambda_L=self.lambda_L,
+                                     L=self.L_,
+                                     l2=self.l2,
+                                     fixed_H=fixed_H,
+                                     sigmaL=self.gamma_,
+                                     use_bregman=self.algo=="bmd",
+                                     cache=cache,
+                                     HL=HLb,
+                                     maxH=maxH)
+
+    def _step_h_parallel(self, W, H):
+        # As in _iteration_chunked, the Laplacian terms are computed once on the full H and the blocks of columns are independent.
+        # The blocks are updated by a pool of threads (the numpy kernels release the GIL), with one BLAS thread per block.
+        # Each block runs in a copy of the context, so that the dichotomies are recorded by the active profiler.
+        n_threads = min(effective_n_jobs(self.n_jobs), H.shape[1])
+        HL = None if self.lambda_L==0 else H @ self.L_
+        maxH = np.max(H, axis=1, keepdims=True)
+        # GW is shared by the blocks, which are then computed with G = None (identity) and no cache
+        GW = self._cache.GW(self.G_, W)
+        bounds = np.linspace(0, H.shape[1], n_threads + 1).astype(int)
+        new_H = np.empty_like(H)
+
+        def step(sl):
+            new_H[:, sl] = self._step_h_block(self.X_[:, sl], None, GW, H, sl, HL, maxH)
+
+        with threadpool_limits(limits=1, user_api="blas"):
+            with ThreadPoolExecutor(max_workers=n_threads) as pool:
+                futures = [pool.submit(contextvars.copy_context().run, step, slice(start, stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+                for future in futures:
+                    future.result()
+        return new_H
+
+    def _iteration_chunked(self, W, H):
+        # Same as _iteration, with X streamed by blocks of pixels.
+        # The steps in H are separable over the pixels: the Laplacian regularization only needs H @ L and the maximum of the
+        # rows of H, which are computed once on the full H (H is resident in memory).
+        # The step in W only needs (X / GWH) @ H.T, which is accumulated over the blocks.
+
+        # 1. Update for H
+        with self._phase("H_step"):
+            if self.linesearch:
+                Hold = H.copy()
+            HL = None if self.lambda_L==0 else H @ self.L_
+            maxH = np.max(H, axis=1, keepdims=True)
+            new_H = np.empty_like(H)
+            for sl, Xb in self.X_.blocks():
+                new_H[:, sl] = self._step_h_block(Xb, self.G_, W, H, sl, HL, maxH, cache=self._cache)
+            H = new_H
+            if self.linesearch:
+                self._update_gamma_surrogate(Hold, H)
 
         # 2. Update for W
-        if self.algo in ["l2_surrogate", "log_surrogate"]:
+        with self._phase("W_step"):
+            ratio_Ht = 0
+            for sl, Xb in self.X_.blocks():
+                _, ratio = get_KL_ratio(Xb, self.G_, W, H[:, sl], cache=self._cache)
+                if not(self.algo=="bmd") and has_nan(ratio):
+                    _, ratio = get_KL_ratio(Xb, self.G_, W, H[:, sl], cache=self._cache, clip=self.log_shift)
+                ratio_Ht = ratio_Ht + ratio @ H[:, sl].T
+            sigmaR = None
+            if self.algo=="bmd":
+                sigmaR = self.X_.sum(axis=1) if self.G_ is None else self.X_.sum()
             W = multiplicative_step_w(self.X_,
                                       self.G_,
                                       W,
                                       H,
                                       log_shift=self.log_shift,
                                       safe=self.debug,
-                                      l2=self.l2,
                                       simplex_W=self.simplex_W,
                                       fixed_W=self.fixed_W,
-                                      physics_model=self.physics_model_)
-        elif self.algo=="bmd":
-            W = multiplicative_step_w(self.X_,
-                                      self.G_,
-                                      W,
-                                      H,
-                                      log_shift=self.log_shift,
-                                      safe=self.debug,
-                                      l2=self.l2,
-                                      simplex_W=self.simplex_W,
-                                      fixed_W=self.fixed_W,
-                                      use_bregman=True,
-                                      physics_model=self.physics_model_)
-        else:
-            if self.linesearch:
-                Wold = W.copy()
-            W = proj_grad_step_w(self.X_,
-                                 self.G_,
-                                 W,
-                                 H,
-                                 log_shift=self.log_shift,
-                                 safe=self.debug,
-                                 gamma=self.gamma_[1],
-                                 simplex_W=self.simplex_W)
-            if self.linesearch:
-                gradf_xt = gradW(self.X_, self.G_, Wold, H, log_shift=self.log_shift, safe=self.debug)
-                f_xt = self.loss(Wold, H, X = self.X_, average=False)
-                f_x = self.loss(W, H, X = self.X_, average=False)
-                g_xxt = quadratic_surrogate(W, Wold, f_xt, gradf_xt, self.gamma_[1])
-                d = g_xxt - f_x
-                if d>0:
-                    self.gamma_[1]  = self.gamma_[1] / 1.05
-                else:
-                    self.gamma_[1]  = self.gamma_[1] * 1.5
-
-        # KL_surr = KL_loss_surrogate(self.X_, W, H, Hold, eps=0)
-        # log_surr = log_surrogate(H, Hold, mu=self.mu, epsilon=self.epsilon_reg)
-        # print("surrogate before:", KL_surr, log_surr, log_surr+KL_surr)
-        # KL_surr = KL_loss_surrogate(self.X_, W, H, H, eps=0)
-        # log_surr = log_surrogate(H, H, mu=self.mu, epsilon=self.epsilon_reg)
-        # print("loss after:", KL_surr, log_surr, log_surr+KL_surr)
-        return  W, H
+                                      use_bregman=self.algo=="bmd",
+                                      physics_model=self.physics_model_,
+                                      ratio_Ht=ratio_Ht,
+                                      sigmaR=sigmaR)
+        return W, H
 
     def loss(self, W, H, average=True, X = None):
         """Compute the loss function."""
@@ -336,9 +492,12 @@ class SmoothNMF(NMFEstimator):
             reg = reg / self.GWH_numel_
         self.detailed_loss_.append(reg)
 
-        l2 = 0.5 * self.lambda_L * trace_xtLx(self.L_, H.T, average=False)
-        if average:
-            l2 = l2 / self.GWH_numel_
+        if self.lambda_L == 0:
+            l2 = 0
+        else:
+            l2 = 0.5 * self.lambda_L * trace_xtLx(self.L_, H.T, average=False)
+            if average:
+                l2 = l2 / self.GWH_numel_
         self.detailed_loss_.append(l2)
         if isinstance(self.gamma_, list):
             self.detailed_loss_.append(self.gamma_[0])
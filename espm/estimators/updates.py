@@ -1,7 +1,236 @@
 import numpy as np
+from scipy import sparse
 from espm.conf import log_shift, dicotomy_tol, sigmaL
+from espm.utils import product_at_nonzeros, sum_keepdims, BlockSparseG, dense_G
 from sklearn.decomposition._nmf import _initialize_nmf as initialize_nmf 
-from espm.estimators.dicotomy import dichotomy_simplex, dichotomy_simplex_acc, dichotomy_simplex_projected_gradient
+from espm.estimators.dicotomy import dichotomy_simplex, dichotomy_simplex_acc, simplex_projected_gradient
+
+def apply_G(G, W):
+    r"""Compute :math:`GW`.
+
+    If `G` is None, it stands for the identity matrix and `W` is returned without any computation.
+    """
+    if G is None:
+        return W
+    return G @ W
+
+def apply_Gt(G, M):
+    r"""Compute :math:`G^\top M`.
+
+    If `G` is None, it stands for the identity matrix and `M` is returned without any computation.
+    """
+    if G is None:
+        return M
+    return G.T @ M
+
+def G_column_sums(G, n, dtype=np.float64):
+    r"""Sums of the columns of `G` as a column vector of shape (m, 1).
+
+    If `G` is None, it stands for the identity matrix of size `n` and a vector of ones is returned.
+    """
+    if G is None:
+        return np.ones((n, 1), dtype=dtype)
+    if isinstance(G, BlockSparseG):
+        return G.column_sums()[:, np.newaxis]
+    return np.sum(G, axis=0, keepdims=True).T
+
+def G_is_nonnegative(G, log_shift=log_shift):
+    r"""Return True if `G` has no entry smaller than `-log_shift/2` (very small negative values are allowed)."""
+    if G is None:
+        return True
+    if isinstance(G, BlockSparseG):
+        return G.min() >= -log_shift/2
+    return np.sum(G<-log_shift/2)==0
+
+def is_identity(G):
+    r"""Return True if `G` is None or a square identity matrix."""
+    if G is None:
+        return True
+    if not(isinstance(G, np.ndarray)) or G.ndim != 2 or G.shape[0] != G.shape[1]:
+        return False
+    return np.allclose(G, np.eye(G.shape[0]))
+
+class ReconstructionCache:
+    r"""Cache of the products :math:`GW` and :math:`GWH`.
+
+    During one iteration of the NMF, the same products are needed by the step in H, the step in W and the evaluation of the loss.
+    The cache keeps the last computed products and recomputes them only when `G`, `W` or `H` is a different object than the one
+    used for the cached value. The arrays are compared by identity, hence :meth:`invalidate` has to be called whenever one of them
+    is modified in place (for example after an update of G by a physical model).
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from espm.estimators.updates import ReconstructionCache
+    >>> cache = ReconstructionCache()
+    >>> G, W, H = np.random.rand(10, 4), np.random.rand(4, 2), np.random.rand(2, 5)
+    >>> GWH = cache.GWH(G, W, H)
+    >>> cache.GWH(G, W, H) is GWH
+    True
+    """
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        r"""Drop all the cached products."""
+        self._G = None
+        self._W = None
+        self._H = None
+        self._GW = None
+        self._GWH = None
+        self._H_nz = None
+        self._X_nz = None
+        self._GWH_nz = None
+
+    def GW(self, G, W):
+        r"""Return :math:`GW`, computing it only if `G` or `W` changed."""
+        if self._GW is None or not(G is self._G) or not(W is self._W):
+            self._G, self._W = G, W
+            self._GW = apply_G(G, W)
+            self._H, self._GWH = None, None
+            self._H_nz, self._X_nz, self._GWH_nz = None, None, None
+        return self._GW
+
+    def GWH(self, G, W, H):
+        r"""Return :math:`GWH`, computing it only if `G`, `W` or `H` changed."""
+        GW = self.GW(G, W)
+        if self._GWH is None or not(H is self._H):
+            self._H = H
+            self._GWH = GW @ H
+        return self._GWH
+
+    def GWH_nonzeros(self, G, W, H, X):
+        r"""Return the entries of :math:`GWH` at the nonzeros of the sparse matrix `X`, computing them only if needed."""
+        GW = self.GW(G, W)
+        if self._GWH_nz is None or not(H is self._H_nz) or not(X is self._X_nz):
+            self._H_nz, self._X_nz = H, X
+            self._GWH_nz = product_at_nonzeros(GW, H, X)
+        return self._GWH_nz
+
+class Workspace(ReconstructionCache):
+    r"""Reconstruction cache writing into preallocated buffers.
+
+    The product :math:`GWH` and the ratio :math:`X / GWH` are written with `out=` semantics into two buffers of shape (n, p)
+    that are allocated once, instead of allocating new temporaries at every call of the update kernels. The buffer
+    `loss_buffer` of shape (2, b, p) can be used by :func:`espm.measures.KLdiv_loss` to evaluate the loss by blocks of b rows.
+
+    Note that the arrays returned by :meth:`GWH` and :meth:`ratio` are overwritten by the next computation. They must not be
+    kept by the caller.
+
+    :param int n: number of rows of X
+    :param int p: number of columns of X
+    :param dtype: dtype of the buffers (default np.float64)
+    :param int block_size: number of rows of the loss buffer (default 256)
+    """
+    def __init__(self, n, p, dtype=np.float64, block_size=256):
+        super().__init__()
+        self.shape = (n, p)
+        self._GWH_buffer = np.empty((n, p), dtype=dtype)
+        self._ratio_buffer = np.empty((n, p), dtype=dtype)
+        self.loss_buffer = np.empty((2, min(block_size, n), p), dtype=dtype)
+
+    def _get_buffer(self, name, dtype):
+        # The buffers are only reallocated if the dtype of the computation changes
+        buffer = getattr(self, name)
+        if buffer.dtype != dtype:
+            buffer = np.empty(self.shape, dtype=dtype)
+            setattr(self, name, buffer)
+        return buffer
+
+    def GWH(self, G, W, H):
+        r"""Return :math:`GWH`, computing it into the buffer only if `G`, `W` or `H` changed."""
+        GW = self.GW(G, W)
+        if self._GWH is None or not(H is self._H):
+            if (GW.shape[0], H.shape[1]) != self.shape:
+                return super().GWH(G, W, H)
+            self._H = H
+            buffer = self._get_buffer("_GWH_buffer", np.result_type(GW, H))
+            self._GWH = np.matmul(GW, H, out=buffer)
+        return self._GWH
+
+    def ratio(self, X, GWH, shift=0):
+        r"""Return :math:`X / (GWH + shift)` written into the ratio buffer."""
+        if X.shape != self.shape:
+            return X / (GWH + shift)
+        buffer = self._get_buffer("_ratio_buffer", np.result_type(X, GWH))
+        if shift == 0:
+            return np.divide(X, GWH, out=buffer)
+        np.add(GWH, shift, out=buffer)
+        return np.divide(X, buffer, out=buffer)
+
+def get_GW(G, W, cache=None):
+    r"""Compute :math:`GW`, using the cache if provided."""
+    if cache is None:
+        return apply_G(G, W)
+    return cache.GW(G, W)
+
+def get_GWH(G, W, H, cache=None):
+    r"""Compute :math:`GW` and :math:`GWH`, using the cache if provided."""
+    if cache is None:
+        GW = apply_G(G, W)
+        return GW, GW @ H
+    return cache.GW(G, W), cache.GWH(G, W, H)
+
+def get_ratio(X, GWH, cache=None, shift=0):
+    r"""Compute :math:`X / (GWH + shift)`, using the buffers of the cache if it is a :class:`Workspace`."""
+    if isinstance(cache, Workspace):
+        return cache.ratio(X, GWH, shift=shift)
+    if shift == 0:
+        return X / GWH
+    return X / (GWH + shift)
+
+def get_GWH_nonzeros(G, W, H, X, cache=None):
+    r"""Compute the entries of :math:`GWH` at the nonzeros of the sparse matrix `X`, using the cache if provided."""
+    if cache is None:
+        return product_at_nonzeros(apply_G(G, W), H, X)
+    return cache.GWH_nonzeros(G, W, H, X)
+
+def get_KL_ratio(X, G, W, H, cache=None, shift=0, clip=None):
+    r"""Compute :math:`GW` and the ratio :math:`X / (GWH + shift)` needed by the KL updates.
+
+    If `X` is a scipy sparse matrix, the ratio is only evaluated at the nonzero entries of `X` and returned as a CSR matrix
+    with the sparsity pattern of `X`. If `clip` is not None, :math:`GWH` is lower bounded by `clip` before the division.
+    """
+    if sparse.issparse(X):
+        X = X.tocsr()
+        GW = get_GW(G, W, cache)
+        GWH = get_GWH_nonzeros(G, W, H, X, cache)
+        if clip is not None:
+            GWH = np.maximum(GWH, clip)
+        if not(shift == 0):
+            GWH = GWH + shift
+        return GW, sparse.csr_matrix((X.data / GWH, X.indices, X.indptr), shape=X.shape)
+    GW, GWH = get_GWH(G, W, H, cache)
+    if clip is not None:
+        GWH = np.maximum(GWH, clip)
+    return GW, get_ratio(X, GWH, cache, shift=shift)
+
+def Dt_ratio(D, ratio):
+    r"""Compute :math:`D^\top R` for a dense or sparse ratio `R`."""
+    if sparse.issparse(ratio):
+        return (ratio.T @ D).T
+    return D.T @ ratio
+
+def has_nan(ratio):
+    r"""Check for NaN in a dense or sparse ratio."""
+    if sparse.issparse(ratio):
+        return np.any(np.isnan(ratio.data))
+    return np.any(np.isnan(ratio))
+
+def simplex_denum_w(num, denum, physics_model=None, log_shift=log_shift, tol=dicotomy_tol):
+    """Add the Lagrange multiplier of the simplex constraint to the denominator of the multiplicative step in W.
+
+    The columns of `num / denum` then sum to one over the lines given by `physics_model.NMF_simplex()` (all lines if `physics_model` is None).
+    `denum` is modified in place.
+    """
+    if physics_model != None:
+        indices = physics_model.NMF_simplex()
+        nu = dichotomy_simplex(num[indices,:], denum[indices,:], log_shift=log_shift, tol=tol)
+        denum[indices,:] = denum[indices,:] + nu
+    else :
+        nu = dichotomy_simplex(num, denum, log_shift=log_shift, tol=tol)
+        denum = denum + nu
+    return denum
 
 def multiplicative_step_w(X,
                           G,
@@ -13,59 +242,64 @@ def multiplicative_step_w(X,
                           l2=False,
                           fixed_W = None,
                           physics_model=None,
-                          use_bregman=False):
+                          use_bregman=False,
+                          cache=None,
+                          ratio_Ht=None,
+                          sigmaR=None):
     """
     Multiplicative step in W.
+
+    If `G` is None, it is assumed to be the identity matrix and all the products with `G` are skipped.
+    If `cache` (a :class:`ReconstructionCache`) is provided, the products :math:`GW` and :math:`GWH` are taken from it when possible.
+    If it is a :class:`Workspace`, the n x p temporaries are written into its buffers.
+    If `ratio_Ht`, the product :math:`(X / GWH) H^\top`, is provided (for example accumulated over blocks of pixels), X is not
+    accessed, except for its sums `sigmaR` that have to be provided as well with `use_bregman`.
     """
     if safe:
         # Allow for very small negative values!
         assert(np.sum(H<-log_shift/2)==0)
         assert(np.sum(W<-log_shift/2)==0)
-        assert(np.sum(G<-log_shift/2)==0)
+        assert(G_is_nonnegative(G, log_shift))
 
         H = np.maximum(H, log_shift)
         W = np.maximum(W, log_shift)
 
     if l2:
-        GG = G.T @ G
         HH = H @ H.T
-        GGWHH = GG @ W @ HH
+        if G is None:
+            GGWHH = W @ HH
+        else:
+            G_dense = dense_G(G)
+            GG = G_dense.T @ G_dense
+            GGWHH = GG @ W @ HH
 
-        GXH = G.T @ (X @ H.T)
+        GXH = apply_Gt(G, X @ H.T)
 
         new_W = W / GGWHH * GXH
     else:
-        GW = G @ W
-        GWH = GW @ H
+        if ratio_Ht is None:
+            GW, ratio = get_KL_ratio(X, G, W, H, cache)
+            if not(use_bregman) and has_nan(ratio):
+                GW, ratio = get_KL_ratio(X, G, W, H, cache, clip=log_shift)
+            ratio_Ht = ratio @ H.T
         if use_bregman:
-            # check if G is the identity matrix
-            if np.allclose(G, np.eye(G.shape[0])):
-                sigmaR = np.sum(X, axis=1, keepdims=True)
-            else:
-                sigmaR = np.sum(X)
+            if sigmaR is None:
+                # The sums of the rows of X are used when G is the identity, whether it is given explicitly or as None
+                if is_identity(G):
+                    sigmaR = sum_keepdims(X, axis=1)
+                else:
+                    sigmaR = sum_keepdims(X)
             num = sigmaR * W
-            gradg = - G.T @ (X / GWH) @ H.T + np.sum(G, axis=0,  keepdims=True).T @ np.sum(H, axis=1,  keepdims=True).T
+            gradg = - apply_Gt(G, ratio_Ht) + G_column_sums(G, X.shape[0], W.dtype) @ np.sum(H, axis=1,  keepdims=True).T
             denum = gradg * W + sigmaR
 
         else:
             # Split to debug timing...
             # term1 = G.T @ (X / (GWH + eps)) @ H.T
-            op1 = X / GWH
-            if np.any(np.isnan(op1)):
-                GWH = np.maximum(GWH, log_shift)
-                op1 = X / GWH
-            
-            mult1 = G.T @ op1
-            num = W*(mult1 @ H.T)
-            denum = np.sum(G, axis=0,  keepdims=True).T @ np.sum(H, axis=1,  keepdims=True).T
+            num = W*apply_Gt(G, ratio_Ht)
+            denum = G_column_sums(G, X.shape[0], W.dtype) @ np.sum(H, axis=1,  keepdims=True).T
             if simplex_W:
-                if physics_model != None:
-                    indices = physics_model.NMF_simplex()
-                    nu = dichotomy_simplex(num[indices,:], denum[indices,:], log_shift=log_shift, tol=dicotomy_tol)
-                    denum[indices,:] = denum[indices,:] + nu
-                else : 
-                    nu = dichotomy_simplex(num, denum, log_shift=log_shift, tol=dicotomy_tol)
-                    denum = denum + nu
+                denum = simplex_denum_w(num, denum, physics_model=physics_model, log_shift=log_shift)
 
         new_W = num / denum
     
@@ -79,7 +313,7 @@ def multiplicative_step_w(X,
 
 
 
-def multiplicative_step_h(X, G, W, H, simplex_H =False, mu=0, log_shift=log_shift, epsilon_reg=1, safe=True, dicotomy_tol=dicotomy_tol, lambda_L=0, L=None, l2=False, sigmaL=sigmaL, fixed_H = None, use_bregman=False):
+def multiplicative_step_h(X, G, W, H, simplex_H =False, mu=0, log_shift=log_shift, epsilon_reg=1, safe=True, dicotomy_tol=dicotomy_tol, lambda_L=0, L=None, l2=False, sigmaL=sigmaL, fixed_H = None, use_bregman=False, cache=None, HL=None, maxH=None):
     """
     Multiplicative step in A.
     The main terms are calculated first.
@@ -88,8 +322,13 @@ def multiplicative_step_h(X, G, W, H, simplex_H =False, mu=0, log_shift=log_shif
     by the mask are calculaed, without particle regularization. Note that mu can be passed
     as a vector to regularize the different phase of A differently.
     To calculate the regularized step, we make a linear approximation of the log.
+    If `G` is None, it is assumed to be the identity matrix.
+    If `cache` (a :class:`ReconstructionCache`) is provided, the products :math:`GW` and :math:`GWH` are taken from it when possible.
+    If it is a :class:`Workspace`, the n x p temporaries are written into its buffers.
+    `HL` (i.e. :math:`HL`) and `maxH` (the maximum of the rows of H) can be provided when H is a block of columns of a larger
+    matrix, so that the Laplacian regularization is computed on the full matrix.
     """
-    if not(lambda_L==0):
+    if not(lambda_L==0) and HL is None:
         if L is None:
             raise ValueError("Please provide the laplacian")
         HL = H@L
@@ -99,11 +338,11 @@ def multiplicative_step_h(X, G, W, H, simplex_H =False, mu=0, log_shift=log_shif
         # TODO: update this
         assert(np.sum(H<-log_shift/2)==0)
         assert(np.sum(W<-log_shift/2)==0)
-        assert(np.sum(G<-log_shift/2)==0)
+        assert(G_is_nonnegative(G, log_shift))
         H = np.maximum(H, log_shift)
         W = np.maximum(W, log_shift)
 
-    GW = G @ W # Also called D
+    GW = get_GW(G, W, cache) # Also called D
     
     if l2:
         assert lambda_L == 0
@@ -117,25 +356,27 @@ def multiplicative_step_h(X, G, W, H, simplex_H =False, mu=0, log_shift=log_shif
         denum = WGGW @ H
     else:
         if use_bregman:
-            GWH = GW @ H
-            sigmaR = np.sum(X, axis=0, keepdims=True)
+            GW, ratio = get_KL_ratio(X, G, W, H, cache)
+            sigmaR = sum_keepdims(X, axis=0)
             num = sigmaR / H
-            gradg = - GW.T @ (X / GWH) +  np.sum(GW, axis=0,  keepdims=True).T
+            gradg = - Dt_ratio(GW, ratio) +  np.sum(GW, axis=0,  keepdims=True).T
             denum = gradg + sigmaR / H
         else:
-            GWH = GW @ H
-            num = GW.T @ (X / GWH)
+            GW, ratio = get_KL_ratio(X, G, W, H, cache)
+            num = Dt_ratio(GW, ratio)
             if np.any(np.isnan(num)):
-                GWH = np.maximum(GWH, log_shift)
-                num = GW.T @ (X / GWH)
+                GW, ratio = get_KL_ratio(X, G, W, H, cache, clip=log_shift)
+                num = Dt_ratio(GW, ratio)
             denum = np.sum(GW, axis=0, keepdims=True).T 
 
         if not(np.isscalar(mu) and mu==0):
+            mu = np.asarray(mu, dtype=H.dtype)
             if len(np.shape(mu))==1:
                 mu = np.expand_dims(mu, axis=1)
             denum = denum + mu / (H + epsilon_reg)
         if not(lambda_L==0):
-            maxH = np.max(H, axis=1, keepdims=True)
+            if maxH is None:
+                maxH = np.max(H, axis=1, keepdims=True)
             num = num + lambda_L * sigmaL * maxH
             denum = denum + lambda_L * sigmaL * maxH + lambda_L * HL 
     num = H * num
@@ -156,13 +397,13 @@ def multiplicative_step_h(X, G, W, H, simplex_H =False, mu=0, log_shift=log_shif
 
 
 
-def initialize_algorithms(X, G, W, H, n_components, init, random_state, simplex_H, simplex_W, logshift=log_shift, physics_model = None):
+def initialize_algorithms(X, G, W, H, n_components, init, random_state, simplex_H, simplex_W, logshift=log_shift, physics_model = None, init_DH = None):
     # Handle initialization
+    # init_DH contains the initial estimates of GW and H computed by the caller (e.g. when X is streamed by blocks). X is then not used.
 
+    # G = None stands for the identity matrix. It is never built explicitly.
     if G is None : 
         skip_second = True
-        # G = sparse.diags(np.ones(X.shape[0]).astype(X.dtype))        
-        G = np.diag(np.ones(X.shape[0]).astype(X.dtype))
 
     # elif callable(G) : 
     #     assert not(model_params is None), "You need to input model_parameters"
@@ -175,7 +416,10 @@ def initialize_algorithms(X, G, W, H, n_components, init, random_state, simplex_
 
     if W is None:
         if H is None:
-            D, H = initialize_nmf(X, n_components=n_components, init=init, random_state=random_state)
+            if init_DH is None:
+                D, H = initialize_nmf(X, n_components=n_components, init=init, random_state=random_state)
+            else:
+                D, H = init_DH
             # D, A = u.rescaled_DA(D,A)
             if simplex_H:
                 H = np.nan_to_num(H, nan = 1.0/H.shape[0])
@@ -184,6 +428,11 @@ def initialize_algorithms(X, G, W, H, n_components, init, random_state, simplex_
                 
                 # D = np.abs(np.linalg.lstsq(H.T, X.T,rcond=None)[0].T)
                 D = D*np.mean(scale)
+        elif not(init_DH is None):
+            D = init_DH[0]
+        elif sparse.issparse(X):
+            # Same least squares solution as below, without densifying X
+            D = np.abs(X @ np.linalg.pinv(H))
         else:
             D = np.abs(np.linalg.lstsq(H.T, X.T,rcond=None)[0].T)
         if skip_second:
@@ -202,7 +451,7 @@ def initialize_algorithms(X, G, W, H, n_components, init, random_state, simplex_
                     W[indices,:] = W[indices,:]/scale
             # P = np.abs(np.linalg.lstsq(G, D,rcond=None)[0])
             else : 
-                W = np.abs(np.linalg.lstsq(G, D,rcond=None)[0])
+                W = np.abs(np.linalg.lstsq(dense_G(G), D,rcond=None)[0])
 
                 if simplex_W:
                     W = np.nan_to_num(W, nan = 1.0/W.shape[0])
@@ -210,8 +459,13 @@ def initialize_algorithms(X, G, W, H, n_components, init, random_state, simplex_
                     W = W/scale
 
     elif H is None:
-        D = G @ W
-        H = np.abs(np.linalg.lstsq(D, X, rcond=None)[0])
+        D = apply_G(G, W)
+        if not(init_DH is None):
+            H = init_DH[1]
+        elif sparse.issparse(X):
+            H = np.abs((X.T @ np.linalg.pinv(D).T).T)
+        else:
+            H = np.abs(np.linalg.lstsq(D, X, rcond=None)[0])
         if simplex_H:
             scale = np.sum(H, axis=0, keepdims=True)
             H = H/scale
@@ -219,6 +473,10 @@ def initialize_algorithms(X, G, W, H, n_components, init, random_state, simplex_
     W = np.maximum(W, log_shift)
     H = np.maximum(H, log_shift)
 
+    # An explicit identity matrix is replaced by None so that the products with G are skipped during the optimization.
+    if not(skip_second) and physics_model is None and is_identity(G):
+        G = None
+
     return G, W, H
 
 def update_q(D, H, log_shift=log_shift):
@@ -239,16 +497,16 @@ def multiplicative_step_wq(X, G, W, H, simplex_W = True, log_shift=log_shift, sa
         # Allow for very small negative values!
         assert np.sum(H<-log_shift/2)==0
         assert np.sum(W<-log_shift/2)==0
-        assert np.sum(G<-log_shift/2)==0
+        assert G_is_nonnegative(G, log_shift)
 
-    GW = G @ W
+    GW = apply_G(G, W)
     Q = update_q(GW, H, log_shift=log_shift)
 
     XQ = np.sum(np.expand_dims(X, axis=2) * Q, axis=1)
 
-    term1 = G.T @ (XQ / (GW + log_shift)) 
+    term1 = apply_Gt(G, XQ / (GW + log_shift))
 
-    term2 = np.sum(G, axis=0,  keepdims=True).T @ np.sum(H, axis=1,  keepdims=True).T
+    term2 = G_column_sums(G, X.shape[0], W.dtype) @ np.sum(H, axis=1,  keepdims=True).T
     if simplex_W :
         if physics_model != None:
             indices = physics_model.NMF_simplex()
@@ -259,28 +517,30 @@ def multiplicative_step_wq(X, G, W, H, simplex_W = True, log_shift=log_shift, sa
             term2 = term2 + nu
     return W / term2 * term1
 
-def multiplicative_step_hq(X, G, W, H, simplex_H=True, log_shift=log_shift, safe=True, dicotomy_tol=dicotomy_tol, lambda_L=0, L=None, sigmaL=sigmaL, fixed_H = None):
+def multiplicative_step_hq(X, G, W, H, simplex_H=True, log_shift=log_shift, safe=True, dicotomy_tol=dicotomy_tol, lambda_L=0, L=None, sigmaL=sigmaL, fixed_H = None, cache=None, HL=None):
     """
     Multiplicative step in H.
+
+    `HL` (i.e. :math:`HL`) can be provided when H is a block of columns of a larger matrix.
     """
-    if not lambda_L==0:
+    if not lambda_L==0 and HL is None:
         if L is None:
             raise ValueError("Please provide the laplacian")
+        HL = H @ L
 
     if safe:
         # Allow for very small negative values!
         assert np.sum(H<-log_shift/2)==0
         assert np.sum(W<-log_shift/2)==0
-        assert np.sum(G<-log_shift/2)==0
+        assert G_is_nonnegative(G, log_shift)
 
-    GW = G @ W # Also called D
-    GWH = GW @ H
+    GW, ratio = get_KL_ratio(X, G, W, H, cache, shift=log_shift) # GW is also called D
 
-    minus_c = H * (GW.T @ (X / (GWH+log_shift)))
+    minus_c = H * Dt_ratio(GW, ratio)
 
     b = np.sum(GW, axis=0, keepdims=True).T 
     if not lambda_L==0 :
-        b = b + lambda_L * H @ L - lambda_L * sigmaL  * H 
+        b = b + lambda_L * HL - lambda_L * sigmaL  * H 
         a = lambda_L * sigmaL
         if simplex_H:
             nu = dichotomy_simplex_acc(a, b, minus_c, log_shift=log_shift, tol=dicotomy_tol)
@@ -299,23 +559,23 @@ def multiplicative_step_hq(X, G, W, H, simplex_H=True, log_shift=log_shift, safe
         new_H[fixed_H >= 0] = fixed_H[fixed_H >= 0]
     return new_H
 
-def gradW(X, G, W, H, log_shift=log_shift, safe=False, l2=False):
+def gradW(X, G, W, H, log_shift=log_shift, safe=False, l2=False, cache=None):
     if safe:
         H = np.maximum(H, log_shift)
         W = np.maximum(W, log_shift)
     if l2:
-        grad = 2*G.T @ ( (G @ W) @ H - X ) @ H.T
+        grad = 2*apply_Gt(G, (apply_G(G, W) @ H - X ) @ H.T)
     else:
-        D = G @ W
-        DH = D @ H
-        grad = G.T @ (- (X / DH) @ H.T + np.sum(H, axis=1, keepdims=True).T)
+        D, ratio = get_KL_ratio(X, G, W, H, cache)
+        grad = apply_Gt(G, - (ratio @ H.T) + np.sum(H, axis=1, keepdims=True).T)
     return grad
 
-def gradH(X, G, W, H, mu=0,  lambda_L=0, L=None, epsilon_reg=1, log_shift=log_shift, safe=False, l2=False):
-    if not(lambda_L==0):
+def gradH(X, G, W, H, mu=0,  lambda_L=0, L=None, epsilon_reg=1, log_shift=log_shift, safe=False, l2=False, cache=None, HL=None):
+    # HL (i.e. H @ L) can be provided when H is a block of columns of a larger matrix
+    if not(lambda_L==0) and HL is None:
         if L is None:
             raise ValueError("Please provide the laplacian")
-        HL = H@L
+        HL = (L @ H.T).T
     
     if safe:
         H = np.maximum(H, log_shift)
@@ -323,31 +583,31 @@ def gradH(X, G, W, H, mu=0,  lambda_L=0, L=None, epsilon_reg=1, log_shift=log_sh
 
 
     if l2:
-        D = G @ W
-        grad = D.T @ (D @ H - X)
+        D, DH = get_GWH(G, W, H, cache)
+        grad = D.T @ (DH - X)
     else:
-        D = G @ W
-        DH = D @ H
-        grad =  - D.T @ (X / DH) + np.sum(D, axis=0, keepdims=True).T
+        D, ratio = get_KL_ratio(X, G, W, H, cache)
+        grad =  - Dt_ratio(D, ratio) + np.sum(D, axis=0, keepdims=True).T
 
     if not(np.isscalar(mu) and mu==0):
+        mu = np.asarray(mu, dtype=H.dtype)
         if len(np.shape(mu))==1:
             mu = np.expand_dims(mu, axis=1)
         grad += mu / (H + epsilon_reg)
 
     if not(lambda_L==0):
-        grad += (lambda_L * L @ H.T).T
+        grad += lambda_L * HL
 
     return grad
 # 
-def proj_grad_step_w(X, G, W, H, gamma, simplex_W = True, log_shift=log_shift, safe=True, l2=False, fixed_W = None):
+def proj_grad_step_w(X, G, W, H, gamma, simplex_W = True, log_shift=log_shift, safe=True, l2=False, fixed_W = None, cache=None):
     """Projected gradient step for the variable W."""
 
     if safe:
         H = np.maximum(H, log_shift)
         W = np.maximum(W, log_shift)
 
-    grad = gradW(X, G, W, H, log_shift=log_shift, safe=safe, l2=l2)
+    grad = gradW(X, G, W, H, log_shift=log_shift, safe=safe, l2=l2, cache=cache)
 
     # gradient step
     new_W = W - 1/gamma * grad
@@ -361,20 +621,23 @@ def proj_grad_step_w(X, G, W, H, gamma, simplex_W = True, log_shift=log_shift, s
         raise NotImplementedError("Simplex constraint not implemented for W using the projected gradient method")
     return new_W
 
-def proj_grad_step_h(X, G, W, H, gamma, simplex_H=True, mu=0, log_shift=log_shift, epsilon_reg=1, safe=True, dicotomy_tol=dicotomy_tol, lambda_L=0, L=None, l2=False, fixed_H = None):
-    """Projected gradient step for the variable H."""
+def proj_grad_step_h(X, G, W, H, gamma, simplex_H=True, mu=0, log_shift=log_shift, epsilon_reg=1, safe=True, dicotomy_tol=dicotomy_tol, lambda_L=0, L=None, l2=False, fixed_H = None, cache=None, HL=None):
+    """Projected gradient step for the variable H.
+
+    `HL` (i.e. :math:`HL`) can be provided when H is a block of columns of a larger matrix.
+    """
 
     if safe:
         H = np.maximum(H, log_shift)
         W = np.maximum(W, log_shift)
 
     # gradient step
-    grad = gradH(X, G, W, H, log_shift=log_shift, safe=safe, mu=mu, epsilon_reg=epsilon_reg, lambda_L=lambda_L, L=L, l2=l2)
+    grad = gradH(X, G, W, H, log_shift=log_shift, safe=safe, mu=mu, epsilon_reg=epsilon_reg, lambda_L=lambda_L, L=L, l2=l2, cache=cache, HL=HL)
     new_H = H - 1/gamma * grad
 
-    # Dichotomy
+    # Exact projection on the simplex (dicotomy_tol is not used)
     if simplex_H:
-        nu = dichotomy_simplex_projected_gradient(new_H, log_shift=log_shift, tol=dicotomy_tol)
+        nu = simplex_projected_gradient(new_H, log_shift=log_shift)
     else:
         nu = 0
 
@@ -386,21 +649,30 @@ def proj_grad_step_h(X, G, W, H, gamma, simplex_H=True, mu=0, log_shift=log_shif
     return new_H
 
 def estimate_Lipschitz_bound_w(log_shift, X, G, k):
-    if G is None:
-        G = np.eye(X.shape[0])
-    Wlim = np.ones([G.shape[1], k]) * log_shift
+    m = X.shape[0] if G is None else G.shape[1]
+    Wlim = np.ones([m, k]) * log_shift
     Hlim = np.ones([k, X.shape[1]]) * log_shift
-    D = G @ Wlim
+    D = apply_G(G, Wlim)
+    if sparse.issparse(X):
+        X = X.tocsr()
+        DH = product_at_nonzeros(D, Hlim, X)
+        S = sparse.csr_matrix((np.sum(Hlim, axis=0)[X.indices] * X.data / DH**2, X.indices, X.indptr), shape=X.shape)
+        return np.max(S @ Hlim.T)
     DH = D @ Hlim
     gamma = np.max((np.sum(Hlim,axis=0, keepdims=True) * X/(DH**2))@ Hlim.T)
     return gamma
 
 def estimate_Lipschitz_bound_h(log_shift, X, G, k, lambda_L=0, mu=0, epsilon_reg=1):
-    if G is None:
-        G = np.eye(X.shape[0])
-    Wlim = np.ones([G.shape[1], k]) * log_shift
+    m = X.shape[0] if G is None else G.shape[1]
+    Wlim = np.ones([m, k]) * log_shift
     Hlim = np.ones([k, X.shape[1]]) * log_shift
-    D = G @ Wlim
+    D = apply_G(G, Wlim)
+    if sparse.issparse(X):
+        X = X.tocsr()
+        DH = product_at_nonzeros(D, Hlim, X)
+        rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+        S = sparse.csr_matrix((np.sum(D, axis=1)[rows] * X.data / DH**2, X.indices, X.indptr), shape=X.shape)
+        return np.max(Dt_ratio(D, S)) + 2*lambda_L+mu*epsilon_reg
     DH = D @ Hlim
     
     gamma = np.max(D.T @ (np.sum(D,axis=1, keepdims=True) * X/(DH**2)) ) + 2*lambda_L+mu*epsilon_reg
@@ -7,8 +7,10 @@ It also contains different metrics to evaluate the results.
 import numpy as np
 from espm.conf import log_shift
 import warnings as w
-from itertools import permutations
+from scipy.optimize import linear_sum_assignment
 from sklearn.metrics import r2_score
+from scipy.sparse import issparse
+from espm.utils import product_at_nonzeros
 
 def spectral_angle(v1, v2):
     r"""Spectral angle
@@ -168,16 +170,19 @@ def global_min (matr) :
 def unique_min (matrix) : 
     '''
 
-    From a square matrix of float values, finds the combination of elements with 
-    different lines which mimises the sum of elements.
+    From a matrix of float values, finds the combination of elements with 
+    different lines which mimises the sum of elements, i.e. a different line is assigned to each column.
     
-    It is a brute force algorithm, it is not recommended to input a matrix bigger than 20 x 20
+    The optimal assignment is computed with the Hungarian algorithm (:func:`scipy.optimize.linear_sum_assignment`),
+    in :math:`O(k^3)` operations. The matrix can be rectangular: if it has fewer lines than columns, only as many
+    columns as lines are assigned and the other columns get a NaN value and a None index.
+    NaN entries of the matrix are never chosen unless there is no other possibility.
 
-    :param np.array 2D matrix: square matrix
+    :param np.array 2D matrix: matrix of shape (number of lines, number of columns)
     
-    :returns: list of unique min values and corresponding indices in the same order
+    :returns: list of unique min values and corresponding indices of the lines, in the order of the columns
 
-    :rtype: (list, list[int])
+    :rtype: (list, tuple[int])
 
     Examples
     --------
@@ -185,27 +190,29 @@ def unique_min (matrix) :
     >>> import numpy as np
     >>> from espm.measures import unique_min
     >>> matrix = np.array([[1.2,  1.3,  3.5],
-                        [4.9,  2.2,  6.5],
-                       [9.0,  4.1,  1.8]])
-    >>> unique_min(v1, v2)   
-        ([1.2, 2.2, 1.8], (0, 1, 2))
+    ...                    [4.9,  2.2,  6.5],
+    ...                    [9.0,  4.1,  1.8]])
+    >>> mins, perm = unique_min(matrix)
+    >>> [float(m) for m in mins], perm
+    ([1.2, 2.2, 1.8], (0, 1, 2))
 
     '''
-    shape = matrix.shape[0]
-    perms = list(permutations(range(shape),shape))
-    list_sum_angles = []
-    for perm in perms : 
-        sum_angles = 0
-        for i in range(shape) :
-            sum_angles += matrix[perm[i],i]
-        list_sum_angles.append(sum_angles)
-    
-    min_ind = list_sum_angles.index(min(list_sum_angles))
-    mins = []
-    for i in range(shape) : 
-        mins.append(matrix[perms[min_ind][i],i])
-
-    return mins, perms[min_ind]
+    matrix = np.asarray(matrix)
+    cost = matrix.astype(np.float64)
+    invalid = ~np.isfinite(cost)
+    if np.any(invalid) : 
+        # The invalid entries are replaced by a value larger than any sum of valid entries
+        finite = cost[~invalid]
+        worst = (np.max(np.abs(finite)) + 1) * (min(cost.shape) + 1) if finite.size else 1
+        cost = np.where(invalid, worst, cost)
+    rows, cols = linear_sum_assignment(cost)
+
+    perm = [None] * matrix.shape[1]
+    for row, col in zip(rows, cols) : 
+        perm[col] = int(row)
+    mins = [matrix[row, i] if not(row is None) else np.nan for i, row in enumerate(perm)]
+
+    return mins, tuple(perm)
     
 
 # def unique_min (matr) : 
@@ -284,6 +291,15 @@ def find_min_MSE(true_maps, algo_maps, get_ind = False, unique=False):
     else : 
         return ordered_maps[0]
 
+def _ordered_pairs (true_maps, algo_maps, input_inds) : 
+    # Stacks the matched pairs, the components with an index None (not assigned) are NaN
+    inds = [j for j in input_inds]
+    assigned = np.array([j is not None for j in inds], dtype=bool)
+    true = np.asarray(true_maps)[[j if j is not None else 0 for j in inds]].astype(np.float64)
+    algo = np.asarray(algo_maps)[:len(inds)].astype(np.float64)
+    true[~assigned] = np.nan
+    return true.reshape(len(inds), -1), algo.reshape(len(inds), -1)
+
 def ordered_mse (true_maps, algo_maps, input_inds) :
     '''
     input : p x Npx matrix of floats, p x Npx matrix of floats, list of integers
@@ -293,10 +309,8 @@ def ordered_mse (true_maps, algo_maps, input_inds) :
     indices of the correspondance between true phases and reconstructed phases
     returns the mean squared errors of each phase in truth order.
     '''
-    ordered_maps = []
-    for i,j in enumerate(input_inds) : 
-        ordered_maps.append(float(mse(true_maps[j], algo_maps[i])))
-    return ordered_maps
+    true, algo = _ordered_pairs(true_maps, algo_maps, input_inds)
+    return [float(v) for v in np.mean((true - algo)**2, axis=1)]
 
 def ordered_mae (true_maps, algo_maps, input_inds) :
     '''
@@ -307,10 +321,8 @@ def ordered_mae (true_maps, algo_maps, input_inds) :
     indices of the correspondance between true phases and reconstructed phases
     returns the mean average errors of each phase in truth order.
     '''
-    ordered_maps = []
-    for i,j in enumerate(input_inds) : 
-        ordered_maps.append(float(mae(true_maps[j], algo_maps[i])))
-    return ordered_maps
+    true, algo = _ordered_pairs(true_maps, algo_maps, input_inds)
+    return [float(v) for v in np.mean(np.abs(true - algo), axis=1)]
 
 def ordered_r2(true_maps, algo_maps, input_inds) :
     '''
@@ -321,20 +333,111 @@ def ordered_r2(true_maps, algo_maps, input_inds) :
     indices of the correspondance between true phases and reconstructed phases
     returns the coefficient of determination of each phase in truth order.
     '''
-    ordered_maps = []
-    for i,j in enumerate(input_inds) : 
-        ordered_maps.append(float(r2(true_maps[j], algo_maps[i])))
-    return ordered_maps
-
+    true_maps = np.asarray(true_maps)
+    # Same convention as r2: a map is a set of outputs (columns) over the first axis
+    shape = (len(input_inds), true_maps.shape[1], -1)
+    true, algo = _ordered_pairs(true_maps, algo_maps, input_inds)
+    true, algo = true.reshape(shape), algo.reshape(shape)
+    sse = np.sum((true - algo)**2, axis=1)
+    sst = np.sum((true - np.mean(true, axis=1, keepdims=True))**2, axis=1)
+    return [float(v) for v in np.mean(_r2_score(sse, sst), axis=-1)]
 
 def ordered_angles (true_spectra, algo_spectra, input_inds) :
     '''
     See ordered mse
     '''
-    ordered_angles = []
-    for i,j in enumerate(input_inds) : 
-        ordered_angles.append(spectral_angle(true_spectra[j],algo_spectra[i]))
-    return ordered_angles
+    true, algo = _ordered_pairs(true_spectra, algo_spectra, input_inds)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cos = np.sum(true * algo, axis=1) / np.linalg.norm(true, axis=1) / np.linalg.norm(algo, axis=1)
+    return list(np.arccos(np.clip(cos, -1.0, 1.0)) * 180 / np.pi)
+
+def _r2_score (sse, sst) : 
+    # Coefficient of determination from the sums of squares, with the conventions of sklearn for constant outputs
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(sst > 0, 1 - sse / sst, np.where(sse > 0, 0.0, 1.0))
+
+def pairwise_metrics (true_vectors, algo_vectors, metrics=("angle", "mse", "mae", "r2"), chunk_size=None) : 
+    r'''Compute the metrics between all the pairs of ground truth and NMF components in one pass.
+
+    The components are stacked along the first axis. The arrays are read by chunks of `chunk_size` elements
+    along the second axis (e.g. the pixels of the maps), so that they can be large memory maps. The metrics are:
+
+    * "angle": spectral angle in degrees (see :func:`spectral_angle`),
+    * "mse": mean squared error (see :func:`mse`),
+    * "mae": mean average error (see :func:`mae`),
+    * "r2": coefficient of determination (see :func:`r2`). As in :func:`r2`, a component of shape (N, M) is a set of
+      M outputs and a component of shape (N,) a single output.
+
+    The MSE, the angle and the R² are computed with matrix products, which is fast but can lose some precision for
+    nearly equal components. The MAE requires a pass over all the pairs.
+
+    :param np.array true_vectors: true components, array of shape (number of true phases, N, ...)
+    :param np.array algo_vectors: NMF components, array of shape (number of NMF phases, N, ...)
+    :param tuple metrics: names of the metrics to compute
+    :param int chunk_size: number of elements of the second axis per chunk (default: chosen to keep the temporaries small)
+
+    :returns: dictionary of the metrics, arrays of shape (number of true phases, number of NMF phases)
+    :rtype: dict
+
+    Examples
+    --------
+
+    >>> import numpy as np
+    >>> from espm.measures import pairwise_metrics
+    >>> true_maps, algo_maps = np.random.rand(3, 100), np.random.rand(4, 100)
+    >>> metrics = pairwise_metrics(true_maps, algo_maps, metrics=("mse", "r2"))
+    >>> metrics["mse"].shape
+    (3, 4)
+
+    '''
+    metrics = tuple(metrics)
+    unknown = set(metrics) - {"angle", "mse", "mae", "r2"}
+    if unknown : 
+        raise ValueError("Unknown metrics: {}".format(sorted(unknown)))
+    if true_vectors.shape[1:] != algo_vectors.shape[1:] : 
+        raise ValueError("The components of true_vectors and algo_vectors should have the same shape.")
+    kt, ka = true_vectors.shape[0], algo_vectors.shape[0]
+    rows = true_vectors.shape[1]
+    cols = int(np.prod(true_vectors.shape[2:]))
+    if chunk_size is None : 
+        if "mae" in metrics : 
+            chunk_size = max(1, 2**22 // (kt * ka * cols))
+        else : 
+            chunk_size = max(1, 2**24 // ((kt + ka) * cols))
+
+    tt = np.zeros((kt, cols))
+    aa = np.zeros((ka, cols))
+    ta = np.zeros((cols, kt, ka))
+    t_sum = np.zeros((kt, cols))
+    abs_sum = np.zeros((kt, ka))
+    for start in range(0, rows, chunk_size) : 
+        stop = min(start + chunk_size, rows)
+        t = np.asarray(true_vectors[:, start:stop], dtype=np.float64).reshape(kt, stop - start, cols)
+        a = np.asarray(algo_vectors[:, start:stop], dtype=np.float64).reshape(ka, stop - start, cols)
+        tt += np.sum(t**2, axis=1)
+        aa += np.sum(a**2, axis=1)
+        # One matrix product per output
+        ta += np.matmul(t.transpose(2, 0, 1), a.transpose(2, 1, 0))
+        t_sum += np.sum(t, axis=1)
+        if "mae" in metrics : 
+            abs_sum += np.sum(np.abs(t[:, np.newaxis] - a[np.newaxis]), axis=(2, 3))
+
+    n = rows * cols
+    dot = np.sum(ta, axis=0)
+    out = {}
+    if "angle" in metrics : 
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cos = dot / np.sqrt(np.sum(tt, axis=1))[:, np.newaxis] / np.sqrt(np.sum(aa, axis=1))[np.newaxis, :]
+        out["angle"] = np.arccos(np.clip(cos, -1.0, 1.0)) * 180 / np.pi
+    if "mse" in metrics : 
+        out["mse"] = np.maximum(np.sum(tt, axis=1)[:, np.newaxis] + np.sum(aa, axis=1)[np.newaxis, :] - 2 * dot, 0) / n
+    if "mae" in metrics : 
+        out["mae"] = abs_sum / n
+    if "r2" in metrics : 
+        sse = np.maximum(tt[:, np.newaxis, :] + aa[np.newaxis, :, :] - 2 * ta.transpose(1, 2, 0), 0)
+        sst = np.maximum(tt - t_sum**2 / rows, 0)[:, np.newaxis, :]
+        out["r2"] = np.mean(_r2_score(sse, sst), axis=-1)
+    return out
 
 
 # This function gives the residuals between the model determined by snmf and the data that were fitted
@@ -453,7 +556,7 @@ def KL(X, Y, log_shift=log_shift, average=False):
         x_log = np.sum(X*np.log(X)) - np.sum(X*np.log(Y))
     return x_lin + x_log
 
-def KLdiv_loss(X, W, H, log_shift=log_shift, average=False):
+def KLdiv_loss(X, W, H, log_shift=log_shift, average=False, WH=None, buffer=None):
     r""" Generalized Generalized KL (Kullback–Leibler) divergence loss
 
     Compute the loss based on the generalized KL divergence given :math: `X,W,H`:
@@ -471,6 +574,14 @@ def KLdiv_loss(X, W, H, log_shift=log_shift, average=False):
         not explode (default value set in module :mod:`esppy.conf`)
     :param boolean average: replace the sum with a mean, i.e.,
         divide the result by n*m (default False)
+    :param np.array 2D WH: precomputed product W @ H (optional). It is used instead of
+        computing the product again. The caller has to ensure that W and H are larger than log_shift.
+    :param np.array 3D buffer: scratch buffer of shape (2, b, m) (optional). If provided, the loss is
+        computed by blocks of b rows written into the buffer, so that no n x m temporary is allocated.
+
+    X can also be a scipy sparse matrix. In that case, the log term is only evaluated at the nonzero
+    entries of X and WH, if provided, contains the entries of W @ H at these nonzeros (in the order of
+    the CSR data of X). The zeros of X are not clipped to log_shift in this case.
 
     :returns: the answer
 
@@ -490,17 +601,58 @@ def KLdiv_loss(X, W, H, log_shift=log_shift, average=False):
         2.921251732961556
     """
 
+    if issparse(X):
+        return _KLdiv_loss_sparse(X, W, H, log_shift, average, WH)
+    if buffer is not None:
+        return _KLdiv_loss_blocks(X, W, H, log_shift, average, WH, buffer)
+
+    X = np.maximum(X, log_shift)
+    if WH is None:
+        W = np.maximum(W, log_shift)
+        H = np.maximum(H, log_shift)
+        Y = W @ H
+    else:
+        Y = WH
+    if average:
+        x_lin = np.mean(Y, dtype=np.float64)
+        x_log = np.mean(X*np.log(Y), dtype=np.float64)
+    else:
+        x_lin = np.sum(Y, dtype=np.float64)
+        x_log = np.sum(X*np.log(Y), dtype=np.float64)
+    return x_lin - x_log
+
+def _KLdiv_loss_sparse(X, W, H, log_shift, average, WH):
+    # Same as KLdiv_loss, the sum of W @ H is computed from the sums of W and H
+    X = X.tocsr()
     W = np.maximum(W, log_shift)
     H = np.maximum(H, log_shift)
-    X = np.maximum(X, log_shift)
+    if WH is None:
+        WH = product_at_nonzeros(W, H, X)
+    x_lin = np.sum(W, axis=0, dtype=np.float64) @ np.sum(H, axis=1, dtype=np.float64)
+    x_log = np.sum(np.maximum(X.data, log_shift) * np.log(WH), dtype=np.float64)
+    if average:
+        return (x_lin - x_log) / (X.shape[0] * X.shape[1])
+    return x_lin - x_log
 
-    Y = W @ H
+def _KLdiv_loss_blocks(X, W, H, log_shift, average, WH, buffer):
+    # Same as KLdiv_loss, but computed by blocks of rows in the preallocated buffer
+    if WH is None:
+        W = np.maximum(W, log_shift)
+        H = np.maximum(H, log_shift)
+    b = buffer.shape[1]
+    x_lin, x_log = 0, 0
+    for start in range(0, X.shape[0], b):
+        stop = min(start + b, X.shape[0])
+        Xb = np.maximum(X[start:stop], log_shift, out=buffer[0, :stop-start])
+        if WH is None:
+            Yb = np.matmul(W[start:stop], H, out=buffer[1, :stop-start])
+        else:
+            Yb = WH[start:stop]
+        x_lin += np.sum(Yb, dtype=np.float64)
+        logYb = np.log(Yb, out=buffer[1, :stop-start])
+        x_log += np.sum(np.multiply(Xb, logYb, out=logYb), dtype=np.float64)
     if average:
-        x_lin = np.mean(Y)
-        x_log = np.mean(X*np.log(Y))        
-    else:
-        x_lin = np.sum(Y)
-        x_log = np.sum(X*np.log(Y))
+        return (x_lin - x_log) / X.size
     return x_lin - x_log
 
 def KL_loss_surrogate(X, W, H, Ht, log_shift=log_shift, average=False):
@@ -593,9 +745,9 @@ def squared_distance(x, y=None):
     --------
     
     >>> import numpy as np
-    >>> from espm.measures import square_distance
+    >>> from espm.measures import squared_distance
     >>> x = np.arange(3)
-    >>> square_distance(x, x)
+    >>> squared_distance(x, x)
         array([[ 0.,  1.,  2.],
         [ 1.,  0.,  1.],
         [ 2.,  1.,  0.]])
@@ -622,7 +774,7 @@ def squared_distance(x, y=None):
     xx = (x * x).sum(axis=1)
     yy = (y * y).sum(axis=1)
     xy = np.dot(x, y.T)    
-    d = abs(np.kron(np.ones((ry, 1)), xx).T +np.kron(np.ones((rx, 1)), yy) - 2 * xy)    
+    d = abs(xx[:, np.newaxis] + yy[np.newaxis, :] - 2 * xy)    
     
     return d / cx
 
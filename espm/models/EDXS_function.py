@@ -16,6 +16,7 @@ from espm.conf import SYMBOLS_PERIODIC_TABLE
 import json
 
 from espm.utils import number_to_symbol_list
+from espm.models.xrays_db import XraysDB
     
 def gaussian(x, mu, sigma):
     r"""
@@ -63,6 +64,9 @@ def read_lines_db (elt,db_dict) :
     cross-sections : 
         :list float: List of emission cross-sections of each line of the given element
     """
+    if isinstance(db_dict, XraysDB) : 
+        energies, cs = db_dict.arrays(elt)
+        return energies.tolist(), cs.tolist()
     energies = []
     cs = []
     for line in db_dict[str(elt)] : 
@@ -88,6 +92,9 @@ def read_compact_db (elt,db_dict) :
     cross-sections : 
         :list float: List of emission cross-sections of each line of the given element
     """
+    if isinstance(db_dict, XraysDB) : 
+        energies, cs = db_dict.arrays(elt)
+        return energies.tolist(), cs.tolist()
     energies = db_dict[str(elt)]["energies"]
     cs = db_dict[str(elt)]["cs"] 
     return energies, cs
@@ -12,6 +12,74 @@ from espm.conf import HSPY_MAC
 import numpy as np
 from pathlib import Path
 from espm.conf import DB_PATH
+import threading
+
+# Process-wide cache of the interpolators of the physics tables
+_interpolators = {}
+_interpolators_lock = threading.Lock()
+
+def clear_interpolator_cache () : 
+    r"""
+    Empty the cache of the interpolators of the mass-absorption coefficients and of the detection efficiency curves.
+    It is called by :func:`espm.tables_utils.save_table`. The cache of a curve file is also invalidated when the file is modified.
+    """
+    with _interpolators_lock : 
+        _interpolators.clear()
+
+def _cached_interpolator (key, build) : 
+    with _interpolators_lock : 
+        interp_func = _interpolators.get(key)
+    if interp_func is None : 
+        interp_func = build()
+        with _interpolators_lock : 
+            _interpolators[key] = interp_func
+    return interp_func
+
+def mass_absorption_interpolator (element, kind = "cubic") : 
+    r"""
+    Return the (cached) interpolator of the mass-absorption coefficient of an element, as a function of the energy in keV.
+
+    Parameters
+    ----------
+    element :
+        :string: Chemical symbol of the element.
+    kind :
+        :string: Polynomial order of the interpolation.
+
+    Returns
+    -------
+    interpolator
+        :scipy.interpolate.interp1d: Interpolator of the mass-absorption coefficient (cm2/g).
+    """
+    def build() : 
+        x_db = HSPY_MAC[element]["energies (keV)"]
+        y_db = HSPY_MAC[element]["mass_absorption_coefficient (cm2/g)"]
+        return interp1d(x_db,y_db,kind=kind)
+    return _cached_interpolator(("mac", element, kind), build)
+
+def efficiency_curve_interpolator (filename, kind = "cubic") : 
+    r"""
+    Return the (cached) interpolator of a detection efficiency curve that is stored in ~/espm/tables.
+    The interpolator is built again if the file was modified.
+
+    Parameters
+    ----------
+    filename: 
+        :string: Name of the file of the detection efficiency.
+    kind :
+        :string: Polynomial order of the interpolation.
+
+    Returns
+    -------
+    interpolator
+        :scipy.interpolate.interp1d: Interpolator of the detection efficiency.
+    """
+    path = DB_PATH / Path(filename)
+    def build() : 
+        array = np.loadtxt(path)
+        x_curve,y_curve = array[:,0], array[:,1]
+        return interp1d(x_curve,y_curve,kind = kind)
+    return _cached_interpolator(("curve", str(path), kind, path.stat().st_mtime_ns), build)
 
 @number_to_symbol_dict
 def absorption_coefficient (x,atomic_fraction = False,*,elements_dict = {"Si" : 1.0}) : 
@@ -43,9 +111,7 @@ def absorption_coefficient (x,atomic_fraction = False,*,elements_dict = {"Si" :
     sum_elts = sum(elements_dict.values())
     
     for key in elements_dict.keys() : 
-        x_db = HSPY_MAC[key]["energies (keV)"]
-        y_db = HSPY_MAC[key]["mass_absorption_coefficient (cm2/g)"]
-        interp_func = interp1d(x_db,y_db,kind="cubic")
+        interp_func = mass_absorption_interpolator(key, kind="cubic")
         mu += elements_dict[key]*interp_func(x)/sum_elts
 
     if len(elements_dict.keys()) == 0 :
@@ -85,10 +151,31 @@ def absorption_correction (x,thickness = 100e-7,toa = 90,density = None,atomic_f
         :np.array 1D: Calculated value of the absorption correction on all the energy range.
     """
     mu = absorption_coefficient(x,atomic_fraction,elements_dict = elements_dict)
-    rad_toa = np.deg2rad(toa)
     if density is None : 
         density = approx_density(atomic_fraction,elements_dict = elements_dict)
-    
+    return absorption_correction_from_mu(mu, thickness, toa, density)
+
+def absorption_correction_from_mu (mu, thickness, toa, density) : 
+    r"""
+    Calculate the absorption correction of :func:`absorption_correction` from precomputed mass-absorption coefficients.
+
+    Parameters
+    ----------
+    mu :
+        :np.array 1D: Mass-absorption coefficient, see :func:`absorption_coefficient`.
+    thickness : 
+        :float: Thickness of the material slab in meter. If the thickness is set to 0.0, the function will return 1.0.
+    toa :
+        :float: Take-off angle in degrees of the x-rays travelling from the sample to the x-ray detectors.
+    density : 
+        :float: Density of the material in g/m3 (to be checked).
+
+    Returns
+    -------
+    absorption correction
+        :np.array 1D: Calculated value of the absorption correction on all the energy range.
+    """
+    rad_toa = np.deg2rad(toa)
     if thickness == 0 : 
         return 1.0
     else : 
@@ -147,9 +234,7 @@ def det_efficiency_from_curve (x,filename,kind = "cubic") :
     Detection efficiency
         :np.array 1D: Interpolated detection efficiency.
     """
-    array = np.loadtxt(DB_PATH / Path(filename))
-    x_curve,y_curve = array[:,0], array[:,1]
-    interp_func = interp1d(x_curve,y_curve,kind = kind)
+    interp_func = efficiency_curve_interpolator(filename, kind = kind)
     return interp_func(x)
 
 def det_efficiency_layer (x, thickness = 100e-7, density = None, atomic_fraction = False, *, elements_dict = {"Si" : 1.0}) : 
@@ -7,9 +7,7 @@ The ToyModel can be used for testing data analysis algorithms.
 """
 
 from abc import ABC, abstractmethod
-from pathlib import Path
-import json
-import espm.conf as conf
+from espm.models.xrays_db import load_xrays_db
 import numpy as np
 from typing import Optional
 
@@ -168,12 +166,9 @@ class PhysicalModel(Model) :
         Returns
         -------
         data
-            :dict: A dictionnary containing the cross-sections in the database
+            :XraysDB: A read-only dictionnary containing the cross-sections in the database (see :class:`espm.models.xrays_db.XraysDB`)
         """
-        db_path = conf.DB_PATH / Path(db_name)
-        with open(db_path,"r") as f :
-            json_dict = json.load(f)
-        return json_dict["table"]
+        return load_xrays_db(db_name)
 
     def extract_DB_mdata (self,db_name) :
         r"""
@@ -189,10 +184,7 @@ class PhysicalModel(Model) :
         data
             :dict: A dictionnary containing the metadata related to the database
         """
-        db_path = conf.DB_PATH / Path(db_name)
-        with open(db_path,"r") as f :
-            json_dict = json.load(f)
-        return json_dict["metadata"]
+        return dict(load_xrays_db(db_name).metadata)
 
     def build_energy_scale(self,e_offset, e_size, e_scale) :
         r"""
@@ -234,7 +226,7 @@ class PhysicalModel(Model) :
         return W
 
     @abstractmethod
-    def NMF_update (self, W = None) :
+    def NMF_update (self, W = None, G = None) :
         """
         Function to be called when during the NMF optimization. It returns the matrix G, updated if necessary. It should be run in between each W iteration.
         You do not need to implement it, if you do not need to update the matrix G during the optimization.
@@ -243,6 +235,8 @@ class PhysicalModel(Model) :
         ----------
         W : 
             :np.array 2D: The part of the matrix W that is required to update the matrix G.
+        G :
+            :np.array 2D: The copy of the matrix G used by the estimator, which may be updated in place. If None, the matrix G of the model is updated.
 
         Returns
         -------
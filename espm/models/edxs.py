@@ -11,10 +11,22 @@ The :mod:`espm.models.edxs` module implements the creation of the G matrix that
 import numpy as np
 import re
 from espm.models import PhysicalModel
-from espm.models.EDXS_function import G_bremsstrahlung, continuum_xrays, gaussian, read_lines_db, read_compact_db, elts_dict_from_dict_list
+from espm.models.EDXS_function import G_bremsstrahlung, gaussian, read_lines_db, read_compact_db, elts_dict_from_dict_list, lifshin_bremsstrahlung_b0, lifshin_bremsstrahlung_b1
+from espm.models.xrays_db import XraysDB
 from espm.conf import DEFAULT_EDXS_PARAMS
-from espm.utils import arg_helper, symbol_to_number_dict, symbol_to_number_list
-from espm.models.absorption_edxs import absorption_correction, det_efficiency, det_efficiency_from_curve, absorption_mass_thickness
+from espm.utils import BlockSparseG, dense_G, arg_helper, symbol_to_number_dict, symbol_to_number_list, approx_density, number_to_symbol_dict, atomic_to_weight_dict
+from espm.models.absorption_edxs import absorption_correction, det_efficiency, det_efficiency_from_curve, absorption_mass_thickness, absorption_coefficient, absorption_correction_from_mu
+
+@number_to_symbol_dict
+def _symbols(*, elements_dict = {}) : 
+    # Chemical symbols of the keys of a composition, in the order of the input
+    return list(elements_dict.keys())
+
+@symbol_to_number_dict
+def _numbers(*, elements_dict = {}) : 
+    # Atomic numbers of the keys of a composition, in the order of the input
+    return list(elements_dict.keys())
+
 # Class to model the EDXS spectra. This is a temporary version since there are some design issues.
 
 
@@ -45,70 +57,74 @@ class EDXS(PhysicalModel):
         self.norm = 1.0
         self.model_elts = []
         self.custom_init = custom_init
-
-    def __add_elts_G(self, reference_elt = {}, *, elements=[]):
+        self._brstlg_basis = None
+
+    def __read_db(self, elt):
+        # Energies and cross-sections of the lines of an element as arrays
+        if isinstance(self.db_dict, XraysDB) : 
+            return self.db_dict.arrays(elt)
+        if self.lines : 
+            energies, cs = read_lines_db(elt,self.db_dict)
+        else : 
+            energies, cs = read_compact_db(elt,self.db_dict)
+        return np.asarray(energies, dtype=float), np.asarray(cs, dtype=float)
+
+    def __read_lines(self, elements):
+        # Energies, cross-sections, absorption and detection efficiency of all the lines of the energy range, with the
+        # index of their element in the list
+        x_min, x_max = np.min(self.x), np.max(self.x)
+        energies, cs, absorption, indices = [], [], [], []
+        for i, elt in enumerate(elements):
+            energies_elt, cs_elt = self.__read_db(elt)
+            in_range = (energies_elt > x_min) & (energies_elt < x_max)
+            energies_elt, cs_elt = energies_elt[in_range], cs_elt[in_range]
+            # The absorption depends on the element, it is computed for all its lines at once
+            A = absorption_correction(energies_elt,**self.params_dict["Abs"],elements_dict = {elt : 1.0})
+            absorption.append(np.broadcast_to(A, energies_elt.shape))
+            indices.append(np.full(energies_elt.shape, i))
+            energies.append(energies_elt)
+            cs.append(cs_elt)
+        energies, cs, absorption, indices = [np.concatenate(a) for a in (energies, cs, absorption, indices)]
+
+        if type(self.params_dict["Det"]) == str : 
+            D = det_efficiency_from_curve(energies,self.params_dict["Det"])
+        else : 
+            D = det_efficiency(energies,self.params_dict["Det"])
+        return energies, cs, absorption, indices, D
+
+    def __add_elts_G(self, reference_elt = {}, sigma_cutoff = None, *, elements=[]):
+        # All the lines of the energy range are gathered in arrays. Each line is assigned to a column of G
+        # (or to the _lo or _hi column of the split elements). With a sigma_cutoff, the gaussians are set to zero
+        # further than sigma_cutoff standard deviations from their line.
+        energies, cs, absorption, indices, D = self.__read_lines(elements)
+        first_columns, elts_columns = [], []
+        n_columns = 0
         for elt in elements:
-            if self.lines : 
-                energies, cs = read_lines_db(elt,self.db_dict)
-            else : 
-                energies, cs = read_compact_db(elt,self.db_dict)
+            first_columns.append(n_columns)
             if elt in reference_elt : 
-                peaks_low = np.zeros((self.x.shape[0], 1))
-                peaks_high = np.zeros((self.x.shape[0], 1))
-                for i, energy in enumerate(energies):
-                    if (energy > np.min(self.x)) and (energy < np.max(self.x)):
-                            
-                        if type(self.params_dict["Det"]) == str : 
-                            D = det_efficiency_from_curve(energy,self.params_dict["Det"])
-                        else : 
-                            D = det_efficiency(energy,self.params_dict["Det"])
-
-                        A = absorption_correction(energy,**self.params_dict["Abs"],elements_dict = {elt : 1.0})
-                        
-                        width = self.width_slope * energy + self.width_intercept
-                        if energy < reference_elt[elt] : 
-                            peaks_low += (
-                                cs[i]
-                                * gaussian(self.x, energy, width / 2.3548)[
-                                    np.newaxis
-                                ].T
-                            )*D*A
-                        else : 
-                            peaks_high += (
-                                cs[i]
-                                * gaussian(self.x, energy, width / 2.3548)[
-                                    np.newaxis
-                                ].T
-                            )*D*A
-                peaks = np.hstack((peaks_low,peaks_high))
+                elts_columns.append([n_columns, n_columns + 1])
+                n_columns += 2
             else : 
-                peaks = np.zeros((self.x.shape[0], 1))
-                for i, energy in enumerate(energies):
-                    
-                    # The actual detected width is calculated at each energy
-                    if (energy > np.min(self.x)) and (energy < np.max(self.x)):
-                        
-                        if type(self.params_dict["Det"]) == str : 
-                            D = det_efficiency_from_curve(energy,self.params_dict["Det"])
-                        else : 
-                            D = det_efficiency(energy,self.params_dict["Det"])
-
-                        A = absorption_correction(energy,**self.params_dict["Abs"],elements_dict = {elt : 1.0})
-                        
-                        width = self.width_slope * energy + self.width_intercept
-                        
-
-                        peaks += (
-                            cs[i]
-                            * gaussian(self.x, energy, width / 2.3548)[
-                                np.newaxis
-                            ].T
-                        )*D*A
-        
+                elts_columns.append([n_columns])
+                n_columns += 1
+        columns = np.array(first_columns, dtype=int)[indices]
+        for i, elt in enumerate(elements):
+            if elt in reference_elt : 
+                columns[indices == i] += (energies[indices == i] >= reference_elt[elt])
+
+        # One gaussian per line, the lines are then summed in their column in the order of the database
+        width = self.width_slope * energies + self.width_intercept
+        peaks = (cs[:, np.newaxis] * gaussian(self.x[np.newaxis, :], energies[:, np.newaxis], width[:, np.newaxis] / 2.3548)) * D[:, np.newaxis] * absorption[:, np.newaxis]
+        if sigma_cutoff is not None : 
+            peaks[np.abs(self.x[np.newaxis, :] - energies[:, np.newaxis]) > sigma_cutoff * width[:, np.newaxis] / 2.3548] = 0.0
+        G_elts = np.zeros((n_columns, self.x.shape[0]))
+        np.add.at(G_elts, columns, peaks)
+
+        for elt, elt_columns in zip(elements, elts_columns):
+            peaks = G_elts[elt_columns].T
             print(np.max(peaks, axis = 0))
             print(str(elt))
             if np.all((np.max(peaks, axis = 0)) > 0.0):
-                self.G = np.concatenate((self.G, peaks), axis=1)
                 if elt in reference_elt : 
                     self.model_elts.append(str(elt)+'_lo')
                     self.model_elts.append(str(elt)+'_hi')
@@ -117,10 +133,11 @@ class EDXS(PhysicalModel):
             else : 
                 print("The energy split of the element : {} leads to empty G columns. Please remove split or change its energy.".format(elt))
                 raise ValueError("Empty G column")           
+        self.G = np.concatenate((self.G, G_elts.T), axis=1)
 
     @symbol_to_number_list
     @symbol_to_number_dict
-    def generate_g_matr(self, g_type="bremsstrahlung",*,elements=[],elements_dict = {},**kwargs):
+    def generate_g_matr(self, g_type="bremsstrahlung",*,elements=[],elements_dict = {},sparse = False,sigma_cutoff = 5.0,**kwargs):
         r"""
         Generate the G matrix. With a complete model the matrix is (e_size,n+2). The first n columns correspond to the sum of X-ray characteristic peaks associated to each shell of the elements. The last 2 columns correspond to a bremsstrahlung model. 
         
@@ -150,11 +167,15 @@ class EDXS(PhysicalModel):
             :dict: The keys are chemical elements (atomic number) and the values are cut-off energies. This argument is used to split some of the columns of G into 2 columns. The first column corresponds to characteristic X-rays before the cut-off and second one corresponds to characteristic X-rays before the cut-off. This feature is implemented to enable more accurate absorption correction.
         elements : 
             :list: List of modeled chemical elements. The list can be populated either with atomic numbers or chemical symbols, e.g. "Fe" or 26.
+        sparse : 
+            :bool: If True, the gaussians of the characteristic X-rays are truncated at `sigma_cutoff` standard deviations from their line and G is stored as a :class:`espm.utils.BlockSparseG`: the characteristic X-rays columns are a sparse matrix, the bremsstrahlung columns are dense. The estimators of :mod:`espm.estimators` use it directly.
+        sigma_cutoff : 
+            :float: Number of standard deviations of the gaussians kept when `sparse` is True.
 
         Returns
         -------
         g matrix :
-            :np.array 2D: matrix of the edx model. 
+            :np.array 2D or BlockSparseG: matrix of the edx model. 
 
         Notes
         -----
@@ -163,6 +184,7 @@ class EDXS(PhysicalModel):
         
         # Reset the internally stored elements list
         self.model_elts = []
+        self._brstlg_basis = None
 
         valid_elts = self.__check_elts_in_G(elements)
         print('Input elements')
@@ -187,7 +209,7 @@ class EDXS(PhysicalModel):
             # The number of shells depend on the element, it is then not straightforward to pre-determine the size of g_matr
             self.G = np.zeros((self.x.shape[0], 0))
             # For each element we unpack all shells and then unpack all lines of each shell.
-            self.__add_elts_G(reference_elt = elements_dict, elements = valid_elts)
+            self.__add_elts_G(reference_elt = elements_dict, sigma_cutoff = sigma_cutoff if sparse else None, elements = valid_elts)
             
             # Appends a pure continuum spectrum is needed
             if self.bkgd_in_G:
@@ -206,28 +228,43 @@ class EDXS(PhysicalModel):
                 norms[0] = np.mean(norms[0])
             self.norm = norms
             self.G /= self.norm
-        else : 
+            if sparse : 
+                self.G = BlockSparseG.from_dense(self.G, 2 if self.bkgd_in_G else 0)
+        else :
             print("g_type has to be one of those : \"bremsstrahlung\", \"no_brstlg\" or \"identity\". G will be None, corresponding to \"identity\". ")
-    
+
+    def set_G(self, G, norm, model_elts, bkgd_in_G) :
+        r"""
+        Set a G matrix previously built by :meth:`generate_g_matr` with the same model parameters, e.g. from the cache of :mod:`espm.models.g_cache`.
+
+        Parameters
+        ----------
+        G :
+            :np.array 2D: The G matrix.
+        norm :
+            :np.array 2D: Normalisation of the columns of G (the attribute `norm` after :meth:`generate_g_matr`).
+        model_elts :
+            :list: Names of the columns of G (the attribute `model_elts` after :meth:`generate_g_matr`).
+        bkgd_in_G :
+            :bool: Whether the last two columns of G are the bremsstrahlung.
+        """
+        self.G = G
+        self.norm = norm
+        self.model_elts = list(model_elts)
+        self.bkgd_in_G = bkgd_in_G
+        self._brstlg_basis = None
+
     def __check_elts_in_G(self, elements):
         """
         Check if the elements of the metadata are in the range of the energy axis.
         """
         valid_elts = []
+        energy_range = [np.min(self.x), np.max(self.x)]
         for elt in elements:
-            if self.lines : 
-                energies, cs = read_lines_db(elt,self.db_dict)
-            else : 
-                energies, cs = read_compact_db(elt,self.db_dict)
-
-            energy_range = [np.min(self.x), np.max(self.x)]
-            found = 0
-            for energy in energies:
-                if (energy > energy_range[0]) and (energy < energy_range[1]):
-                    valid_elts.append(elt)
-                    found = 1
-                    break
-            if not found:
+            energies, _ = self.__read_db(elt)
+            if np.any((energies > energy_range[0]) & (energies < energy_range[1])):
+                valid_elts.append(elt)
+            else:
                 print("No peak is present in the energy range for element : {}".format(elt))
         return valid_elts
     
@@ -249,12 +286,12 @@ class EDXS(PhysicalModel):
         -----
         The absorption correction is done using the average composition of the phases. The same correction is used for each phase.
         """
-        self.phases = []
         unique_elts = dict(elts_dict_from_dict_list([x["elements_dict"] for x in phases_parameters]))
-        for p in phases_parameters:
-            # p.update({"elements_dict" : unique_elts})
-            self.phases.append(self.generate_spectrum(**p,abs_elts_dict = unique_elts))
-        self.phases = np.array(self.phases)
+        self.phases = self.generate_spectra([p["elements_dict"] for p in phases_parameters],
+                                            b0 = [p.get("b0", 0) for p in phases_parameters],
+                                            b1 = [p.get("b1", 0) for p in phases_parameters],
+                                            scale = [p.get("scale", 1.0) for p in phases_parameters],
+                                            abs_elts_dict = unique_elts)
         self.phases /= self.phases.sum(axis = 1)[:,np.newaxis]
 
     @symbol_to_number_dict
@@ -298,34 +335,105 @@ class EDXS(PhysicalModel):
         -----
         Check EDXS_function for details about the bremsstrahlung model.
         """
-        temp = np.zeros_like(self.x)
-        for elt in elements_dict.keys():
-            if self.lines : 
-                energies, cs = read_lines_db(elt,self.db_dict)
-            else : 
-                energies, cs = read_compact_db(elt,self.db_dict)
-            for i, energy in enumerate(energies):
-                if (energy > np.min(self.x)) and (energy < np.max(self.x)):
-                    if type(self.params_dict["Det"]) == str : 
-                        D = det_efficiency_from_curve(energy,self.params_dict["Det"])
-                    else : 
-                        D = det_efficiency(energy,self.params_dict["Det"])
-                    A = absorption_correction(energy,**self.params_dict["Abs"],elements_dict = {elt : 1.0})
-                
-                    width = self.width_slope * energy + self.width_intercept
-                    temp += (
-                        elements_dict[elt]
-                        * cs[i]
-                        * gaussian(self.x, energy, width / 2.3548)
-                    )*A*D
-        temp /= temp.sum()
-        if abs_elts_dict == {} : 
-            temp += continuum_xrays(self.x,self.params_dict,b0,b1,self.E0,elements_dict=elements_dict) * scale
+        return self.generate_spectra([elements_dict], b0, b1, scale, abs_elts_dict)[0]
+
+    def generate_spectra(self, compositions, b0 = 0, b1 = 0, scale = 1.0, abs_elts_dict = {}, elements = None) : 
+        r"""
+        Generate a series of spectra from chemical compositions and bremsstrahlung parameters, with the same model as :meth:`generate_spectrum`.
+
+        The characteristic X-rays of each element are computed once on the energy axis, the spectra are then obtained with a matrix
+        product with the compositions. The absorption of the continuum X-rays is computed once if `abs_elts_dict` is given, otherwise
+        it is computed for each composition from the mass-absorption coefficients of the elements.
+
+        Parameters
+        ----------
+        compositions : 
+            :list or np.array 2D: List of dictionnaries of elements and associated concentrations (as the argument elements_dict of :meth:`generate_spectrum`), or array of shape (n_spectra, n_elements) of the concentrations of `elements`.
+        b0 : 
+            :float or np.array 1D: First bremsstrahlung parameter, for all the spectra or for each of them.
+        b1 : 
+            :float or np.array 1D: Second bremsstrahlung parameter, for all the spectra or for each of them.
+        scale : 
+            :float or np.array 1D: Scale factor to apply to the bremsstrahlung, for all the spectra or for each of them.
+        abs_elts_dict : 
+            :dict: Dictionnary of elements and associated concentrations used to calculate the absorption of the continuum X-rays of all the spectra. If empty, the composition of each spectrum is used.
+        elements : 
+            :list: Elements (atomic numbers or chemical symbols) of the columns of `compositions` when it is an array.
+
+        Returns
+        -------
+        spectra : 
+            :np.array 2D: Array of shape (n_spectra, e_size) of the modelled spectra.
+
+        Examples
+        --------
+        >>> from espm.models.edxs import EDXS
+        >>> from espm.conf import DEFAULT_EDXS_PARAMS
+        >>> model = EDXS(**DEFAULT_EDXS_PARAMS)
+        >>> spectra = model.generate_spectra([{"Si" : 1.0, "O" : 2.0}, {"Fe" : 1.0}], b0 = [5e-5, 1e-4], b1 = 2e-3)
+        >>> spectra.shape
+        (2, 1980)
+        """
+        if elements is None : 
+            elements = list(dict.fromkeys(key for composition in compositions for key in composition))
+            C = np.array([[composition.get(elt, 0.0) for elt in elements] for composition in compositions], dtype=float)
         else : 
-            temp += continuum_xrays(self.x,self.params_dict,b0,b1,self.E0,elements_dict=abs_elts_dict) * scale
-        
-        return temp
-    
+            C = np.atleast_2d(np.asarray(compositions, dtype=float))
+            if C.shape[1] != len(elements) : 
+                raise ValueError("compositions should have one column per element.")
+        # The same element may be given with its symbol and its atomic number
+        numbers = [_numbers(elements_dict = {elt : None})[0] for elt in elements]
+        unique_numbers = list(dict.fromkeys(numbers))
+        C = C @ (np.array(numbers)[:, np.newaxis] == np.array(unique_numbers)[np.newaxis, :])
+        n_spectra = C.shape[0]
+
+        # Characteristic X-rays of each element, normalised for each spectrum
+        energies, cs, absorption, indices, D = self.__read_lines(unique_numbers)
+        width = self.width_slope * energies + self.width_intercept
+        peaks = (cs[:, np.newaxis] * gaussian(self.x[np.newaxis, :], energies[:, np.newaxis], width[:, np.newaxis] / 2.3548)) * D[:, np.newaxis] * absorption[:, np.newaxis]
+        basis = np.zeros((len(unique_numbers), self.x.shape[0]))
+        np.add.at(basis, indices, peaks)
+        spectra = C @ basis
+        spectra /= spectra.sum(axis = 1, keepdims = True)
+
+        if len(self.params_dict) == 0 : 
+            return spectra
+
+        # Continuum X-rays: the bremsstrahlung is linear in b0 and b1
+        if type(self.params_dict["Det"]) == str : 
+            D = det_efficiency_from_curve(self.x,self.params_dict["Det"])
+        else : 
+            D = det_efficiency(self.x,self.params_dict["Det"])
+        b0, b1, scale = [np.broadcast_to(np.asarray(v, dtype=float), (n_spectra,))[:, np.newaxis] for v in (b0, b1, scale)]
+        B = (b0 * lifshin_bremsstrahlung_b0(self.x, b0 = 1, E0 = self.E0) + b1 * lifshin_bremsstrahlung_b1(self.x, b1 = 1, E0 = self.E0)) * D
+
+        if abs_elts_dict != {} : 
+            A = absorption_correction(self.x,**self.params_dict["Abs"],elements_dict = abs_elts_dict)
+        else : 
+            A = self.__compositions_absorption(C, unique_numbers)
+        return spectra + B * A * scale
+
+    def __compositions_absorption(self, C, elements) : 
+        # Absorption correction on the energy axis of each composition (line of C), using that the mass-absorption
+        # coefficient is the weighted mean of the coefficients of the elements
+        abs_params = self.params_dict["Abs"]
+        atomic_fraction = abs_params.get("atomic_fraction", False)
+        density = abs_params.get("density", None)
+        symbols = _symbols(elements_dict = dict.fromkeys(elements))
+        mu_elts = np.array([absorption_coefficient(self.x, elements_dict = {elt : 1.0}) for elt in elements])
+        weights = C.copy()
+        densities = np.empty((C.shape[0], 1))
+        for i, composition in enumerate(C) : 
+            # The conversions only involve the elements of the composition, with their symbols to skip the decorators
+            present = np.nonzero(composition)[0]
+            elements_dict = {symbols[j] : composition[j] for j in present}
+            if atomic_fraction : 
+                elements_dict = atomic_to_weight_dict.__wrapped__(elements_dict = elements_dict)
+                weights[i, present] = list(elements_dict.values())
+            densities[i] = approx_density.__wrapped__(False, elements_dict = elements_dict) if density is None else density
+        mu = weights @ mu_elts / np.sum(weights, axis = 1, keepdims = True)
+        return absorption_correction_from_mu(mu, abs_params.get("thickness", 100e-7), abs_params.get("toa", 90), densities)
+
     def get_elements(self) :
         for elt in self.model_elts:
             if re.match(r'[0-9]*(_lo)',elt) : 
@@ -337,32 +445,26 @@ class EDXS(PhysicalModel):
                 yield elt
         
     def carac_X_span(self) : 
-        all_indices = []
-        for elt in self.get_elements():
-            if self.lines : 
-                energies, cs = read_lines_db(elt,self.db_dict)
-            else : 
-                energies, cs = read_compact_db(elt,self.db_dict)
-            for energy in energies:
-                width = self.width_slope * energy + self.width_intercept
-                span = [energy - 2*width, energy + 2*width]
-                indices = np.where((self.x > span[0]) & (self.x < span[1]))[0]
-                all_indices.append(indices)
-        return np.unique(np.concatenate(all_indices))
+        energies = np.concatenate([self.__read_db(elt)[0] for elt in self.get_elements()])
+        width = self.width_slope * energies + self.width_intercept
+        # Channels within two widths of at least one line
+        in_span = (self.x[np.newaxis, :] > (energies - 2*width)[:, np.newaxis]) & (self.x[np.newaxis, :] < (energies + 2*width)[:, np.newaxis])
+        return np.nonzero(np.any(in_span, axis=0))[0]
     
     def NMF_initialize_W(self, D) :
         if self.G is None :
             raise ValueError('The G matrix is identity, the W matrix cannot be initialized. Please use a np.array for G in the ESpM-NMF instead of the model object')
+        G = dense_G(self.G)
         if self.bkgd_in_G and self.custom_init:
             idx = self.carac_X_span()
-            mask = np.ones(self.G.shape[0], bool)
+            mask = np.ones(G.shape[0], bool)
             mask[idx] = 0
-            Wbrem = (np.linalg.lstsq(self.G[mask,-2:],D[mask,:],rcond = None)[0]).clip(min = 0)
-            Wcarac = (np.linalg.lstsq(self.G[idx,:-2],D[idx,:] ,rcond = None)[0]).clip(min = 0)
-            # filter = np.where(np.mean(self.G[:,:-2],axis=1)<(np.max(np.mean(self.G[:,:-2],axis=1))*0.001))[0]
+            Wbrem = (np.linalg.lstsq(G[mask,-2:],D[mask,:],rcond = None)[0]).clip(min = 0)
+            Wcarac = (np.linalg.lstsq(G[idx,:-2],D[idx,:] ,rcond = None)[0]).clip(min = 0)
+            # filter = np.where(np.mean(G[:,:-2],axis=1)<(np.max(np.mean(G[:,:-2],axis=1))*0.001))[0]
             W = np.vstack((Wcarac,Wbrem))
         else :
-            W = (np.linalg.lstsq(self.G,D,rcond = None)[0]).clip(min = 0)
+            W = (np.linalg.lstsq(G,D,rcond = None)[0]).clip(min = 0)
 
         return W
         
@@ -381,26 +483,35 @@ class EDXS(PhysicalModel):
         # We skip the bremsstrahlung
         return ind_list
     
-    def NMF_update(self, W=None):
+    def NMF_update(self, W=None, G=None):
         """
         Update the G matrix with the new absorption correction.
+
+        If `G` is given (the copy of the G matrix of an estimator), its last two columns are modified in place. Otherwise,
+        the G matrix of the model is replaced by an updated copy, so that the matrices returned previously are not modified.
         """
         # We don't need to check whether G was correctyl initialized it should work anyway.
         
-        if W is None:
-            return self.G
-        if not(self.bkgd_in_G) :
-            return self.G
+        if W is None or not(self.bkgd_in_G) :
+            return self.G if G is None else G
         else :
             new_brstlg = self.update_bremsstrahlung(W)
-            new_G = self.G.copy()
-            new_G[:,-2:] = new_brstlg/self.norm[0][-2:]
-            self.G = new_G
-            return self.G
+            if G is None : 
+                G = self.G.copy()
+                self.G = G
+            if isinstance(G, BlockSparseG) : 
+                G.dense[:] = new_brstlg/self.norm[0][-2:]
+            else : 
+                G[:,-2:] = new_brstlg/self.norm[0][-2:]
+            return G
 
     def update_bremsstrahlung(self, W) : 
         """
         Update the bremsstrahlung part of the G matrix. This function is used for the NMF decomposition so that the absorption correction is updated in between each step.
+
+        The mass-absorption coefficient being linear in the composition, the coefficients of each element, the detection efficiency
+        and the bremsstrahlung are computed on the energy axis at the first call. The update is then a weighted sum of
+        the coefficients followed by the absorption formula (see :func:`espm.models.EDXS_function.G_bremsstrahlung`).
         """
         if not(self.bkgd_in_G) :
             raise AttributeError("The bremsstrahlung is not comprised in the model.")
@@ -408,6 +519,32 @@ class EDXS(PhysicalModel):
         indices = self.NMF_simplex()
         mean_compo = np.mean(W[indices,:],axis=1)
         normed_compo = mean_compo/np.sum(mean_compo)
-        elements_dict = {key : normed_compo[i] for i,key in enumerate(self.get_elements())}
-        bremsstrahlung = G_bremsstrahlung(self.x,self.E0,self.params_dict,elements_dict=elements_dict)
-        return bremsstrahlung
+
+        if self._brstlg_basis is None : 
+            self._brstlg_basis = self.__brstlg_basis(list(self.get_elements()))
+        symbols, mu_elts, DB = self._brstlg_basis
+        # The composition is given with the chemical symbols to skip the conversions of the decorators
+        elements_dict = {key : normed_compo[i] for i,key in enumerate(symbols)}
+
+        abs_params = self.params_dict["Abs"]
+        atomic_fraction = abs_params.get("atomic_fraction", False)
+        if atomic_fraction : 
+            weights = np.array(list(atomic_to_weight_dict(elements_dict = elements_dict).values()))
+        else : 
+            weights = normed_compo
+        mu = weights @ mu_elts / np.sum(weights)
+        density = abs_params.get("density", None)
+        if density is None : 
+            density = approx_density.__wrapped__(atomic_fraction, elements_dict = elements_dict)
+        A = absorption_correction_from_mu(mu, abs_params.get("thickness", 100e-7), abs_params.get("toa", 90), density)
+        return np.asarray(A)[..., np.newaxis] * DB
+
+    def __brstlg_basis(self, elements) : 
+        # Symbols and mass-absorption coefficients of the elements, and bremsstrahlung times detection efficiency on the energy axis
+        mu_elts = np.array([absorption_coefficient(self.x, elements_dict = {elt : 1.0}) for elt in elements])
+        if type(self.params_dict["Det"]) == str : 
+            D = det_efficiency_from_curve(self.x,self.params_dict["Det"])
+        else : 
+            D = det_efficiency(self.x,self.params_dict["Det"])
+        DB = np.vstack((D*lifshin_bremsstrahlung_b0(self.x, b0 = 1, E0 = self.E0), D*lifshin_bremsstrahlung_b1(self.x, b1 = 1, E0 = self.E0))).T
+        return _symbols(elements_dict = dict.fromkeys(elements)), mu_elts, DB
@@ -0,0 +1,151 @@
+r"""
+G matrix cache
+--------------
+
+The :mod:`espm.models.g_cache` module stores the G matrices generated by :meth:`espm.models.EDXS.generate_g_matr`, so that
+the G matrix of a given set of model parameters is built only once.
+
+The cache is keyed by a hash of the model parameters (energy axis, detector, absorption parameters and X-ray database), of
+the type of G matrix and of the modelled elements. The X-ray database and the efficiency curve files are identified by
+their modification time and size, so that the cached matrices are rebuilt when they are modified. The matrices are kept
+in memory and, optionally, in `.npz` files in a folder (e.g. :data:`espm.conf.G_CACHE_PATH`).
+
+"""
+
+from pathlib import Path
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import numpy as np
+import espm.conf as conf
+
+# Version of the layout of the cache entries, to be incremented when the G matrix or the entries change
+CACHE_VERSION = 1
+
+# Cached entries (G, norm, model_elts, bkgd_in_G), keyed by the hash of the parameters
+_entries = {}
+_entries_lock = threading.Lock()
+
+
+def _file_stamp(filename) :
+    path = conf.DB_PATH / Path(filename)
+    if not(path.is_file()) :
+        return None
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+def _json_default(obj) :
+    if isinstance(obj, np.generic) :
+        return obj.item()
+    if isinstance(obj, np.ndarray) :
+        return obj.tolist()
+    return str(obj)
+
+def _str_keys(obj) :
+    # json.dumps cannot sort keys of different types, e.g. 26 and "Fe"
+    if isinstance(obj, dict) :
+        return {str(key) : _str_keys(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)) :
+        return [_str_keys(value) for value in obj]
+    return obj
+
+def g_cache_key(model_params, g_type, elements, elements_dict = {}) :
+    r"""
+    Return a stable hash (hexadecimal string) of the parameters of a G matrix.
+
+    Parameters
+    ----------
+    model_params :
+        :dict: Parameters of the :class:`espm.models.EDXS` model, e.g. the output of :func:`espm.datasets.eds_spim.get_metadata`.
+    g_type :
+        :string: Type of G matrix (see :meth:`espm.models.EDXS.generate_g_matr`).
+    elements :
+        :list: Modelled elements.
+    elements_dict :
+        :dict: Split energies of the elements.
+
+    Returns
+    -------
+    key
+        :string: The sha256 hash of the parameters.
+    """
+    det = model_params.get("params_dict", {}).get("Det")
+    payload = {
+        "version" : CACHE_VERSION,
+        "model_params" : _str_keys(model_params),
+        "g_type" : g_type,
+        "elements" : [str(elt) for elt in elements],
+        "elements_dict" : _str_keys(elements_dict),
+        "db_stamp" : _file_stamp(model_params.get("db_name", "")),
+        "det_stamp" : _file_stamp(det) if isinstance(det, str) else None,
+    }
+    serialized = json.dumps(payload, sort_keys = True, default = _json_default)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+def _copy_entry(entry) :
+    # The G matrices are mutable (e.g. EDXS.NMF_update with an explicit G), hence the cached arrays are never shared
+    G, norm, model_elts, bkgd_in_G = entry
+    return G.copy(), np.array(norm, copy = True), list(model_elts), bkgd_in_G
+
+def load_g(key, cache_dir = None) :
+    r"""
+    Return the cached entry (G, norm, model_elts, bkgd_in_G) of a key, or None if it is not cached.
+
+    The entry is looked up in memory, then in `cache_dir` if it is not None.
+    """
+    with _entries_lock :
+        entry = _entries.get(key)
+    if entry is None and cache_dir is not None :
+        filename = Path(cache_dir) / "{}.npz".format(key)
+        if filename.exists() :
+            try :
+                with np.load(filename, allow_pickle = False) as data :
+                    entry = (data["G"], data["norm"], data["model_elts"].tolist(), bool(data["bkgd_in_G"]))
+            except (OSError, ValueError, KeyError) :
+                entry = None
+        if entry is not None :
+            with _entries_lock :
+                _entries[key] = entry
+    if entry is None :
+        return None
+    return _copy_entry(entry)
+
+def save_g(key, G, norm, model_elts, bkgd_in_G, cache_dir = None) :
+    r"""
+    Store a G matrix with its normalisation, its elements and whether it contains the bremsstrahlung.
+
+    The entry is kept in memory and written to `cache_dir` if it is not None. The file is written atomically, so that
+    concurrent processes can share the same folder.
+    """
+    entry = _copy_entry((np.asarray(G), norm, model_elts, bkgd_in_G))
+    with _entries_lock :
+        _entries[key] = entry
+    if cache_dir is None :
+        return
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents = True, exist_ok = True)
+    fd, tmp_name = tempfile.mkstemp(dir = cache_dir, suffix = ".npz")
+    try :
+        with os.fdopen(fd, "wb") as f :
+            np.savez(f, G = entry[0], norm = entry[1], model_elts = np.array(entry[2], dtype = str), bkgd_in_G = np.array(bkgd_in_G))
+        os.replace(tmp_name, cache_dir / "{}.npz".format(key))
+    except BaseException :
+        if os.path.exists(tmp_name) :
+            os.remove(tmp_name)
+        raise
+
+def clear_g_cache(cache_dir = None) :
+    r"""
+    Empty the G matrices kept in memory, and delete the cached files of `cache_dir` if it is not None.
+    It is called by :func:`espm.tables_utils.save_table`, which may modify an X-ray table with the same modification time.
+    """
+    with _entries_lock :
+        _entries.clear()
+    if cache_dir is not None and Path(cache_dir).is_dir() :
+        # Only the files named after a key are removed
+        for filename in Path(cache_dir).glob("*.npz") :
+            if re.fullmatch(r"[0-9a-f]{64}", filename.stem) :
+                filename.unlink()
@@ -26,8 +26,8 @@ def generate_brem_params (seed) :
 
     """
     np.random.seed(seed)
-    b0 = float(np.random.rand(1)*1e-2)
-    b1 = float(np.random.rand(1)*1e-1)
+    b0 = float(np.random.rand()*1e-2)
+    b1 = float(np.random.rand()*1e-1)
     return {"b0" : b0,"b1" : b1}
 
 def generate_elts_dict (seed, nb_elements = 3) : 
@@ -0,0 +1,181 @@
+r"""
+X-ray lines database
+--------------------
+
+The :mod:`espm.models.xrays_db` module implements a compact binary version of the json tables of X-ray lines.
+
+The json tables of ~/espm/tables (and the custom tables written by :func:`espm.tables_utils.save_table`) are converted
+once to a `.npz` file stored next to them, which contains a structured array with the name, energy and cross-section of
+all the lines, sorted by element. The `.npz` file is converted again when the json table is modified. The loaded
+databases are memoized per process.
+
+"""
+
+from collections.abc import Mapping
+from pathlib import Path
+import json
+import os
+import tempfile
+import threading
+import numpy as np
+import espm.conf as conf
+
+# Memoized databases, keyed by the path of the json table
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+class XraysDB(Mapping) :
+    r"""
+    Read-only database of X-ray lines.
+
+    It behaves like the "table" dictionnary of the json tables: `db["26"]` gives the lines of iron, in the format of the
+    json table (a dictionnary of lines with their "energy" and "cs" for the tables with the metadata "lines" set to True,
+    otherwise a dictionnary with the lists "energies" and "cs"). The method :meth:`arrays` gives the same data as arrays
+    without building the dictionnaries.
+
+    Parameters
+    ----------
+    elements :
+        :list: Atomic numbers (strings) of the elements, in the order of the table.
+    offsets :
+        :np.array 1D: Index of the first line of each element in `lines` (of size len(elements) + 1).
+    lines :
+        :np.array 1D: Structured array with the fields "line", "energy" and "cs".
+    metadata :
+        :dict: Metadata of the table.
+    """
+    def __init__(self, elements, offsets, lines, metadata) :
+        self.elements = list(elements)
+        self.offsets = np.asarray(offsets)
+        self.lines = lines
+        self.lines.flags.writeable = False
+        self.metadata = metadata
+        self._index = {elt : i for i, elt in enumerate(self.elements)}
+
+    @classmethod
+    def from_table(cls, table, metadata) :
+        r"""
+        Build the database from the "table" and "metadata" dictionnaries of a json table.
+        """
+        names, energies, cs, offsets = [], [], [], [0]
+        for elt, entry in table.items() :
+            if "energies" in entry :
+                energies += list(entry["energies"])
+                cs += list(entry["cs"])
+                names += [""] * len(entry["energies"])
+            else :
+                for line, values in entry.items() :
+                    names.append(line)
+                    energies.append(values["energy"])
+                    cs.append(values["cs"])
+            offsets.append(len(energies))
+        width = max([len(name) for name in names] + [1])
+        lines = np.zeros(len(energies), dtype=[("line", "U{}".format(width)), ("energy", "f8"), ("cs", "f8")])
+        lines["line"], lines["energy"], lines["cs"] = names, energies, cs
+        return cls([str(elt) for elt in table], offsets, lines, metadata)
+
+    def arrays(self, elt) :
+        r"""
+        Return the energies and cross-sections of the lines of an element as (read-only) arrays.
+        """
+        i = self._index[str(elt)]
+        lines = self.lines[self.offsets[i]:self.offsets[i + 1]]
+        return lines["energy"], lines["cs"]
+
+    def __getitem__(self, elt) :
+        i = self._index[str(elt)]
+        lines = self.lines[self.offsets[i]:self.offsets[i + 1]]
+        if self.metadata.get("lines", True) :
+            return {str(line["line"]) : {"energy" : float(line["energy"]), "cs" : float(line["cs"])} for line in lines}
+        return {"energies" : lines["energy"].tolist(), "cs" : lines["cs"].tolist()}
+
+    def __iter__(self) :
+        return iter(self.elements)
+
+    def __len__(self) :
+        return len(self.elements)
+
+    def save(self, filename, source_stamp=None) :
+        r"""
+        Save the database to a `.npz` file. The file is written atomically, so that concurrent processes can convert the same table.
+        """
+        filename = Path(filename)
+        header = json.dumps({"metadata" : self.metadata, "source" : source_stamp})
+        fd, tmp_name = tempfile.mkstemp(dir=filename.parent, suffix=".npz")
+        try :
+            with os.fdopen(fd, "wb") as f :
+                np.savez(f, lines=self.lines, offsets=self.offsets, elements=np.array(self.elements), header=np.array(header))
+            os.replace(tmp_name, filename)
+        except BaseException :
+            if os.path.exists(tmp_name) :
+                os.remove(tmp_name)
+            raise
+
+    @classmethod
+    def load(cls, filename, source_stamp=None) :
+        r"""
+        Load a database saved with :meth:`save`. Returns None if it was not converted from the json table with the given stamp.
+        """
+        with np.load(filename, allow_pickle=False) as data :
+            header = json.loads(str(data["header"]))
+            if source_stamp is not None and header["source"] != list(source_stamp) :
+                return None
+            return cls(data["elements"].tolist(), data["offsets"], data["lines"], header["metadata"])
+
+
+def _source_stamp(json_path) :
+    stat = os.stat(json_path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+def load_xrays_db(db_name) :
+    r"""
+    Load a table of X-ray lines from ~/espm/tables.
+
+    The compiled `.npz` version of the table is used if it is up to date, otherwise the json table is converted
+    (and the `.npz` file is written if the folder is writable). The result is memoized per process.
+
+    Parameters
+    ----------
+    db_name :
+        :string: Name of the json table, e.g. "200keV_xrays.json".
+
+    Returns
+    -------
+    database
+        :XraysDB: The database of X-ray lines and its metadata.
+    """
+    json_path = conf.DB_PATH / Path(db_name)
+    stamp = _source_stamp(json_path)
+    key = str(json_path)
+    with _databases_lock :
+        cached = _databases.get(key)
+    if cached is not None and cached[0] == stamp :
+        return cached[1]
+
+    npz_path = json_path.with_suffix(".npz")
+    db = None
+    if npz_path.exists() :
+        try :
+            db = XraysDB.load(npz_path, stamp)
+        except (OSError, ValueError, KeyError) :
+            db = None
+    if db is None :
+        with open(json_path, "r") as f :
+            json_dict = json.load(f)
+        db = XraysDB.from_table(json_dict["table"], json_dict["metadata"])
+        try :
+            db.save(npz_path, stamp)
+        except OSError :
+            # Read-only installation: the conversion is only kept in memory
+            pass
+    with _databases_lock :
+        _databases[key] = (stamp, db)
+    return db
+
+def clear_xrays_db_cache() :
+    r"""
+    Empty the memoized databases. It is called by :func:`espm.tables_utils.save_table`.
+    """
+    with _databases_lock :
+        _databases.clear()
@@ -2,7 +2,8 @@ from espm import models
 import numpy as np
 import espm.models.EDXS_function as ef
 from espm.conf import DEFAULT_EDXS_PARAMS
-from espm.utils import arg_helper
+from espm.utils import arg_helper, approx_density
+from espm.models.absorption_edxs import absorption_coefficient, det_efficiency, det_efficiency_from_curve
 import lmfit as lm
 import re
 
@@ -16,22 +17,10 @@ def make_partial_xy (list_energies,spectrum,x) :
         part_y=np.append(part_y,spectrum.isig[elt[0]:elt[1]].data)
 
     #Construction of a boolean array for display purposes
-    list_boola=[]
-    for i in range(len(list_energies)) :
-        list_boola.append(np.empty_like(x))
-
-    for i in range(len(list_energies)) :
-        for j in range(x.shape[0]) :
-            if np.logical_and(x[j]<list_energies[i][1],x[j]>list_energies[i][0]) :
-                list_boola[i][j]=True
-            else :
-                list_boola[i][j] = False
-
     sum_boola=np.zeros_like(x,dtype=bool)
-    for elt in list_boola :
-        sum_boola+=elt.astype(bool)
-    
-    
+    for elt in list_energies :
+        sum_boola |= (x<elt[1]) & (x>elt[0])
+
     return part_x, part_y, sum_boola
 
 def residual(pars,x,data = None) : 
@@ -91,3 +80,146 @@ def nested_dict_iter(nested, prefix = ""):
             new_key = prefix + key
             yield new_key, value
 
+
+
+class BackgroundModel :
+    r"""
+    Fast version of :func:`residual` for the fits of the bremsstrahlung parameters b0, b1 and of the thickness.
+
+    The model is the continuum X-rays of :func:`espm.models.EDXS_function.continuum_xrays`. The parts that do not depend on the
+    fitted parameters (bremsstrahlung basis, detection efficiency, mass-absorption coefficient and density) are computed once
+    on the fitted energies, so that an evaluation of the residual is a few vector operations. The jacobian is analytic.
+
+    The parameters are named as in the output of :func:`ndict_to_params`: "b0", "b1" and "params_dict__Abs__thickness". The
+    other parameters (take-off angle, density, composition, E0, detector) are fixed when the model is built.
+
+    Parameters
+    ----------
+    x :
+        :np.array 1D: Energy scale.
+    params_dict :
+        :dict: Dictionnary containing the absorption and detection parameters (completed with the default parameters).
+    E0 :
+        :float: Energy of the incident beam in keV.
+    elements_dict :
+        :dict: Composition of the studied sample, used for the absorption.
+    mask :
+        :np.array 1D: Boolean array selecting the fitted energies of x, e.g. the output sum_boola of :func:`make_partial_xy`. If None, all the energies are fitted.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> import espm.spectrum_fitting as sf
+    >>> x = np.linspace(0.5, 20, num = 1000)
+    >>> example = {"E0" : 200, "b0" : 1.0, "b1" : 1.0, "params_dict" : {"Det" : "SDD_efficiency.txt", "Abs" : {"thickness" : 2e-5, "toa" : 35, "density" : 3.5}}, "elements_dict" : {"Si" : 1.0, "O" : 2.0}}
+    >>> pars = sf.ndict_to_params(example)
+    >>> background = sf.BackgroundModel.from_params(pars, x)
+    >>> out = background.fit(sf.residual(pars, x) * 1.5, pars)
+    >>> round(out.params["b0"].value, 3)
+    1.5
+    """
+    names = ["b0", "b1", "params_dict__Abs__thickness"]
+
+    def __init__(self, x, params_dict = {}, E0 = 200, *, elements_dict = {"Si" : 1.0}, mask = None) : 
+        params_dict = arg_helper(params_dict, DEFAULT_EDXS_PARAMS["params_dict"])
+        self.mask = None if mask is None else np.asarray(mask, dtype = bool)
+        self.x = np.asarray(x, dtype = float)
+        x_fit = self.x if self.mask is None else self.x[self.mask]
+        self.x_fit = x_fit
+
+        if type(params_dict["Det"]) == str : 
+            D = det_efficiency_from_curve(x_fit,params_dict["Det"])
+        else : 
+            D = det_efficiency(x_fit,params_dict["Det"])
+        self.basis = np.vstack((ef.lifshin_bremsstrahlung_b0(x_fit, b0 = 1, E0 = E0), ef.lifshin_bremsstrahlung_b1(x_fit, b1 = 1, E0 = E0))) * D
+
+        abs_params = params_dict["Abs"]
+        atomic_fraction = abs_params.get("atomic_fraction", False)
+        mu = absorption_coefficient(x_fit, atomic_fraction, elements_dict = elements_dict)
+        density = abs_params.get("density", None)
+        if density is None : 
+            density = approx_density(atomic_fraction, elements_dict = elements_dict)
+        # chi = k * thickness, see espm.models.absorption_edxs.absorption_correction
+        self.k = mu * density / np.sin(np.deg2rad(abs_params.get("toa", 90)))
+        self.thickness = abs_params.get("thickness", 100e-7)
+
+        self._bremsstrahlung = np.empty_like(x_fit)
+        self._last_thickness = None
+
+    @classmethod
+    def from_params(cls, pars, x, mask = None) : 
+        r"""
+        Build the model from the parameters of :func:`residual` (see :func:`ndict_to_params`).
+        """
+        kwargs = params_to_ndict(pars)
+        return cls(x, kwargs.get("params_dict", {}), kwargs.get("E0", 200), elements_dict = kwargs.get("elements_dict", {"Si" : 1.0}), mask = mask)
+
+    def _values(self, pars) : 
+        b0, b1 = pars["b0"].value, pars["b1"].value
+        thickness = pars[self.names[2]].value if self.names[2] in pars else self.thickness
+        return b0, b1, thickness
+
+    def _absorption(self, thickness) : 
+        # Absorption correction (1 - exp(-chi))/chi and its derivative with respect to chi, for the last thickness
+        if thickness != self._last_thickness : 
+            chi = self.k * thickness
+            if thickness == 0 : 
+                A, dA = np.ones_like(chi), np.full_like(chi, -0.5)
+            else : 
+                small = chi < 1e-4
+                # Taylor expansions for small chi, where the closed forms lose their precision
+                safe_chi = np.where(small, 1.0, chi)
+                A = np.where(small, 1 - chi / 2 + chi**2 / 6, -np.expm1(-safe_chi) / safe_chi)
+                dA = np.where(small, -0.5 + chi / 3, (np.exp(-safe_chi) * (1 + safe_chi) - 1) / safe_chi**2)
+            self._A, self._dA, self._last_thickness = A, dA, thickness
+        return self._A, self._dA
+
+    def residual(self, pars, data = None) : 
+        r"""
+        Return the model on the fitted energies, or the model minus `data` (given on the fitted energies).
+        """
+        b0, b1, thickness = self._values(pars)
+        A, _ = self._absorption(thickness)
+        np.multiply(b0, self.basis[0], out = self._bremsstrahlung)
+        self._bremsstrahlung += b1 * self.basis[1]
+        out = self._bremsstrahlung * A
+        if data is not None : 
+            out -= data
+        return out
+
+    def jacobian(self, pars, data = None) : 
+        r"""
+        Return the jacobian of :meth:`residual` with respect to the varying parameters, with shape (n_energies, n_varying).
+        """
+        b0, b1, thickness = self._values(pars)
+        A, dA = self._absorption(thickness)
+        varying = [name for name, par in pars.items() if par.vary]
+        jac = np.empty((self.x_fit.shape[0], len(varying)))
+        for i, name in enumerate(varying) : 
+            if name == "b0" : 
+                np.multiply(self.basis[0], A, out = jac[:, i])
+            elif name == "b1" : 
+                np.multiply(self.basis[1], A, out = jac[:, i])
+            elif name == self.names[2] : 
+                np.multiply(b0 * self.basis[0] + b1 * self.basis[1], self.k * dA, out = jac[:, i])
+            else : 
+                raise ValueError("Only the parameters {} can be fitted with BackgroundModel, set the parameter {} with vary=False.".format(self.names, name))
+        return jac
+
+    def fit(self, data, pars, **kwargs) : 
+        r"""
+        Fit the parameters to `data` with the analytic jacobian and return the lmfit.MinimizerResult.
+
+        The data are given on the energies x (the mask is applied) or on the fitted energies. Only "b0", "b1" and
+        "params_dict__Abs__thickness" are fitted: the other parameters are fixed in the copy of `pars` used for the fit.
+        The other keyword arguments are passed to lmfit.minimize.
+        """
+        data = np.asarray(data, dtype = float)
+        if self.mask is not None and data.shape[0] == self.mask.shape[0] : 
+            data = data[self.mask]
+        pars = pars.copy()
+        for name, par in pars.items() : 
+            if not(name in self.names) : 
+                par.vary = False
+        kwargs.setdefault("method", "leastsq")
+        return lm.minimize(self.residual, pars, kws = {"data" : data}, Dfun = self.jacobian, **kwargs)
@@ -14,6 +14,9 @@ from espm.conf import DB_PATH, SYMBOLS_PERIODIC_TABLE, SIEGBAHN_TO_IUPAC
 import re
 import numpy as np
 import espm.utils as u
+from espm.models.absorption_edxs import clear_interpolator_cache
+from espm.models.xrays_db import clear_xrays_db_cache
+from espm.models.g_cache import clear_g_cache
 
 def load_table (db_name) :
     r"""
@@ -152,6 +155,10 @@ def save_table (filename, table, mdata) :
     d["metadata"] = mdata
     with open(filename,"w") as f :
         json.dump(d,f,indent = 4)
+    # The interpolators, the compiled tables and the G matrices may be outdated
+    clear_interpolator_cache()
+    clear_xrays_db_cache()
+    clear_g_cache()
         
 def get_k_factor (table, mdata, element, line, range = 0.5, ref_elt = "14", ref_line = "KL3", ref_range = 0.5) : 
     r"""
@@ -1,8 +1,17 @@
 from espm.models.absorption_edxs import det_efficiency, absorption_correction
+import espm.models.absorption_edxs as ae
+import espm.tables_utils
+from espm.tables_utils import save_table, load_table
+from espm.models.xrays_db import load_xrays_db, XraysDB
+from espm.models.g_cache import g_cache_key, clear_g_cache
+from espm.datasets.eds_spim import get_metadata
+import espm.conf
+import os
 from espm.models.generate_EDXS_phases import generate_elts_dict
 import numpy as np
 import espm.models.EDXS_function as ef
 from espm.models import EDXS
+from espm.utils import BlockSparseG
 from espm.models.EDXS_function import lifshin_bremsstrahlung, lifshin_bremsstrahlung_b0, lifshin_bremsstrahlung_b1
 import hyperspy.api as hs
 
@@ -81,6 +90,53 @@ def test_absorption () :
     np.testing.assert_array_less(1e-30,abs_corr)
     np.testing.assert_array_less(abs_corr,1.0)
 
+def test_interpolator_cache (tmp_path, monkeypatch) : 
+    ae.clear_interpolator_cache()
+    assert ae.mass_absorption_interpolator("Fe") is ae.mass_absorption_interpolator("Fe")
+    assert ae.mass_absorption_interpolator("Fe") is not ae.mass_absorption_interpolator("Fe", kind="linear")
+
+    monkeypatch.setattr(ae, "DB_PATH", tmp_path)
+    curve = np.array([[0.1, 0.5], [5, 0.9], [10, 0.8], [30, 0.3]])
+    np.savetxt(tmp_path / "curve.txt", curve)
+    np.testing.assert_allclose(ae.det_efficiency_from_curve(curve[:, 0], "curve.txt", kind="linear"), curve[:, 1])
+    interp_func = ae.efficiency_curve_interpolator("curve.txt", kind="linear")
+    assert ae.efficiency_curve_interpolator("curve.txt", kind="linear") is interp_func
+
+    # A modification of the file invalidates the cache
+    np.savetxt(tmp_path / "curve.txt", curve * [1, 0.5])
+    stat = os.stat(tmp_path / "curve.txt")
+    os.utime(tmp_path / "curve.txt", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    np.testing.assert_allclose(ae.det_efficiency_from_curve(curve[:, 0], "curve.txt", kind="linear"), curve[:, 1] * 0.5)
+
+    # Saving a table clears the cache
+    save_table(tmp_path / "table.json", {}, {})
+    assert len(ae._interpolators) == 0
+    assert ae.efficiency_curve_interpolator("curve.txt", kind="linear") is not interp_func
+
+def test_xrays_db (tmp_path, monkeypatch) : 
+    for db_name in ["200keV_xrays.json", "default_xrays.json"] : 
+        table, mdata = load_table(db_name)
+        monkeypatch.setattr(espm.conf, "DB_PATH", tmp_path)
+        save_table(tmp_path / db_name, table, mdata)
+        db = load_xrays_db(db_name)
+        assert (tmp_path / db_name).with_suffix(".npz").exists()
+        assert load_xrays_db(db_name) is db
+        assert dict(db) == table
+        assert db.metadata == mdata
+        read_db = ef.read_lines_db if mdata["lines"] else ef.read_compact_db
+        assert read_db("26", db) == read_db("26", table)
+
+        # The compiled table is used by another process, and converted again when the json table is modified
+        espm.tables_utils.clear_xrays_db_cache()
+        assert dict(load_xrays_db(db_name)) == table
+        del table["26"]
+        save_table(tmp_path / db_name, table, mdata)
+        assert "26" not in load_xrays_db(db_name)
+        monkeypatch.undo()
+
+    model = EDXS(**model_parameters)
+    assert isinstance(model.db_dict, XraysDB)
+
 def test_elts_dict_from_dict_list () : 
     dict_list = [{"chou" : 1, "carottes" : 2, "navet" : 3}, {"chou" : 2, "oignons" : 3, "navet" : 3}, {"orange" : 6, "citron" : 4, "poireau" : 8}]
     unique_dict = ef.elts_dict_from_dict_list(dict_list)
@@ -103,6 +159,42 @@ def test_get_elements () :
         nelts.append(i)
     assert nelts == ['14', '8', '26', '20'] 
         
+def test_build_G_cache (tmp_path, monkeypatch) : 
+    clear_g_cache()
+    s = create_data()
+    s.build_G(elements_dict ={'Fe' : 3.0}, cache_dir = tmp_path)
+    G, norm, model_elts = s.G.copy(), s.model.norm.copy(), list(s.model.model_elts)
+    assert len(list(tmp_path.glob("*.npz"))) == 1
+
+    # Same metadata: G is not generated again, and the cached matrix is not shared with the model
+    def fail(*args, **kwargs) : 
+        raise AssertionError("G should be taken from the cache")
+    t = create_data()
+    monkeypatch.setattr(t.model, "generate_g_matr", fail)
+    t.build_G(elements_dict ={'Fe' : 3.0})
+    np.testing.assert_array_equal(t.G, G)
+    np.testing.assert_array_equal(t.model.norm, norm)
+    assert t.model.model_elts == model_elts and t.model.bkgd_in_G
+    t.model.NMF_update(np.random.rand(t.G.shape[1], 3), t.G)
+    assert not(t.G is s.G)
+    np.testing.assert_array_equal(s.G, G)
+
+    # From the disk after emptying the memory
+    clear_g_cache()
+    t.build_G(elements_dict ={'Fe' : 3.0}, cache_dir = tmp_path)
+    np.testing.assert_array_equal(t.G, G)
+    assert t.model.model_elts == model_elts
+
+    # Different parameters give a different key
+    mod_pars = get_metadata(s)
+    key = g_cache_key(mod_pars, "bremsstrahlung", ["Si","O","Fe","Ca"], {'Fe' : 3.0})
+    assert key == g_cache_key(mod_pars, "bremsstrahlung", ["Si","O","Fe","Ca"], {'Fe' : 3.0})
+    assert key != g_cache_key(mod_pars, "bremsstrahlung", ["Si","O","Fe","Ca"], {})
+    assert key != g_cache_key(mod_pars, "no_brstlg", ["Si","O","Fe","Ca"], {'Fe' : 3.0})
+    assert key != g_cache_key(dict(mod_pars, e_size = 99), "bremsstrahlung", ["Si","O","Fe","Ca"], {'Fe' : 3.0})
+    clear_g_cache(tmp_path)
+    assert len(list(tmp_path.glob("*.npz"))) == 0
+
 def test_carac_x_span () :
     # TODO : Find a way to implement the test of this function
     pass
@@ -151,6 +243,24 @@ def test_NMF_update () :
     assert model.NMF_update(np.random.rand(6,10)).shape == model.G.shape
     with np.testing.assert_raises(AssertionError):
         np.testing.assert_array_equal(model.NMF_update(np.random.rand(6,10))[:,-2:], temp_G[:,-2:])
+
+    # The precomputed update gives the bremsstrahlung of the mean composition and only modifies the last two columns of the given G in place
+    for atomic_fraction in [False, True] : 
+        parameters = dict(model_parameters, params_dict = dict(model_parameters["params_dict"], Abs = dict(model_parameters["params_dict"]["Abs"], atomic_fraction = atomic_fraction, density = None)))
+        model = EDXS(**parameters)
+        model.generate_g_matr(g_type = "bremsstrahlung", elements = ["Na", "Sr", "Ge", "Nb"], elements_dict={"Ge" : 3.0})
+        G, temp_G = model.G, model.G.copy()
+        W = np.random.rand(7, 10)
+        compo = np.mean(W[model.NMF_simplex()], axis=1)
+        compo = compo / np.sum(compo)
+        brstlg = ef.G_bremsstrahlung(model.x, model.E0, model.params_dict, elements_dict = {elt : compo[i] for i, elt in enumerate(model.get_elements())})
+        assert model.NMF_update(W, G) is G
+        np.testing.assert_allclose(G[:, -2:], brstlg / model.norm[0][-2:], rtol=1e-12)
+        np.testing.assert_array_equal(G[:, :-2], temp_G[:, :-2])
+        # Without an explicit G, the G matrix of the model is replaced
+        new_G = model.NMF_update(W)
+        assert model.G is new_G and not(new_G is G)
+        np.testing.assert_array_equal(new_G, G)
     
 def test_generate_g_matr () : 
     model1 = EDXS(**model_parameters)
@@ -184,6 +294,94 @@ def test_generate_g_matr () :
     assert(model3.model_elts == ['11', '38', '32', '41'])
     assert(model4.model_elts == ['11', '38', '32_lo', '32_hi', '41'])
 
+def test_generate_g_matr_reference () : 
+    # The vectorized builder gives the same matrix as the sum of the lines element by element
+    model = EDXS(**model_parameters)
+    elements_dict = {"32" : 3.0}
+    model.generate_g_matr(g_type = "no_brstlg", elements = ["Na", "Sr", "Ge", "Nb"], elements_dict={"Ge" : 3.0})
+    columns = []
+    for elt in ["11", "38", "32", "41"] : 
+        energies, cs = ef.read_compact_db(elt, model.db_dict)
+        peaks = np.zeros((model.x.shape[0], 2 if elt in elements_dict else 1))
+        for energy, c in zip(energies, cs) : 
+            if (energy > np.min(model.x)) and (energy < np.max(model.x)) : 
+                D = det_efficiency(energy, det_dict)
+                A = absorption_correction(energy, **model_parameters["params_dict"]["Abs"], elements_dict = {elt : 1.0})
+                width = model.width_slope * energy + model.width_intercept
+                column = int(elt in elements_dict and energy >= elements_dict[elt])
+                peaks[:, column] += c * ef.gaussian(model.x, energy, width / 2.3548) * D * A
+        columns.append(peaks)
+    G = np.hstack(columns)
+    np.testing.assert_array_equal(model.G, G / np.mean(np.sqrt(np.sum(G**2, axis=0))))
+
+    span = np.concatenate([np.nonzero(np.abs(model.x - e) < 2*(model.width_slope * e + model.width_intercept))[0] for elt in ["11", "38", "32", "41"] for e in ef.read_compact_db(elt, model.db_dict)[0]])
+    np.testing.assert_array_equal(model.carac_X_span(), np.unique(span))
+
+def test_sparse_g_matr () : 
+    elts_list = ["Na", "Sr", "Ge", "Nb"]
+    dense_model = EDXS(**model_parameters)
+    dense_model.generate_g_matr(g_type = "bremsstrahlung", elements = elts_list, elements_dict={"Ge" : 3.0})
+    model = EDXS(**model_parameters)
+    model.generate_g_matr(g_type = "bremsstrahlung", elements = elts_list, elements_dict={"Ge" : 3.0}, sparse = True, sigma_cutoff = 5.0)
+    G = model.G
+    assert isinstance(G, BlockSparseG)
+    assert G.shape == dense_model.G.shape
+    assert G.dense.shape == (model_parameters["e_size"], 2)
+    assert G.nnz < 0.2 * G.sparse.shape[0] * G.sparse.shape[1]
+    # The truncated tails of the gaussians are negligible
+    np.testing.assert_allclose(G.toarray(), dense_model.G, atol=1e-5 * np.max(dense_model.G))
+    np.testing.assert_array_equal(G.dense, dense_model.G[:, -2:])
+
+    W, M = np.random.rand(7, 3), np.random.rand(model_parameters["e_size"], 3)
+    np.testing.assert_allclose(G @ W, G.toarray() @ W)
+    np.testing.assert_allclose(G.T @ M, G.toarray().T @ M)
+    np.testing.assert_allclose(G.column_sums(), np.sum(G.toarray(), axis=0))
+
+    # The bremsstrahlung columns of a given G are updated in place, as for the dense matrix
+    W = np.random.rand(7, 10)
+    assert model.NMF_update(W, G) is G
+    np.testing.assert_allclose(G.dense, dense_model.NMF_update(W)[:, -2:])
+
+    model.generate_g_matr(g_type = "no_brstlg", elements = elts_list, elements_dict={}, sparse = True)
+    assert model.G.shape == (model_parameters["e_size"], 4)
+    assert model.G.dense.shape == (model_parameters["e_size"], 0)
+
+def test_generate_spectra () : 
+    # Reference: the spectra computed line by line and phase by phase
+    def spectrum_reference(model, b0, b1, scale, abs_elts_dict, elements_dict) : 
+        temp = np.zeros_like(model.x)
+        for elt in elements_dict.keys() : 
+            energies, cs = ef.read_compact_db(elt, model.db_dict)
+            for energy, c in zip(energies, cs) : 
+                if (energy > np.min(model.x)) and (energy < np.max(model.x)) : 
+                    D = det_efficiency(energy, det_dict)
+                    A = absorption_correction(energy, **model.params_dict["Abs"], elements_dict = {elt : 1.0})
+                    width = model.width_slope * energy + model.width_intercept
+                    temp += elements_dict[elt] * c * ef.gaussian(model.x, energy, width / 2.3548) * A * D
+        temp /= temp.sum()
+        abs_dict = elements_dict if abs_elts_dict == {} else abs_elts_dict
+        return temp + ef.continuum_xrays(model.x, model.params_dict, b0, b1, model.E0, elements_dict = abs_dict) * scale
+
+    compositions = [{"14" : 0.5, "8" : 0.3, "26" : 0.2}, {"26" : 0.7, "42" : 0.3}, {"20" : 1.0, "8" : 0.1}]
+    b0, b1, scale = [5e-5, 1e-4, 2e-5], [2e-3, 1e-3, 3e-3], [1.0, 0.5, 2.0]
+    for atomic_fraction, density in [(False, 3.12), (True, None)] : 
+        parameters = dict(model_parameters, params_dict = dict(model_parameters["params_dict"], Abs = dict(model_parameters["params_dict"]["Abs"], atomic_fraction = atomic_fraction, density = density)))
+        model = EDXS(**parameters)
+        for abs_elts_dict in [{}, {"14" : 0.5, "26" : 0.5}] : 
+            spectra = model.generate_spectra(compositions, b0, b1, scale, abs_elts_dict)
+            reference = [spectrum_reference(model, b0[i], b1[i], scale[i], abs_elts_dict, c) for i, c in enumerate(compositions)]
+            np.testing.assert_allclose(spectra, reference, rtol = 1e-10)
+        np.testing.assert_allclose(model.generate_spectrum(b0[0], b1[0], scale[0], elements_dict = {"Si" : 0.5, "O" : 0.3, "Fe" : 0.2}), spectrum_reference(model, b0[0], b1[0], scale[0], {}, compositions[0]), rtol = 1e-10)
+
+    # Array of compositions, the same element may be given with its symbol and its atomic number
+    model = EDXS(**model_parameters)
+    C = np.random.rand(5, 3)
+    spectra = model.generate_spectra(C, b0 = 1e-4, b1 = 1e-3, elements = ["Fe", "O", 26])
+    reference = model.generate_spectra([{"26" : c[0] + c[2], "8" : c[1]} for c in C], b0 = 1e-4, b1 = 1e-3)
+    np.testing.assert_allclose(spectra, reference, rtol = 1e-10)
+    with np.testing.assert_raises(ValueError) : 
+        model.generate_spectra(C, elements = ["Fe", "O"])
+
 def test_G_bremsstrahlung() : 
     model = EDXS(**model_parameters)
     size = model_parameters["e_size"]
@@ -1,13 +1,17 @@
 from sklearn.utils.estimator_checks import check_estimator
 from espm.estimators.surrogates import diff_surrogate, smooth_l2_surrogate, smooth_dgkl_surrogate
-from espm.estimators import SmoothNMF
+from espm.estimators import SmoothNMF, OnlineSmoothNMF, MultiStartNMF
 from espm.estimators.base import normalization_factor
+from espm.estimators.profiling import get_active_profiler
 import numpy as np
+import pytest
+import json
+from concurrent.futures import ThreadPoolExecutor
 from espm.models import EDXS
 from espm.weights import generate_weights
 from espm.datasets.base import generate_spim
-from espm.measures import trace_xtLx
-from espm.utils import create_laplacian_matrix
+from espm.measures import trace_xtLx, find_min_angle
+from espm.utils import create_laplacian_matrix, BlockSparseG, dense_G
 from espm.models.generate_EDXS_phases import generate_modular_phases
 from espm.datasets.base import generate_spim_sample
 
@@ -152,6 +156,313 @@ def test_general():
     # assert(trace_xtLx(L, A.T) < trace_xtLx(L, A2.T) )
     assert(trace_xtLx(L, A3.T) < trace_xtLx(L, H.T)*1.01 )
 
+ALGOS = ["log_surrogate", "l2_surrogate", "projected_gradient", "bmd"]
+
+def _algo_params(algo, **params):
+    # Parameters of SmoothNMF used to compare two fits, with the simplex constraint on W or H depending on the algorithm
+    simplex_W = algo != "projected_gradient"
+    return dict(dict(n_components= 2, max_iter=10, shape_2d=(10, 20), algo=algo, simplex_W=simplex_W, simplex_H=not(simplex_W), hspy_comp = False, random_state=0, no_stop_criterion=True), **params)
+
+def _fit_pair(params_a, params_b, X_a, X_b=None, rtol=1e-6, atol=0, loss_rtol=None):
+    # Fit SmoothNMF with params_a on X_a and params_b on X_b (X_a by default), check that the components and the losses
+    # match and return the two estimators. atol is relative to the maximum of the components.
+    estimator_a, estimator_b = SmoothNMF(**params_a), SmoothNMF(**params_b)
+    D_a = estimator_a.fit_transform(X=X_a)
+    D_b = estimator_b.fit_transform(X=X_a if X_b is None else X_b)
+    np.testing.assert_allclose(D_a, D_b, rtol=rtol, atol=atol*np.max(D_a))
+    np.testing.assert_allclose(estimator_a.get_losses()["full_loss"], estimator_b.get_losses()["full_loss"], rtol=rtol if loss_rtol is None else loss_rtol)
+    return estimator_a, estimator_b
+
+def test_identity_G():
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    params = dict(n_components= 2,max_iter=20, simplex_W=False, simplex_H=True, hspy_comp = False, random_state=0)
+    estimator1, estimator2 = _fit_pair(params, dict(params, G=np.eye(Xdot.shape[0])), Xdot)
+    assert estimator1.G_ is None and estimator2.G_ is None
+    np.testing.assert_allclose(estimator2.inverse_transform(estimator2.W_), estimator2.W_ @ estimator2.H_)
+
+@pytest.mark.parametrize("algo", ALGOS)
+def test_workspace(algo):
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    params = _algo_params(algo, G=G, max_iter=20, lambda_L=1, no_stop_criterion=False)
+    _fit_pair(params, dict(params, workspace=True), Xdot)
+
+@pytest.mark.parametrize("algo", ALGOS)
+def test_float32(algo):
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    params = _algo_params(algo, G=G, max_iter=20, lambda_L=1, mu=0.1, no_stop_criterion=False)
+    _, estimator = _fit_pair(params, dict(params, dtype=np.float32), Xdot, rtol=1e-2, atol=1e-3, loss_rtol=1e-3)
+    for M in [estimator.X_, estimator.G_, estimator.W_, estimator.H_, estimator.L_, estimator.G_ @ estimator.W_]:
+        assert M.dtype == np.float32
+
+@pytest.mark.parametrize("algo", ALGOS)
+def test_sparse(algo):
+    from scipy.sparse import csr_matrix
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    # Low dose data with a majority of zeros
+    X = np.random.poisson(0.2 * Xdot / np.mean(Xdot)).astype(float)
+    assert np.mean(X == 0) > 0.5
+    params = _algo_params(algo, G=G, lambda_L=1, mu=0.1)
+    _fit_pair(params, params, X, csr_matrix(X))
+
+def test_sparse_l2():
+    from scipy.sparse import csr_matrix
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    estimator = SmoothNMF(n_components= 2, l2=True, hspy_comp = False)
+    with pytest.raises(ValueError):
+        estimator.fit_transform(X=csr_matrix(X))
+
+@pytest.mark.parametrize("algo", ALGOS)
+def test_sparse_G(algo):
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    models = []
+    for sparse in [False, True]:
+        model = EDXS(**phases_dict["model_params"])
+        model.generate_g_matr(g_type="bremsstrahlung", elements=["Fe", "Mo", "Ca", "Si", "O", "Pt"] ,elements_dict={}, sparse=sparse)
+        models.append(model)
+    params = _algo_params(algo)
+    _, estimator = _fit_pair(dict(params, G=models[0]), dict(params, G=models[1]), Xdot, rtol=1e-3, atol=1e-4)
+    assert isinstance(estimator.G_, BlockSparseG)
+
+def test_block_sparse_G():
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    # A BlockSparseG can also be given directly as the G matrix
+    estimator = SmoothNMF(G=BlockSparseG.from_dense(G), n_components= 2, max_iter=10, shape_2d=(10, 20), dtype=np.float32, hspy_comp = False, random_state=0)
+    estimator.fit_transform(X=Xdot)
+    assert estimator.G_.dtype == np.float32
+
+@pytest.mark.parametrize("algo", ["log_surrogate", "l2_surrogate", "bmd"])
+def test_chunked(tmp_path, algo):
+    G, W, H, D, w, X0, Xdot, N = generate_one_sample()
+    X = X0.copy()
+    X[:, 3] = 0
+    Xmm = np.memmap(tmp_path / "X.dat", dtype=X.dtype, mode="w+", shape=X.shape)
+    Xmm[:] = X
+    Xmm.flush()
+    Xmm = np.memmap(tmp_path / "X.dat", dtype=X.dtype, mode="r", shape=X.shape)
+    params = _algo_params(algo, G=G, lambda_L=1, mu=0.1, simplex_W=False, simplex_H=True, init="random", normalize=True, dicotomy_tol=1e-10)
+    _fit_pair(params, dict(params, chunk_size=37), X, Xmm, rtol=1e-8)
+    np.testing.assert_array_equal(Xmm, X)
+
+def test_chunked_options():
+    G, W, H, D, w, X0, Xdot, N = generate_one_sample()
+    # Initialization from H and hyperspy layout
+    params = dict(G=G, n_components= 2, max_iter=10, simplex_W=False, simplex_H=True, hspy_comp = True, no_stop_criterion=True, dicotomy_tol=1e-10)
+    D1 = SmoothNMF(**params).fit_transform(X=X0.T, H=H)
+    D2 = SmoothNMF(chunk_size=50, **params).fit_transform(X=np.ascontiguousarray(X0.T), H=H)
+    np.testing.assert_allclose(D1, D2, rtol=1e-8)
+
+    with pytest.raises(ValueError):
+        SmoothNMF(chunk_size=50, algo="projected_gradient", simplex_W=False, simplex_H=True, hspy_comp = False).fit_transform(X=X0)
+
+@pytest.mark.parametrize("algo", ALGOS)
+def test_n_jobs(algo):
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    fixed_W, fixed_H = gen_fixed_mat()
+    params = _algo_params(algo, G=G, lambda_L=1, mu=0.1, fixed_H=None if algo=="bmd" else fixed_H, dicotomy_tol=1e-10)
+    estimator1, estimator2 = _fit_pair(params, dict(params, n_jobs=3), X, rtol=1e-10)
+    np.testing.assert_allclose(estimator1.H_, estimator2.H_, rtol=1e-10)
+
+def test_n_jobs_error():
+    with pytest.raises(AssertionError):
+        SmoothNMF(n_jobs=0)
+
+def test_physics_model_G():
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    for sparse in [False, True]:
+        model = EDXS(**phases_dict["model_params"])
+        model.generate_g_matr(g_type="bremsstrahlung", elements=["Fe", "Mo", "Ca", "Si", "O", "Pt"] ,elements_dict={}, sparse=sparse)
+        G_model = model.G.copy()
+        params = dict(G=model, n_components= 2, max_iter=6, simplex_W=True, hspy_comp = False, random_state=0, no_stop_criterion=True)
+        # The G matrix is updated in a private copy: the model and the estimators fitted earlier are not modified
+        first = SmoothNMF(**params)
+        first.fit(X)
+        G_first = first.G_.copy()
+        assert not(np.allclose(dense_G(G_first), dense_G(G_model)))
+        second = SmoothNMF(dtype=np.float32, **params)
+        second.fit(2 * X)
+        np.testing.assert_array_equal(dense_G(first.G_), dense_G(G_first))
+        np.testing.assert_array_equal(dense_G(model.G), dense_G(G_model))
+
+def test_online():
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    model = EDXS(**phases_dict["model_params"])
+    model.generate_g_matr(g_type="bremsstrahlung", elements=["Fe", "Mo", "Ca", "Si", "O", "Pt"] ,elements_dict={})
+    X = np.random.default_rng(0).poisson(np.tile(Xdot, (1, 10))).astype(float)
+
+    params = dict(G=model, n_components= 2, simplex_W=True, hspy_comp = False, random_state=0, no_stop_criterion=True)
+    estimator = SmoothNMF(max_iter=50, **params)
+    estimator.fit(X)
+    loss_batch = estimator.losses_[-1]
+
+    estimator = OnlineSmoothNMF(max_iter=2, batch_size=100, **params)
+    estimator.fit(X)
+    assert estimator.n_iter_ == 2
+    assert estimator.losses_[-1] < 1.02 * loss_batch
+    indices = model.NMF_simplex()
+    np.testing.assert_allclose(np.sum(estimator.W_[indices], axis=0), 1, atol=1e-3)
+
+    estimator = OnlineSmoothNMF(**params)
+    for epoch in range(2):
+        for start in range(0, X.shape[1], 100):
+            estimator.partial_fit(X[:, start:start + 100])
+    assert estimator.n_batches_ == 40
+    assert estimator.H_batch_.shape == (2, 100)
+    np.testing.assert_allclose(np.sum(estimator.W_[indices], axis=0), 1, atol=1e-3)
+    assert np.max(find_min_angle(D.T, (estimator.G_ @ estimator.W_).T, unique=True)) < 5
+
+    with pytest.raises(AssertionError):
+        OnlineSmoothNMF(lambda_L=1)
+
+def test_laplacian_options():
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    params = dict(G=G, n_components= 2, max_iter=5, lambda_L=1, simplex_W=False, simplex_H=True, hspy_comp = False, random_state=0, no_stop_criterion=True)
+    estimator = SmoothNMF(shape_2d=(10, 20), laplacian_connectivity=8, **params)
+    estimator.fit(X)
+    assert estimator.gamma_ == 16
+    assert np.all(np.isfinite(estimator.losses_))
+
+    mask = np.zeros((10, 20), dtype=bool)
+    mask[2:8, 5:15] = True
+    mask[2, 5] = False
+    estimator = SmoothNMF(shape_2d=(10, 20), laplacian_mask=mask, **params)
+    estimator.fit(X[:, mask.ravel()])
+    assert estimator.H_.shape == (2, np.sum(mask))
+    with pytest.raises(ValueError):
+        estimator.fit(X)
+
+    # Without smoothness regularization, the Laplacian is not built
+    estimator = SmoothNMF(**dict(params, lambda_L=0))
+    estimator.fit(X)
+    assert estimator.L_ is None
+    assert estimator.get_losses()["Lapl_reg_loss"][-1] == 0
+
+def test_multi_start(tmp_path):
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    estimator = SmoothNMF(G=G, n_components= 2, max_iter=10, lambda_L=1, shape_2d=(10, 20), simplex_W=False, simplex_H=True, hspy_comp = False, verbose=0)
+    multi1 = MultiStartNMF(estimator, n_init=3, random_state=0)
+    D1 = multi1.fit_transform(X)
+    assert len(multi1.estimators_) == 3
+    assert multi1.reconstruction_errs_[multi1.best_index_] == np.min(multi1.reconstruction_errs_)
+    assert multi1.angles_.shape == (3, 2)
+    np.testing.assert_allclose(multi1.angles_[multi1.best_index_], 0, atol=1e-5)
+    np.testing.assert_allclose(D1, multi1.best_estimator_.G_ @ multi1.best_estimator_.W_)
+    assert not(hasattr(multi1.best_estimator_, "X_"))
+    assert estimator.init is None
+
+    # The runs in a process pool give the same results
+    multi2 = MultiStartNMF(estimator, n_init=3, random_state=0, n_jobs=2)
+    D2 = multi2.fit_transform(X)
+    np.testing.assert_array_equal(multi1.random_states_, multi2.random_states_)
+    np.testing.assert_allclose(multi1.reconstruction_errs_, multi2.reconstruction_errs_)
+    np.testing.assert_allclose(D1, D2)
+
+    # A memory map is opened again by the workers, with an offset and in the Fortran order
+    filename = tmp_path / "X.dat"
+    X_map = np.memmap(filename, mode="w+", dtype=X.dtype, offset=16, shape=X.shape, order="F")
+    X_map[:] = X
+    multi3 = MultiStartNMF(estimator, n_init=3, random_state=0, n_jobs=2)
+    np.testing.assert_allclose(multi3.fit_transform(X_map), D1)
+    np.testing.assert_allclose(multi1.reconstruction_errs_, multi3.reconstruction_errs_)
+
+    # The empty lines and columns are filled as in the sequential runs
+    X_zeros = X.copy()
+    X_zeros[:5], X_zeros[:, :3] = 0, 0
+    D4 = MultiStartNMF(estimator, n_init=2, random_state=0).fit_transform(X_zeros)
+    np.testing.assert_allclose(MultiStartNMF(estimator, n_init=2, random_state=0, n_jobs=2).fit_transform(X_zeros), D4)
+
+def test_remove_zeros_lines():
+    X = np.random.rand(6, 8)
+    estimator = SmoothNMF()
+    # X is only copied when it has to be filled
+    assert estimator.remove_zeros_lines(X, 1e-10) is X
+    X[1], X[:, 2] = 0, 0
+    new_X = estimator.remove_zeros_lines(X, 1e-10)
+    assert np.all(X[1] == 0)
+    assert np.all(new_X[1] == 1e-10) and np.all(new_X[:, 2] == 1e-10)
+    np.testing.assert_array_equal(np.delete(np.delete(new_X, 1, axis=0), 2, axis=1), np.delete(np.delete(X, 1, axis=0), 2, axis=1))
+
+def test_profile(tmp_path):
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    estimator = SmoothNMF(G=G, n_components= 2, max_iter=5, lambda_L=1, shape_2d=(10, 20), simplex_W=False, simplex_H=True, hspy_comp = False,
+                          true_D=D, true_H=H, no_stop_criterion=True, profile="memory")
+    estimator.fit(X)
+    profile = estimator.get_profile()
+    assert len(profile) == estimator.n_iter_ == len(estimator.get_losses())
+    np.testing.assert_array_equal(profile["iteration"], np.arange(1, 6))
+    for name in ["H_step", "W_step", "dichotomy", "loss", "truth_metrics", "stopping_checks"]:
+        assert np.all(profile[name + "_wall"] > 0)
+    assert np.all(profile["dichotomy_iter"] > 0)
+    assert np.all(profile["peak_bytes"] > 0)
+
+    filename = tmp_path / "trace.json"
+    estimator.export_profile(filename)
+    with open(filename) as f:
+        events = json.load(f)["traceEvents"]
+    assert {event["name"] for event in events} >= {"H_step", "W_step", "dichotomy", "loss"}
+
+    estimator = SmoothNMF(G=G, n_components= 2, max_iter=2, hspy_comp = False)
+    estimator.fit(X)
+    with pytest.raises(ValueError):
+        estimator.get_profile()
+
+def test_profile_threads():
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    params = dict(G=G, n_components= 2, max_iter=3, lambda_L=1, shape_2d=(10, 20), simplex_W=False, simplex_H=True, hspy_comp = False,
+                  no_stop_criterion=True)
+    # The profiler is not shared by fits running in different threads, and the pool of the steps in H records the dichotomies
+    estimators = [SmoothNMF(profile=True, **params), SmoothNMF(profile=True, n_jobs=2, **params), SmoothNMF(**params)]
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        list(pool.map(lambda estimator: estimator.fit(X), estimators))
+    for estimator in estimators[:2]:
+        reference = SmoothNMF(profile=True, n_jobs=estimator.n_jobs, **params)
+        reference.fit(X)
+        assert np.all(estimator.get_profile()["dichotomy_iter"] > 0)
+        np.testing.assert_array_equal(estimator.get_profile()["dichotomy_iter"], reference.get_profile()["dichotomy_iter"])
+    assert get_active_profiler() is None
+
+def test_callback():
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    states = []
+    def callback(state):
+        states.append(state)
+        return state.n_iter >= 6
+    estimator = SmoothNMF(G=G, n_components= 2, max_iter=20, lambda_L=1, shape_2d=(10, 20), simplex_W=False, simplex_H=True, hspy_comp = False,
+                          no_stop_criterion=True, callback=callback, callback_every=2, profile=True)
+    estimator.fit(X)
+    assert estimator.n_iter_ == 6
+    assert [state.n_iter for state in states] == [2, 4, 6]
+    assert states[-1].loss == estimator.losses_[-1]
+    assert states[-1].rel_W == estimator.rel_[-1][0]
+    assert states[-1].timings["total"] >= states[-1].timings["iteration"] > 0
+    assert states[-1].timings["H_step"] > 0
+    assert not(states[-1].W.flags.writeable)
+    assert states[-1].H.shape == estimator.H_.shape
+
+    with pytest.raises(ValueError):
+        SmoothNMF(G=G, n_components= 2, callback=1, hspy_comp = False).fit(X)
+
+def test_eval_truth():
+    G, W, H, D, w, X, Xdot, N = generate_one_sample()
+    params = dict(G=G, n_components= 2, max_iter=6, lambda_L=1, shape_2d=(10, 20), simplex_W=False, simplex_H=True, hspy_comp = False,
+                  true_D=D, true_H=H, no_stop_criterion=True, random_state=0)
+    estimator = SmoothNMF(**params)
+    estimator.fit(X)
+    losses = estimator.get_losses()
+
+    estimator = SmoothNMF(eval_truth_background=True, **params)
+    estimator.fit(X)
+    losses_background = estimator.get_losses()
+    for name in losses.dtype.names:
+        np.testing.assert_allclose(losses[name], losses_background[name])
+
+    estimator = SmoothNMF(eval_truth_every=2, **params)
+    estimator.fit(X)
+    losses_every = estimator.get_losses()
+    np.testing.assert_allclose(losses_every["full_loss"], losses["full_loss"])
+    assert np.all(np.isnan(losses_every["true_KL_loss"][::2]))
+    np.testing.assert_allclose(losses_every["true_KL_loss"][1::2], losses["true_KL_loss"][1::2])
+    np.testing.assert_allclose(losses_every["ang_p0"][1::2], losses["ang_p0"][1::2])
+
 def test_fixed_mat () :
     G, W, H, D, w, X, Xdot, N = generate_one_sample()
     fW, fH = gen_fixed_mat()
@@ -1,5 +1,5 @@
 import numpy as np
-from espm.utils import create_laplacian_matrix
+from espm.utils import create_laplacian_matrix, LaplacianOperator
 from espm.conf import sigmaL
 from scipy.sparse.linalg import eigs
 
@@ -36,3 +36,29 @@ def test_sigma_L():
             Delta = create_laplacian_matrix(nx, ny)
             l2 = np.abs(eigs(Delta, k=1)[0][0])
             assert(l2 <= sigmaL)
+
+def test_laplacian_operator():
+    for nx in range(2, 5):
+        for ny in range(2, 8):
+            H = np.random.rand(3, nx*ny)
+            L = LaplacianOperator(nx, ny, dtype=np.float64)
+            L2 = create_laplacian_matrix(nx, ny)
+            np.testing.assert_allclose(H @ L, H @ L2)
+            np.testing.assert_allclose(L @ H.T, L2 @ H.T)
+            np.testing.assert_allclose(L.toarray(), L2.toarray())
+
+    # 8 neighbours: the adjacency contains the diagonal neighbours
+    L8 = LaplacianOperator(6, 7, connectivity=8).toarray()
+    np.testing.assert_allclose(L8, L8.T)
+    np.testing.assert_allclose(np.sum(L8, axis=1), 0, atol=1e-6)
+    assert L8[0, 0] == 3 and L8[0, 8] == -1
+    assert np.max(np.linalg.eigvalsh(L8)) <= LaplacianOperator(6, 7, connectivity=8).sigma
+
+    # Mask: Laplacian of the subgraph of the pixels of the mask
+    mask = np.random.rand(6, 7) > 0.3
+    Lm = LaplacianOperator(6, 7, mask=mask, dtype=np.float64)
+    A = np.diag(np.diag(create_laplacian_matrix(6, 7).toarray())) - create_laplacian_matrix(6, 7).toarray()
+    ind = np.flatnonzero(mask)
+    A = A[np.ix_(ind, ind)]
+    np.testing.assert_allclose(Lm.toarray(), np.diag(np.sum(A, axis=1)) - A)
+    assert Lm.shape == (len(ind), len(ind))
@@ -1,6 +1,8 @@
 import numpy as np
+import pytest
 from espm.measures import mse, spectral_angle, KLdiv_loss, KLdiv, find_min_MSE, find_min_angle, trace_xtLx, Frobenius_loss, ordered_angles, ordered_mse
-from espm.measures import KL_loss_surrogate, log_reg, log_surrogate
+from espm.measures import KL_loss_surrogate, log_reg, log_surrogate, unique_min, pairwise_metrics, mae, r2, ordered_mae, ordered_r2
+from itertools import permutations
 from espm.conf import log_shift
 from espm.utils import create_laplacian_matrix
 
@@ -128,6 +130,60 @@ def test_find_min_mse () :
     np.testing.assert_allclose(mins_g,true_res_g[0])
     np.testing.assert_allclose(ind_mins_g,true_res_g[1])
 
+def test_unique_min () : 
+    np.random.seed(0)
+    for k in range(1, 7) : 
+        matrix = np.random.rand(k, k)
+        # Brute force search over the permutations
+        sums = [sum(matrix[perm[i], i] for i in range(k)) for perm in permutations(range(k))]
+        best = list(permutations(range(k)))[np.argmin(sums)]
+        mins, perm = unique_min(matrix)
+        assert perm == best
+        np.testing.assert_allclose(mins, [matrix[best[i], i] for i in range(k)])
+
+    # More lines than columns: every column is assigned
+    matrix = np.random.rand(5, 3)
+    sums = {perm : sum(matrix[perm[i], i] for i in range(3)) for perm in permutations(range(5), 3)}
+    mins, perm = unique_min(matrix)
+    assert perm == min(sums, key=sums.get)
+
+    # More columns than lines: the unassigned columns are NaN
+    mins, perm = unique_min(matrix.T)
+    assert sum(p is None for p in perm) == 2
+    assert np.sum(np.isnan(mins)) == 2
+    assert sorted(p for p in perm if p is not None) == [0, 1, 2]
+
+    # NaN entries are avoided and large problems are solved
+    matrix = np.random.rand(20, 20)
+    matrix[0, 0] = np.nan
+    mins, perm = unique_min(matrix)
+    assert perm[0] != 0 and sorted(perm) == list(range(20))
+
+def test_pairwise_metrics () : 
+    np.random.seed(0)
+    for shape in [(50,), (6, 7)] : 
+        true_maps = np.random.rand(3, *shape)
+        algo_maps = np.random.rand(4, *shape)
+        algo_maps[1] = true_maps[2]
+        for chunk_size in [None, 4] : 
+            metrics = pairwise_metrics(true_maps, algo_maps, chunk_size=chunk_size)
+            for i in range(3) : 
+                for j in range(4) : 
+                    np.testing.assert_allclose(metrics["angle"][i, j], spectral_angle(true_maps[i].ravel(), algo_maps[j].ravel()), atol=1e-5)
+                    np.testing.assert_allclose(metrics["mse"][i, j], mse(true_maps[i], algo_maps[j]), atol=1e-12)
+                    np.testing.assert_allclose(metrics["mae"][i, j], mae(true_maps[i], algo_maps[j]))
+                    np.testing.assert_allclose(metrics["r2"][i, j], r2(true_maps[i], algo_maps[j]), atol=1e-12)
+
+    metrics = pairwise_metrics(true_maps, algo_maps, metrics=("mse",))
+    assert list(metrics) == ["mse"]
+    with pytest.raises(ValueError):
+        pairwise_metrics(true_maps, algo_maps, metrics=("rmse",))
+
+    # Unassigned components of the ordered functions are NaN
+    inds = (2, None, 0)
+    np.testing.assert_allclose(ordered_mae(true_maps, algo_maps, inds), [mae(true_maps[2], algo_maps[0]), np.nan, mae(true_maps[0], algo_maps[2])])
+    np.testing.assert_allclose(ordered_r2(true_maps, algo_maps, inds)[0], r2(true_maps[2], algo_maps[0]))
+
 def test_ordered_functions () : 
     np.random.seed(42)
     p1 = np.random.rand(4,34)
@@ -276,3 +332,14 @@ def test_surrogates():
     np.testing.assert_allclose(
         log_surrogate(H0, H0, mu=mu, epsilon=epsilon),
         log_reg(H0, mu=mu, epsilon=epsilon))
+
+def test_KLdiv_loss_sparse():
+    from scipy.sparse import csr_matrix
+    W = np.random.rand(20, 3)
+    H = np.random.rand(3, 30)
+    X = np.random.poisson(0.3 * W @ H).astype(float)
+    X[0, 0] = 1
+    Xs = csr_matrix(X)
+    for average in [False, True]:
+        # The zeros of X only contribute to the dense loss through the clipping to log_shift
+        np.testing.assert_allclose(KLdiv_loss(Xs, W, H, average=average), KLdiv_loss(X, W, H, average=average), rtol=1e-7)
@@ -0,0 +1,64 @@
+import numpy as np
+import hyperspy.api as hs
+import espm.spectrum_fitting as sf
+
+example = {
+    "E0" : 200,
+    "b0" : 1.0,
+    "b1" : 1.0,
+    "params_dict" : {
+        "Det" : "SDD_efficiency.txt",
+        "Abs" : {
+            "thickness" : 2e-5,
+            "toa" : 35,
+            "density" : 3.5}
+    },
+    "elements_dict" : {"Fe" : 0.0194, "C" : 0.8904, "Pt" : 0.0051, "O" : 0.03797, "Si" : 0.00850, "Cu" : 0.03846}
+}
+
+def test_make_partial_xy () :
+    x = np.linspace(0.3, 19.29, 1900)
+    spectrum = hs.signals.Signal1D(np.random.rand(1900))
+    spectrum.axes_manager[0].offset = 0.3
+    spectrum.axes_manager[0].scale = 0.01
+    list_energies = [[1.0, 2.0], [5.5, 7.25]]
+    part_x, part_y, mask = sf.make_partial_xy(list_energies, spectrum, x)
+    np.testing.assert_array_equal(mask, ((x > 1.0) & (x < 2.0)) | ((x > 5.5) & (x < 7.25)))
+    assert part_x.shape == (275,)
+    assert part_y.shape == (275,)
+
+def test_background_model () :
+    x = np.linspace(0.3, 19, 1900)
+    pars = sf.ndict_to_params(example)
+    for name in ["params_dict__Abs__toa", "params_dict__Abs__density", "E0"] :
+        pars[name].vary = False
+    truth = pars.copy()
+    truth["b0"].value, truth["b1"].value, truth["params_dict__Abs__thickness"].value = 3e-2, 5e-3, 5e-5
+    mask = np.zeros_like(x, dtype = bool)
+    mask[100:300], mask[900:1200], mask[1500:1800] = True, True, True
+    data = sf.residual(truth, x)
+
+    background = sf.BackgroundModel.from_params(pars, x, mask = mask)
+    np.testing.assert_allclose(background.residual(truth), data[mask], rtol = 1e-12)
+    np.testing.assert_allclose(background.residual(pars, data[mask]), sf.residual(pars, x[mask], data = data[mask]), rtol = 1e-12, atol = 1e-15)
+
+    # Analytic jacobian against finite differences
+    jac = background.jacobian(truth)
+    assert jac.shape == (mask.sum(), 3)
+    for i, name in enumerate(background.names) :
+        shifted = truth.copy()
+        step = 1e-6 * shifted[name].value
+        shifted[name].value += step
+        np.testing.assert_allclose((background.residual(shifted) - background.residual(truth)) / step, jac[:, i], rtol = 1e-4, atol = 1e-6 * np.max(np.abs(jac[:, i])))
+
+    out = background.fit(data, pars)
+    for name in background.names :
+        np.testing.assert_allclose(out.params[name].value, truth[name].value, rtol = 1e-6)
+    # The other parameters are not fitted
+    assert out.params["params_dict__Abs__toa"].value == pars["params_dict__Abs__toa"].value
+
+    # Without absorption, the model is linear in b0 and b1
+    pars["params_dict__Abs__thickness"].value = 0.0
+    pars["params_dict__Abs__thickness"].vary = False
+    background = sf.BackgroundModel.from_params(pars, x)
+    np.testing.assert_allclose(background.residual(pars), sf.residual(pars, x), rtol = 1e-12)
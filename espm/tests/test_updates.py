@@ -2,6 +2,8 @@ import numpy as np
 
 from espm.estimators.updates import dichotomy_simplex, multiplicative_step_w, multiplicative_step_h, update_q, dichotomy_simplex_acc, multiplicative_step_hq
 from espm.estimators.updates import estimate_Lipschitz_bound_h, estimate_Lipschitz_bound_w, gradW, gradH, proj_grad_step_h, proj_grad_step_w
+from espm.estimators.updates import initialize_algorithms, ReconstructionCache, Workspace
+from espm.estimators.dicotomy import dichotomy_simplex_projected_gradient, simplex_projected_gradient, dicotomy
 from espm.measures import KLdiv_loss, log_reg, Frobenius_loss, trace_xtLx
 from espm.conf import log_shift, dicotomy_tol
 from espm.utils import create_laplacian_matrix
@@ -730,6 +732,35 @@ def test_proj_step_h():
                         loss_old = loss
                         n_grad_old = n_grad
 
+def test_safeguarded_newton():
+    # The Newton solver reaches the same multipliers as the dichotomy
+    num = np.random.rand(6, 300)**3
+    num[0, :10] = 0
+    denum = np.random.rand(6, 1) + np.zeros((6, 300))
+    nu = dichotomy_simplex(num, denum, log_shift=1e-14, tol=1e-10)
+    a = np.max(np.where(num>0, num/2 - denum, -np.inf), axis=0)
+    b = 12 * np.max(num, axis=0) - np.min(denum, axis=0)
+    nu_ref = dicotomy(a, b, lambda x: np.sum(np.maximum(num / (x + denum), 1e-14), axis=0) - 1, 200, 1e-12)
+    np.testing.assert_allclose(nu, nu_ref, rtol=1e-6)
+
+    a, b, minus_c = 0.3, np.random.rand(6, 300), np.random.rand(6, 300)
+    nu = dichotomy_simplex_acc(a, b, minus_c, log_shift=1e-14, tol=1e-10)
+    np.testing.assert_allclose(np.sum(np.maximum((-(b + nu) + np.sqrt((b + nu)**2 + 4*a*minus_c)) / (2*a), 1e-14), axis=0), 1, atol=1e-8)
+
+def test_simplex_projected_gradient():
+    for k in [2, 3, 10]:
+        for shift in [0, 1e-3]:
+            a = np.random.randn(k, 500) * np.random.choice([0.01, 1, 10], size=(1, 500))
+            nu = simplex_projected_gradient(a, log_shift=shift)
+            assert nu.shape == (500,)
+            np.testing.assert_allclose(np.sum(np.maximum(a + nu, shift), axis=0), 1)
+            nu2 = dichotomy_simplex_projected_gradient(a.copy(), log_shift=shift, tol=1e-12, maxit=200)
+            np.testing.assert_allclose(nu, nu2, atol=1e-10)
+    a = np.random.randn(3, 20).astype(np.float32)
+    assert simplex_projected_gradient(a).dtype == np.float32
+    with pytest.raises(ValueError):
+        simplex_projected_gradient(a, log_shift=0.5)
+
 def test_proj_step_w():
     for _ in range(10):
         shape_2d = [10, 15]
@@ -774,3 +805,100 @@ def test_proj_step_w():
             n_grad_old = n_grad
 
 
+
+def test_identity_G():
+    l = 26
+    k = 5
+    p = 100
+
+    H = np.random.rand(k,p)
+    H = H/np.sum(H, axis=0, keepdims=True)
+    W = np.random.rand(l,k)
+    # X is not an exact factorization, otherwise the steps with use_bregman are fixed points
+    X = np.random.rand(l, p)
+    I = np.eye(l)
+
+    for use_bregman in [False, True]:
+        W1 = multiplicative_step_w(X, None, W, H, simplex_W = True, use_bregman=use_bregman)
+        W2 = multiplicative_step_w(X, I, W, H, simplex_W = True, use_bregman=use_bregman)
+        np.testing.assert_allclose(W1, W2)
+        assert not(np.allclose(W1, W))
+
+        H1 = multiplicative_step_h(X, None, W, H, simplex_H = True, use_bregman=use_bregman)
+        H2 = multiplicative_step_h(X, I, W, H, simplex_H = True, use_bregman=use_bregman)
+        np.testing.assert_allclose(H1, H2)
+
+    np.testing.assert_allclose(multiplicative_step_w(X, None, W, H, l2=True), multiplicative_step_w(X, I, W, H, l2=True))
+    np.testing.assert_allclose(multiplicative_step_hq(X, None, W, H), multiplicative_step_hq(X, I, W, H))
+    np.testing.assert_allclose(gradW(X, None, W, H), gradW(X, I, W, H))
+    np.testing.assert_allclose(gradW(X, None, W, H, l2=True), gradW(X, I, W, H, l2=True))
+    np.testing.assert_allclose(gradH(X, None, W, H), gradH(X, I, W, H))
+    np.testing.assert_allclose(estimate_Lipschitz_bound_w(log_shift, X, None, k), estimate_Lipschitz_bound_w(log_shift, X, I, k))
+    np.testing.assert_allclose(estimate_Lipschitz_bound_h(log_shift, X, None, k), estimate_Lipschitz_bound_h(log_shift, X, I, k))
+
+    # An explicit identity is replaced by None during the initialization
+    G, W0, H0 = initialize_algorithms(X, I, None, None, k, "nndsvda", 0, simplex_H=True, simplex_W=False)
+    assert G is None
+    G, W0, H0 = initialize_algorithms(X, None, None, None, k, "nndsvda", 0, simplex_H=True, simplex_W=False)
+    assert G is None
+
+def test_reconstruction_cache():
+    G, W, H, X, Xdot = create_toy_problem()
+    cache = ReconstructionCache()
+
+    GWH = cache.GWH(G, W, H)
+    np.testing.assert_allclose(GWH, G @ W @ H)
+    assert cache.GWH(G, W, H) is GWH
+    assert cache.GW(G, W) is cache.GW(G, W)
+
+    # A new H only triggers the computation of GWH
+    GW = cache.GW(G, W)
+    H2 = H.copy()
+    assert not(cache.GWH(G, W, H2) is GWH)
+    assert cache.GW(G, W) is GW
+
+    # In place modifications require an invalidation
+    G[:, 0] = 2 * G[:, 0]
+    cache.invalidate()
+    np.testing.assert_allclose(cache.GWH(G, W, H2), G @ W @ H2)
+
+    # The kernels give the same results with and without cache
+    cache = ReconstructionCache()
+    for _ in range(3):
+        H1 = multiplicative_step_h(Xdot, G, W, H, simplex_H=True, cache=cache)
+        H2 = multiplicative_step_h(Xdot, G, W, H, simplex_H=True)
+        np.testing.assert_allclose(H1, H2)
+        W1 = multiplicative_step_w(Xdot, G, W, H1, simplex_W=True, cache=cache)
+        W2 = multiplicative_step_w(Xdot, G, W, H2, simplex_W=True)
+        np.testing.assert_allclose(W1, W2)
+        np.testing.assert_allclose(KLdiv_loss(Xdot, G @ W1, H1, WH=cache.GWH(G, W1, H1)), KLdiv_loss(Xdot, G @ W1, H1))
+        W, H = W1, H1
+
+def test_workspace():
+    G, W, H, X, Xdot = create_toy_problem()
+    L = create_laplacian_matrix(10, 10)
+    for G_ in [G, None]:
+        W_ = W if G_ is not None else G @ W
+        ws = Workspace(*Xdot.shape, block_size=7)
+        buffer = ws._GWH_buffer
+        for _ in range(2):
+            H1 = multiplicative_step_h(Xdot, G_, W_, H, simplex_H=True, lambda_L=1, L=L, cache=ws)
+            H2 = multiplicative_step_h(Xdot, G_, W_, H, simplex_H=True, lambda_L=1, L=L)
+            np.testing.assert_allclose(H1, H2)
+            for use_bregman in [False, True]:
+                W1 = multiplicative_step_w(Xdot, G_, W_, H1, use_bregman=use_bregman, cache=ws)
+                W2 = multiplicative_step_w(Xdot, G_, W_, H1, use_bregman=use_bregman)
+                np.testing.assert_allclose(W1, W2)
+            np.testing.assert_allclose(multiplicative_step_hq(Xdot, G_, W_, H1, cache=ws), multiplicative_step_hq(Xdot, G_, W_, H1))
+            np.testing.assert_allclose(gradW(Xdot, G_, W_, H1, cache=ws), gradW(Xdot, G_, W_, H1))
+            np.testing.assert_allclose(gradH(Xdot, G_, W_, H1, cache=ws), gradH(Xdot, G_, W_, H1))
+            GW = G_ @ W1 if G_ is not None else W1
+            l1 = KLdiv_loss(Xdot, GW, H1, buffer=ws.loss_buffer)
+            l2 = KLdiv_loss(Xdot, GW, H1, WH=ws.GWH(G_, W1, H1), buffer=ws.loss_buffer)
+            l3 = KLdiv_loss(Xdot, GW, H1)
+            np.testing.assert_allclose(l1, l3)
+            np.testing.assert_allclose(l2, l3)
+            np.testing.assert_allclose(KLdiv_loss(Xdot, GW, H1, average=True, buffer=ws.loss_buffer), KLdiv_loss(Xdot, GW, H1, average=True))
+            W_, H = W1, H1
+        # No new buffer has been allocated
+        assert ws._GWH_buffer is buffer
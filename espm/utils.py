@@ -1,7 +1,7 @@
 r"""Utils for the ESPM package"""
 
 import numpy as np
-from scipy.sparse import lil_matrix, block_diag
+from scipy.sparse import lil_matrix, block_diag, issparse, csr_matrix, csc_matrix
 from scipy.optimize import nnls
 from espm.conf import SYMBOLS_PERIODIC_TABLE, NUMBER_PERIODIC_TABLE
 import json
@@ -36,7 +36,7 @@ def process_losses(losses):
     values = np.array(values)
     return values, names
 
-def create_laplacian_matrix(nx, ny=None):
+def create_laplacian_matrix(nx, ny=None, dtype=np.float32):
     r"""
     Helper method to create the laplacian matrix for the laplacian regularization
     
@@ -44,6 +44,7 @@ def create_laplacian_matrix(nx, ny=None):
     ----------
     :param nx: height of the original image
     :param ny: width of the original image
+    :param dtype: dtype of the matrix (default np.float32)
 
     Returns
     -------
@@ -58,12 +59,12 @@ def create_laplacian_matrix(nx, ny=None):
     assert(nx>1)
     assert(ny>1)
     #Blocks corresponding to the corner of the image (linking row elements)
-    top_block=lil_matrix((ny,ny),dtype=np.float32)
+    top_block=lil_matrix((ny,ny),dtype=dtype)
     top_block.setdiag([2]+[3]*(ny-2)+[2])
     top_block.setdiag(-1,k=1)
     top_block.setdiag(-1,k=-1)
     #Blocks corresponding to the middle of the image (linking row elements)
-    mid_block=lil_matrix((ny,ny),dtype=np.float32)
+    mid_block=lil_matrix((ny,ny),dtype=dtype)
     mid_block.setdiag([3]+[4]*(ny-2)+[3])
     mid_block.setdiag(-1,k=1)
     mid_block.setdiag(-1,k=-1)
@@ -73,7 +74,235 @@ def create_laplacian_matrix(nx, ny=None):
     #Diagonals linking different rows
     blocks.setdiag(-1,k=ny)
     blocks.setdiag(-1,k=-ny)
-    return blocks
+    return blocks.tocsr()
+
+
+class LaplacianOperator:
+    r"""
+    Matrix-free graph Laplacian of the pixels of an image.
+
+    The Laplacian is applied with a stencil on the (k, nx, ny) view of a matrix H of shape (k, p), without building the
+    p x p matrix. It supports `H @ L` and `L @ X`, so it can replace the matrix of :func:`create_laplacian_matrix` (the
+    operator is symmetric). With `connectivity=4` and no mask, it is equal to this matrix.
+
+    Parameters
+    ----------
+    :param nx: height of the original image
+    :param ny: width of the original image (default nx)
+    :param connectivity: 4 (horizontal and vertical neighbours) or 8 (also the diagonal neighbours)
+    :param mask: boolean array of shape (nx, ny) selecting the pixels of a non-rectangular region. The pixels are then the
+        p = mask.sum() pixels of the mask (in the row-major order) and only the edges between them are kept.
+    :param dtype: dtype of the operator (default np.float32)
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from espm.utils import LaplacianOperator, create_laplacian_matrix
+    >>> H = np.random.rand(3, 20)
+    >>> np.allclose(H @ LaplacianOperator(4, 5), H @ create_laplacian_matrix(4, 5))
+    True
+    """
+    # Let numpy defer H @ L to __rmatmul__
+    __array_ufunc__ = None
+
+    def __init__(self, nx, ny=None, connectivity=4, mask=None, dtype=np.float32):
+        if ny is None:
+            ny = nx
+        if not(connectivity in [4, 8]):
+            raise ValueError("The connectivity must be 4 or 8.")
+        self.shape_2d = (nx, ny)
+        self.connectivity = connectivity
+        self.dtype = np.dtype(dtype)
+        if mask is None:
+            self.mask = None
+            indicator = np.ones((1, nx, ny), dtype=self.dtype)
+        else:
+            self.mask = np.asarray(mask, dtype=bool)
+            if self.mask.shape != self.shape_2d:
+                raise ValueError("The mask should have the shape (nx, ny).")
+            indicator = self.mask[np.newaxis].astype(self.dtype)
+        p = nx * ny if self.mask is None else int(np.sum(self.mask))
+        self.shape = (p, p)
+        # Degree of each pixel, i.e. the number of its neighbours in the region
+        self.degrees = self._neighbours_sum(indicator)[0]
+        # Bound on the largest eigenvalue of the Laplacian
+        self.sigma = 2 * float(np.max(self.degrees)) if p > 0 else 0.0
+
+    def _neighbours_sum(self, V):
+        # Sum of the values of the neighbours of each pixel, for V of shape (k, nx, ny)
+        out = np.zeros_like(V)
+        out[:, 1:, :] += V[:, :-1, :]
+        out[:, :-1, :] += V[:, 1:, :]
+        out[:, :, 1:] += V[:, :, :-1]
+        out[:, :, :-1] += V[:, :, 1:]
+        if self.connectivity == 8:
+            out[:, 1:, 1:] += V[:, :-1, :-1]
+            out[:, :-1, :-1] += V[:, 1:, 1:]
+            out[:, 1:, :-1] += V[:, :-1, 1:]
+            out[:, :-1, 1:] += V[:, 1:, :-1]
+        return out
+
+    def apply(self, H):
+        r"""Compute :math:`H L` for H of shape (k, p)."""
+        H = np.asarray(H)
+        squeeze = H.ndim == 1
+        H = np.atleast_2d(H)
+        if H.shape[1] != self.shape[0]:
+            raise ValueError("H should have {} columns.".format(self.shape[0]))
+        dtype = np.result_type(H, self.dtype)
+        if self.mask is None:
+            V = H.reshape((H.shape[0],) + self.shape_2d).astype(dtype, copy=False)
+        else:
+            V = np.zeros((H.shape[0],) + self.shape_2d, dtype=dtype)
+            V[:, self.mask] = H
+        out = self.degrees * V - self._neighbours_sum(V)
+        out = out.reshape(H.shape[0], -1) if self.mask is None else out[:, self.mask]
+        return out[0] if squeeze else out
+
+    def __rmatmul__(self, H):
+        return self.apply(H)
+
+    def __matmul__(self, X):
+        # L @ X = (X^T L)^T as L is symmetric
+        X = np.asarray(X)
+        if X.ndim == 1:
+            return self.apply(X)
+        return self.apply(X.T).T
+
+    @property
+    def T(self):
+        return self
+
+    def tocsr(self):
+        r"""Return the Laplacian as a scipy.sparse.csr_matrix."""
+        return csr_matrix(self.apply(np.eye(self.shape[0], dtype=self.dtype)))
+
+    def toarray(self):
+        r"""Return the Laplacian as a dense np.array."""
+        return self.apply(np.eye(self.shape[0], dtype=self.dtype))
+
+
+class BlockSparseG:
+    r"""
+    G matrix made of a sparse block of columns followed by a dense block of columns.
+
+    The characteristic X-ray columns of the EDXS model are sums of gaussians, which are nearly zero a few widths away from
+    their lines. Once truncated, they are stored in a scipy.sparse.csc_matrix, while the bremsstrahlung columns (which are
+    updated during the NMF) are kept in a dense array. The matrix supports `G @ W`, `G.T @ M` and the sums of its columns,
+    so that it can replace a dense G in the estimators of :mod:`espm.estimators`.
+
+    Parameters
+    ----------
+    :param sparse: n x m_s sparse matrix of the first columns
+    :param dense: n x m_d array of the last columns (m_d can be 0)
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from espm.utils import BlockSparseG
+    >>> G = np.random.rand(20, 5) * (np.random.rand(20, 5) > 0.7)
+    >>> W = np.random.rand(5, 3)
+    >>> np.allclose(BlockSparseG.from_dense(G, 2) @ W, G @ W)
+    True
+    """
+    # Let numpy defer W.T @ G to __rmatmul__
+    __array_ufunc__ = None
+
+    def __init__(self, sparse, dense):
+        dense = np.asarray(dense)
+        if dense.ndim != 2 or dense.shape[0] != sparse.shape[0]:
+            raise ValueError("The dense block should have {} rows.".format(sparse.shape[0]))
+        self.sparse = csc_matrix(sparse)
+        self.dense = dense
+        self.n_sparse = self.sparse.shape[1]
+
+    @classmethod
+    def from_dense(cls, G, n_dense=2):
+        r"""Split a dense matrix into a sparse block (its first columns, without the zeros) and a dense block of `n_dense` columns."""
+        G = np.asarray(G)
+        n_sparse = G.shape[1] - n_dense
+        return cls(csc_matrix(G[:, :n_sparse]), G[:, n_sparse:].copy())
+
+    @property
+    def shape(self):
+        return (self.sparse.shape[0], self.n_sparse + self.dense.shape[1])
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def dtype(self):
+        return np.result_type(self.sparse.dtype, self.dense.dtype)
+
+    @property
+    def nnz(self):
+        r"""Number of stored entries of the sparse block."""
+        return self.sparse.nnz
+
+    def __matmul__(self, W):
+        if isinstance(W, BlockSparseG):
+            W = W.toarray()
+        W = np.asarray(W)
+        return self.sparse @ W[:self.n_sparse] + self.dense @ W[self.n_sparse:]
+
+    def __rmatmul__(self, M):
+        # M @ G, computed as (G^T M^T)^T
+        M = np.asarray(M)
+        if M.ndim == 1:
+            return self.T @ M
+        return (self.T @ M.T).T
+
+    @property
+    def T(self):
+        return _TransposedBlockSparseG(self)
+
+    def column_sums(self):
+        r"""Return the sums of the columns as an array of shape (m,)."""
+        sparse_sums = np.asarray(self.sparse.sum(axis=0)).ravel()
+        return np.concatenate([sparse_sums, np.sum(self.dense, axis=0)]).astype(self.dtype, copy=False)
+
+    def min(self):
+        r"""Return the smallest entry (the implicit zeros of the sparse block included)."""
+        values = [np.min(self.dense)] if self.dense.size else []
+        if self.sparse.nnz:
+            values.append(np.min(self.sparse.data))
+        if self.sparse.nnz < self.sparse.shape[0] * self.n_sparse:
+            values.append(0)
+        return min(values)
+
+    def astype(self, dtype, copy=True):
+        r"""Return the matrix in the given dtype. With `copy=False`, the matrix itself is returned if it already has this dtype."""
+        if not(copy) and self.sparse.dtype == dtype and self.dense.dtype == dtype:
+            return self
+        return BlockSparseG(self.sparse.astype(dtype), self.dense.astype(dtype))
+
+    def copy(self):
+        return BlockSparseG(self.sparse.copy(), self.dense.copy())
+
+    def toarray(self):
+        r"""Return G as a dense np.array."""
+        return np.hstack([self.sparse.toarray(), self.dense]).astype(self.dtype, copy=False)
+
+
+class _TransposedBlockSparseG:
+    # Transpose of a BlockSparseG, only used to compute G.T @ M
+    def __init__(self, G):
+        self.G = G
+        self.shape = G.shape[::-1]
+
+    def __matmul__(self, M):
+        if isinstance(M, BlockSparseG):
+            M = M.toarray()
+        M = np.asarray(M)
+        return np.concatenate([self.G.sparse.T @ M, self.G.dense.T @ M], axis=0)
+
+
+def dense_G(G):
+    r"""Return `G` as a np.array if it is a :class:`BlockSparseG`, otherwise `G` unchanged."""
+    if isinstance(G, BlockSparseG):
+        return G.toarray()
+    return G
 
 
 def rescaled_DH(D,H) :
@@ -95,6 +324,42 @@ def rescaled_DH(D,H) :
     H_rescale = np.diag(s)@H
     return D_rescale, H_rescale
 
+def product_at_nonzeros(D, H, X, block_size=65536) :
+    r"""Compute the entries of :math:`DH` at the nonzero entries of the sparse matrix `X`.
+
+    Only the nnz entries are computed, i.e. the cost is O(nnz k) instead of O(n m k).
+
+    :param np.array 2D D: n x k matrix
+    :param np.array 2D H: k x m matrix
+    :param scipy.sparse.csr_matrix X: n x m sparse matrix
+    :param int block_size: number of entries computed at once (default 65536)
+
+    :return: the values of :math:`DH` in the order of `X.data`
+    :rtype: np.array 1D
+    """
+    X = X.tocsr()
+    rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+    out = np.empty(X.nnz, dtype=np.result_type(D, H))
+    for start in range(0, X.nnz, block_size) : 
+        s = slice(start, start + block_size)
+        out[s] = np.einsum("ij,ji->i", D[rows[s]], H[:, X.indices[s]])
+    return out
+
+def sum_keepdims(X, axis=None) :
+    r"""Sum of a dense or sparse matrix. The dimensions are kept when `axis` is not None.
+
+    :param np.array 2D or scipy.sparse matrix X: matrix
+    :param int axis: axis of the sum (default None, i.e. the sum of all entries)
+
+    :return: the sum
+    :rtype: float or np.array 2D
+    """
+    if axis is None : 
+        return X.sum()
+    if issparse(X) : 
+        return np.asarray(X.sum(axis=axis)).reshape((1, -1) if axis == 0 else (-1, 1))
+    return np.sum(X, axis=axis, keepdims=True)
+
 def bin_spim(data,n,m):
     r""" 
     
@@ -396,19 +661,26 @@ def close_all():
 def get_explained_intensity_W(G, W, H) : 
     r""" Compute the explained intensity of each element of W.
 
-    :param np.array 2D G: G matrix of the ESpM-NMF decomposition
+    :param np.array 2D G: G matrix of the ESpM-NMF decomposition (None stands for the identity matrix)
     :param np.array 2D W: W matrix of the ESpM-NMF decomposition
     :param np.array 2D H: H matrix of the ESpM-NMF decomposition
 
     :return: np.array 2D
 
     """
+
     # I couldn't find a linear algebra trick
     #int_matrix = np.zeros(W.shape)
     #for i in range(W.shape[0]) : 
     #    for j in range(W.shape[1]) : 
     #        int_matrix[i,j] = np.sum(G[:,i, np.newaxis]*W[i,j]*H[np.newaxis,j,:])
 
-    int_matrix =G.sum(0)[:,np.newaxis]*W*H.sum(1)[np.newaxis,:] #This?
+    if G is None : 
+        G_sums = np.ones(W.shape[0])
+    elif isinstance(G, BlockSparseG) : 
+        G_sums = G.column_sums()
+    else : 
+        G_sums = G.sum(0)
+    int_matrix =G_sums[:,np.newaxis]*W*H.sum(1)[np.newaxis,:] #This?
 
     return int_matrix
\ No newline at end of file
@@ -20,6 +20,7 @@ global_param["dicotomy_tol"] = dicotomy_tol
 global_param["debug"] = False
 global_param["log_shift"] = log_shift 
 global_param["eval_print"] = 10
+global_param["eval_truth_background"] = True
 global_param["hspy_comp"] = False
 global_param["no_stop_criterion"] = True
 global_param["init"] = "nndsvda"